@@ -0,0 +1,101 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         bench_acks.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Compares small-call throughput of a consumer that acks (and replies to) each message on its own with one that
+#   batches them (see `acks`).  Needs a RabbitMQ server; the queues are deleted afterwards.
+#
+#   A consumer process with a few workers echoes tiny requests while this process publishes them and counts the
+#   replies, with the default prefetch (one message per worker) and with a large one.
+#
+#   Usage: python benchmarks/bench_acks.py [calls] [host]
+#
+
+import multiprocessing
+import sys
+import time
+
+import pika
+from rabbitrpc.rabbitmq import consumer
+
+
+QUEUE = 'rabbitrpc.bench.acks'
+REPLIES = 'rabbitrpc.bench.acks.replies'
+WORKERS = 4
+# Prefetch counts to compare, ``None`` for the default
+PREFETCHES = (None, 200)
+
+
+def serve(host, prefetch, ack_batch_size):
+    config = {
+        'queue_name': QUEUE,
+        'workers': WORKERS,
+        'prefetch_count': prefetch,
+        'ack_batch_size': ack_batch_size,
+        'connection_settings': {'host': host, 'port': 5672, 'virtual_host': '/', 'username': 'guest',
+                                'password': 'guest'},
+    }
+    consumer.Consumer(lambda body: body, config).run()
+#---
+
+def run(label, host, calls, prefetch, ack_batch_size):
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    channel = connection.channel()
+    channel.queue_declare(queue=QUEUE, durable=True)
+    channel.queue_declare(queue=REPLIES)
+    channel.queue_purge(queue=QUEUE)
+    channel.queue_purge(queue=REPLIES)
+
+    server = multiprocessing.Process(target=serve, args=(host, prefetch, ack_batch_size))
+    server.start()
+    time.sleep(1)
+
+    properties = pika.BasicProperties(reply_to=REPLIES)
+    started = time.time()
+    for number in xrange(calls):
+        channel.basic_publish(exchange='', routing_key=QUEUE, body=str(number), properties=properties)
+
+    replies = 0
+    for _ in channel.consume(REPLIES, no_ack=True):
+        replies += 1
+        if replies == calls:
+            break
+    elapsed = time.time() - started
+
+    channel.cancel()
+    server.terminate()
+    server.join()
+    channel.queue_delete(queue=QUEUE)
+    channel.queue_delete(queue=REPLIES)
+    connection.close()
+    print '%-14s %6.2fs   %8.0f calls/s' % (label, elapsed, calls / elapsed)
+#---
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    host = sys.argv[2] if len(sys.argv) > 2 else 'localhost'
+
+    print '%i calls, %i workers, on %s' % (calls, WORKERS, host)
+
+    for prefetch in PREFETCHES:
+        print 'prefetch %i:' % (prefetch or WORKERS)
+        run('ack each', host, calls, prefetch, 1)
+        run('batched (50)', host, calls, prefetch, 50)
@@ -0,0 +1,118 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         bench_adaptive.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Simulates a consumer whose worker pool is sized by the adaptive controller, through load steps, and prints how the
+#   pool size and latency settle.  The simulation runs on its own clock, so no RabbitMQ server is needed and it takes
+#   a few seconds.
+#
+#   The simulated endpoint takes SERVICE_TIME on average, and slows down once more than CORES calls run at once, so
+#   too big a pool hurts as much as too small a one.
+#
+#   Usage: python benchmarks/bench_adaptive.py [latency target in ms]
+#
+
+import collections
+import heapq
+import random
+import sys
+
+from rabbitrpc.rabbitmq import adaptive
+
+
+SERVICE_TIME = 0.02
+CORES = 16
+# (until, calls per second)
+LOAD_STEPS = [(60, 200), (120, 600), (180, 100)]
+REPORT_EVERY = 5
+
+
+def service_time(rng, busy):
+    """
+    Stands in for an endpoint: exponential service time, stretched by contention past CORES concurrent calls.
+
+    """
+    stretch = 1 + 2.0 * max(0, busy - CORES) / CORES
+    return rng.expovariate(1 / (SERVICE_TIME * stretch))
+#---
+
+def offered_rate(now):
+    for until, rate in LOAD_STEPS:
+        if now < until:
+            return rate
+    return 0
+#---
+
+def simulate(target):
+    rng = random.Random(1)
+    clock = [0.0]
+    controller = adaptive.AdaptiveController(target, max_workers=64, clock=lambda: clock[0])
+
+    waiting = collections.deque()
+    # (finish time, wait, service)
+    running = []
+    latencies = []
+    next_arrival = rng.expovariate(offered_rate(0))
+    next_report = REPORT_EVERY
+
+    print '%6s %8s %8s %9s %10s %8s' % ('time', 'offered', 'workers', 'prefetch', 'latency', 'queued')
+
+    while clock[0] < LOAD_STEPS[-1][0]:
+        next_finish = running[0][0] if running else float('inf')
+        clock[0] = min(next_arrival, next_finish)
+
+        if clock[0] == next_arrival:
+            waiting.append(clock[0])
+            controller.delivered()
+            next_arrival = clock[0] + rng.expovariate(offered_rate(clock[0]) or 1e-9)
+        else:
+            finished, wait, service = heapq.heappop(running)
+            controller.completed(wait, service)
+            latencies.append(wait + service)
+
+        # The pool shrinks as workers free up, like WorkerPool.resize
+        while waiting and len(running) < controller.workers:
+            delivered_at = waiting.popleft()
+            service = service_time(rng, len(running) + 1)
+            heapq.heappush(running, (clock[0] + service, clock[0] - delivered_at, service))
+
+        if controller.due():
+            controller.adjust()
+
+        if clock[0] >= next_report:
+            mean = sum(latencies) / len(latencies) if latencies else 0
+            print '%5is %7i/s %8i %9i %8.1fms %8i' % (next_report, offered_rate(next_report - 1), controller.workers,
+                                                      controller.prefetch, mean * 1000, len(waiting))
+            latencies = []
+            next_report += REPORT_EVERY
+
+    print
+    print 'decisions: %s' % ', '.join('%s %i' % (name.split('.')[1], count)
+                                      for name, count in sorted(controller.stats.snapshot().items())
+                                      if name.split('.')[1] in ('increase', 'decrease', 'backoff'))
+#---
+
+if __name__ == '__main__':
+    target = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.05
+
+    print 'latency target %ims, service time %ims, contention past %i concurrent calls' % (
+        target * 1000, SERVICE_TIME * 1000, CORES)
+    simulate(target)
@@ -0,0 +1,85 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         bench_confirms.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Compares publishing throughput without publisher confirms, with pika's synchronous confirms (a round trip per
+#   message) and with the pipelined confirms of confirms.ConfirmTracker.  Needs a RabbitMQ server; the messages go to
+#   a temporary queue that is deleted afterwards.
+#
+#   Usage: python benchmarks/bench_confirms.py [messages] [host]
+#
+
+import sys
+import time
+
+import pika
+from rabbitrpc.rabbitmq import confirms
+
+
+BODY = 'x' * 512
+QUEUE = 'rabbitrpc.bench.confirms'
+
+
+def publish_unconfirmed(connection, channel, messages):
+    for _ in xrange(messages):
+        channel.basic_publish(exchange='', routing_key=QUEUE, body=BODY)
+#---
+
+def publish_sync(connection, channel, messages):
+    channel.confirm_delivery()
+
+    for _ in xrange(messages):
+        channel.basic_publish(exchange='', routing_key=QUEUE, body=BODY)
+#---
+
+def publish_async(connection, channel, messages):
+    tracker = confirms.ConfirmTracker(connection, channel)
+    tracker.start()
+
+    for _ in xrange(messages):
+        tracker.publish(exchange='', routing_key=QUEUE, body=BODY)
+
+    tracker.wait()
+#---
+
+def run(label, publish, host, messages):
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+    channel = connection.channel()
+    channel.queue_declare(queue=QUEUE)
+    channel.queue_purge(queue=QUEUE)
+
+    started = time.time()
+    publish(connection, channel, messages)
+    elapsed = time.time() - started
+
+    channel.queue_delete(queue=QUEUE)
+    connection.close()
+    print '%-12s %6.2fs   %8.0f msg/s' % (label, elapsed, messages / elapsed)
+#---
+
+if __name__ == '__main__':
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    host = sys.argv[2] if len(sys.argv) > 2 else 'localhost'
+
+    print '%i messages of %i bytes to %s' % (messages, len(BODY), host)
+    run('no confirms', publish_unconfirmed, host, messages)
+    run('sync', publish_sync, host, messages)
+    run('async', publish_async, host, messages)
@@ -0,0 +1,177 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         bench_deadlines.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Simulates a server taking interactive calls with tight deadlines alongside bursts of batch calls with loose ones,
+#   and compares the share of calls that miss their deadline when the server runs calls in arrival order with that
+#   under earliest deadline first scheduling (see `scheduling`), with and without dropping the calls that can't make
+#   theirs.  The simulation runs on its own clock, so no RabbitMQ server is needed.
+#
+#   Calls wait in the broker until they fit in the consumer's window (its prefetch), and the scheduler picks from
+#   the window.  At the first load the server has capacity to spare on average, and it is the bursts that queue the
+#   interactive calls.  At the second it falls behind during the bursts, and some calls miss their deadline whatever
+#   the order.
+#
+#   Usage: python benchmarks/bench_deadlines.py [window]
+#
+
+import collections
+import heapq
+import random
+import sys
+
+from rabbitrpc.rabbitmq import scheduling
+
+
+WORKERS = 8
+SERVICE_TIME = 0.01
+# Interactive calls per second, and seconds they may take
+INTERACTIVE_RATE = 300
+INTERACTIVE_DEADLINE = 0.2
+# Batch calls per burst, for a load the server keeps up with and one it can't, seconds between bursts, and seconds
+# they may take
+BURST_SIZES = (1200, 2000)
+BURST_EVERY = 3.0
+BATCH_DEADLINE = 3.0
+DURATION = 120
+
+
+class FifoScheduler(object):
+    """
+    Arrival order, as the server does without a scheduler.  Nothing is dropped.
+
+    """
+    def __init__(self):
+        self._items = collections.deque()
+
+    def push(self, name, item, deadline = None):
+        self._items.append((name, item))
+
+    def pop(self):
+        return self._items.popleft() if self._items else None
+
+    def expired(self):
+        return []
+#---
+
+class Clock(object):
+    """
+    The simulation's clock, for the schedulers.
+
+    """
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+#---
+
+def arrivals(rng, burst_size):
+    """
+    (time, kind) of every call, in time order.
+
+    """
+    calls = []
+
+    now = rng.expovariate(INTERACTIVE_RATE)
+    while now < DURATION:
+        calls.append((now, 'interactive'))
+        now += rng.expovariate(INTERACTIVE_RATE)
+
+    burst = BURST_EVERY / 2
+    while burst < DURATION:
+        calls.extend((burst + number * 1e-5, 'batch') for number in range(burst_size))
+        burst += BURST_EVERY
+
+    return sorted(calls)
+#---
+
+def simulate(scheduler, clock, window, calls, rng):
+    broker = collections.deque(calls)
+    deadlines = {'interactive': INTERACTIVE_DEADLINE, 'batch': BATCH_DEADLINE}
+    # (finish time, kind, deadline)
+    running = []
+    held = 0
+    outcomes = collections.defaultdict(collections.Counter)
+    clock.now = 0.0
+
+    while broker or held:
+        # Deliver what has arrived, up to the window
+        while broker and broker[0][0] <= clock.now and held < window:
+            arrived, kind = broker.popleft()
+            deadline = arrived + deadlines[kind]
+            scheduler.push(kind, (kind, deadline), deadline)
+            held += 1
+
+        for kind, _ in scheduler.expired():
+            outcomes[kind]['dropped'] += 1
+            held -= 1
+
+        while len(running) < WORKERS:
+            scheduled = scheduler.pop()
+            if scheduled is None:
+                break
+            kind, (_, deadline) = scheduled
+            heapq.heappush(running, (clock.now + rng.expovariate(1 / SERVICE_TIME), kind, deadline))
+
+        # With the window full, only a finished call lets the next one in
+        next_finish = running[0][0] if running else None
+        next_arrival = broker[0][0] if broker and held < window else None
+        clock.now = min(t for t in (next_arrival, next_finish) if t is not None)
+
+        if next_finish is not None and clock.now == next_finish:
+            finished, kind, deadline = heapq.heappop(running)
+            held -= 1
+            outcomes[kind]['met' if finished <= deadline else 'late'] += 1
+
+    return outcomes
+#---
+
+def report(label, outcomes):
+    missed = sum(counts['late'] + counts['dropped'] for counts in outcomes.values())
+    line = '  %-9s missed %5.1f%%' % (label, missed * 100.0 / sum(sum(counts.values()) for counts in outcomes.values()))
+
+    for kind in ('interactive', 'batch'):
+        counts = outcomes[kind]
+        total = float(sum(counts.values()))
+        line += '    %s %5.1f%% late, %5.1f%% dropped' % (kind, counts['late'] / total * 100,
+                                                         counts['dropped'] / total * 100)
+
+    print line
+#---
+
+if __name__ == '__main__':
+    window = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    clock = Clock()
+
+    print ('%i workers, %ims calls, window %i: %i/s interactive calls with %ims deadlines, bursts of batch calls with '
+           '%is deadlines every %is' % (WORKERS, SERVICE_TIME * 1000, window, INTERACTIVE_RATE,
+                                        INTERACTIVE_DEADLINE * 1000, BATCH_DEADLINE, BURST_EVERY))
+
+    for burst_size in BURST_SIZES:
+        calls = arrivals(random.Random(1), burst_size)
+
+        print 'bursts of %i:' % burst_size
+        report('fifo', simulate(FifoScheduler(), clock, window, calls, random.Random(2)))
+        # Never too late to start: only the order changes
+        report('edf', simulate(scheduling.EarliestDeadlineFirst(min_remaining=-float('inf'), clock=clock), clock,
+                               window, calls, random.Random(2)))
+        report('edf+drop', simulate(scheduling.EarliestDeadlineFirst(min_remaining=SERVICE_TIME, clock=clock), clock,
+                                    window, calls, random.Random(2)))
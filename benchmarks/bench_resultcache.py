@@ -0,0 +1,119 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         bench_resultcache.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Compares per-process result caches against one shared memory cache for a pool of worker processes serving the
+#   same skewed stream of requests.  No RabbitMQ server is needed.
+#
+#   Usage: python benchmarks/bench_resultcache.py [workers] [requests per worker]
+#
+
+import cPickle
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from rabbitrpc.server import resultcache
+from rabbitrpc.server import sharedcache
+
+
+KEY_SPACE = 20000
+# Budget per worker for the private caches, the shared cache gets the sum of them
+BUDGET_PER_WORKER = 4 * 1024 * 1024
+SLOT_SIZE = 16 * 1024
+
+
+def expensive_result(key):
+    """
+    Stands in for an endpoint: some CPU work and a ~10KB encoded reply.
+
+    """
+    rng = random.Random(key)
+    return cPickle.dumps({'key': key, 'rows': [rng.random() for _ in range(1000)]}, 2)
+#---
+
+def worker(cache_factory, requests, seed, results):
+    cache = cache_factory()
+    rng = random.Random(seed)
+    hits = 0
+
+    started = time.time()
+    for _ in xrange(requests):
+        # Pareto-ish popularity, a few keys are very hot and there is a long tail
+        key = 'report:%i' % min(int(rng.paretovariate(0.6)), KEY_SPACE)
+
+        if cache.get(key) is not None:
+            hits += 1
+        else:
+            cache.set(key, expensive_result(key))
+
+    results.put((hits, time.time() - started))
+#---
+
+def run(label, cache_factory, workers, requests):
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(cache_factory, requests, seed, results))
+                 for seed in range(workers)]
+
+    started = time.time()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    wall = time.time() - started
+
+    hits = sum(results.get()[0] for _ in processes)
+    total = workers * requests
+    print '%-14s hit rate %5.1f%%   wall %6.2fs   %8.0f req/s' % (label, 100.0 * hits / total, wall, total / wall)
+#---
+
+class PrivateCacheFactory(object):
+    def __call__(self):
+        return resultcache.ResultCache(BUDGET_PER_WORKER)
+#---
+
+class SharedCacheFactory(object):
+    def __init__(self, path, workers):
+        self.path = path
+        self.workers = workers
+
+    def __call__(self):
+        return sharedcache.SharedResultCache(self.path, BUDGET_PER_WORKER * self.workers, slot_size=SLOT_SIZE)
+#---
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    print '%i workers x %i requests, %iMB cache budget per worker' % (workers, requests,
+                                                                     BUDGET_PER_WORKER / 1024 / 1024)
+    run('per-process', PrivateCacheFactory(), workers, requests)
+
+    fd, path = tempfile.mkstemp(prefix='rabbitrpc-bench-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    os.close(fd)
+    os.unlink(path)
+    try:
+        run('shared', SharedCacheFactory(path, workers), workers, requests)
+    finally:
+        os.unlink(path)
@@ -0,0 +1,155 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         bench_tenants.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Simulates a server shared by a few quiet tenants and a noisy one that sends its calls in bursts, and compares the
+#   quiet tenants' latencies when the server runs calls in arrival order with those under fair queuing (see
+#   `scheduling`).  The simulation runs on its own clock, so no RabbitMQ server is needed.
+#
+#   Calls wait in the broker until they fit in the consumer's window (its prefetch), and the scheduler picks from
+#   the window.  On average the server has capacity to spare; it is the bursts that queue the quiet calls.
+#
+#   Each scheduler is run with a window larger than a burst, and with one smaller.  The small window shows why the
+#   prefetch must be larger than the bursts when tenants are capped: a capped tenant's calls wait in the window
+#   until they may run, so a burst fills it and the quiet tenants' calls can't get in until it drains.
+#
+#   Usage: python benchmarks/bench_tenants.py [window ...]
+#
+
+import collections
+import heapq
+import random
+import sys
+
+from rabbitrpc.rabbitmq import scheduling
+
+
+WORKERS = 8
+SERVICE_TIME = 0.01
+QUIET_TENANTS = 4
+QUIET_RATE = 50
+# Calls per burst, and seconds between bursts
+BURST_SIZE = 1500
+BURST_EVERY = 5.0
+DURATION = 120
+
+
+class FifoScheduler(object):
+    """
+    Arrival order, as the server does without a scheduler.
+
+    """
+    def __init__(self):
+        self._items = collections.deque()
+
+    def push(self, name, item):
+        self._items.append((name, item))
+
+    def pop(self):
+        return self._items.popleft() if self._items else None
+
+    def done(self, name):
+        pass
+#---
+
+def arrivals(rng):
+    """
+    (time, tenant) of every call, in time order.
+
+    """
+    calls = []
+
+    for tenant in range(QUIET_TENANTS):
+        now = rng.expovariate(QUIET_RATE)
+        while now < DURATION:
+            calls.append((now, 'quiet-%i' % tenant))
+            now += rng.expovariate(QUIET_RATE)
+
+    burst = BURST_EVERY / 2
+    while burst < DURATION:
+        calls.extend((burst + number * 1e-5, 'noisy') for number in range(BURST_SIZE))
+        burst += BURST_EVERY
+
+    return sorted(calls)
+#---
+
+def simulate(scheduler, window, calls, rng):
+    broker = collections.deque(calls)
+    delivered = collections.deque()
+    # (finish time, tenant, arrival time)
+    running = []
+    held = 0
+    latencies = collections.defaultdict(list)
+    now = 0.0
+
+    while broker or held:
+        # Deliver what has arrived, up to the window
+        while broker and broker[0][0] <= now and held < window:
+            arrived, tenant = broker.popleft()
+            scheduler.push(tenant, arrived)
+            held += 1
+
+        while len(running) < WORKERS:
+            scheduled = scheduler.pop()
+            if scheduled is None:
+                break
+            tenant, arrived = scheduled
+            heapq.heappush(running, (now + rng.expovariate(1 / SERVICE_TIME), tenant, arrived))
+
+        # With the window full, only a finished call lets the next one in
+        next_finish = running[0][0] if running else None
+        next_arrival = broker[0][0] if broker and held < window else None
+        now = min(t for t in (next_arrival, next_finish) if t is not None)
+
+        if next_finish is not None and now == next_finish:
+            finished, tenant, arrived = heapq.heappop(running)
+            scheduler.done(tenant)
+            held -= 1
+            latencies[tenant].append(finished - arrived)
+
+    return latencies
+#---
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+#---
+
+def report(label, latencies):
+    quiet = [latency for tenant, values in latencies.items() if tenant != 'noisy' for latency in values]
+    print '%-10s quiet p50 %7.1fms  p99 %7.1fms    noisy p50 %7.1fms  p99 %7.1fms' % (
+        label, percentile(quiet, 50) * 1000, percentile(quiet, 99) * 1000,
+        percentile(latencies['noisy'], 50) * 1000, percentile(latencies['noisy'], 99) * 1000)
+#---
+
+if __name__ == '__main__':
+    windows = [int(window) for window in sys.argv[1:]] or [2000, 200]
+    calls = arrivals(random.Random(1))
+
+    print '%i workers, %ims calls: %i quiet tenants at %i/s, bursts of %i noisy calls every %is' % (
+        WORKERS, SERVICE_TIME * 1000, QUIET_TENANTS, QUIET_RATE, BURST_SIZE, BURST_EVERY)
+
+    for window in windows:
+        print '\nwindow %i (%s than a burst)' % (window, 'larger' if window > BURST_SIZE else 'smaller')
+        report('fifo', simulate(FifoScheduler(), window, calls, random.Random(2)))
+        report('fair', simulate(scheduling.WeightedFairQueue(), window, calls, random.Random(2)))
+        report('fair+cap', simulate(scheduling.WeightedFairQueue(max_running={'noisy': WORKERS / 2}), window, calls,
+                                    random.Random(2)))
@@ -0,0 +1,142 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         admission.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Load shedding on queue wait.
+#
+#   The producer stamps every call with the time it was published (SENT_AT_HEADER, in milliseconds since the epoch).
+#   When a worker picks the call up, the consumer works out how long it has waited, in the broker and for a worker,
+#   and the server refuses calls that waited longer than their limit (the `max_queue_wait` endpoint option, then the
+#   lane's, then the RabbitMQ config's) with OverloadError.  Their callers get the error straight away instead of a
+#   late reply or a timeout, and the server spends its time on calls that can still be answered in time.
+#
+#   The producer also stamps calls it waits for with their deadline (DEADLINE_HEADER, same unit): the time its reply
+#   timeout runs out, or the deadline of the call the server is running on that thread, if that comes first, so a
+#   call made on behalf of another inherits what is left of its deadline.  The consumer can run calls earliest
+#   deadline first and drop those that can't make theirs (see `scheduling`).
+#
+#   The wait is measured across hosts, so their clocks need to be in sync (e.g. by NTP) to well within the limits.
+#
+
+import contextlib
+import threading
+import time
+
+
+class AdmissionError(Exception): pass
+class OverloadError(AdmissionError): pass
+
+
+# Header with the time a call was published
+SENT_AT_HEADER = 'x-sent-at'
+# Header with the time by which the caller needs the reply
+DEADLINE_HEADER = 'x-deadline'
+
+
+_local = threading.local()
+
+
+def waited(headers):
+    """
+    Works out how long a call has waited since it was published.
+
+    :param headers: The call's message headers
+    :type headers: dict
+
+    :return: Seconds, or ``None`` for calls that were not stamped
+    :rtype: float
+    """
+    if not isinstance(headers, dict) or headers.get(SENT_AT_HEADER) is None:
+        return None
+
+    return max(0.0, time.time() - headers[SENT_AT_HEADER] / 1000.0)
+#---
+
+def deadline(headers):
+    """
+    Provides a call's deadline.
+
+    :param headers: The call's message headers
+    :type headers: dict
+
+    :return: Seconds since the epoch, or ``None`` for calls without one
+    :rtype: float
+    """
+    if not isinstance(headers, dict) or headers.get(DEADLINE_HEADER) is None:
+        return None
+
+    return headers[DEADLINE_HEADER] / 1000.0
+#---
+
+def queue_wait():
+    """
+    Provides how long the call running on this thread waited before it started.
+
+    :return: Seconds, or ``None`` if unknown
+    :rtype: float
+    """
+    return getattr(_local, 'queue_wait', None)
+#---
+
+def current_deadline():
+    """
+    Provides the deadline of the call running on this thread.
+
+    :return: Seconds since the epoch, or ``None`` if it has none
+    :rtype: float
+    """
+    return getattr(_local, 'deadline', None)
+#---
+
+@contextlib.contextmanager
+def running(wait, deadline = None):
+    """
+    Makes a call's queue wait and deadline the current ones for the block.
+
+    :param wait: Seconds the call waited, ``None`` if unknown
+    :type wait: float
+    :param deadline: The call's deadline in seconds since the epoch, ``None`` if it has none
+    :type deadline: float
+
+    """
+    previous = queue_wait(), current_deadline()
+    _local.queue_wait, _local.deadline = wait, deadline
+
+    try:
+        yield
+    finally:
+        _local.queue_wait, _local.deadline = previous
+#---
+
+def admit(wait, max_wait):
+    """
+    Refuses a call that waited longer than it may.
+
+    :param wait: Seconds the call waited, ``None`` if unknown
+    :type wait: float
+    :param max_wait: Seconds the call may wait, ``None`` for no limit
+    :type max_wait: float
+
+    :raises: OverloadError
+    """
+    if wait is not None and max_wait is not None and wait > max_wait:
+        raise OverloadError('Call waited %.3fs in the queue, over the limit of %.3fs' % (wait, max_wait))
+#---
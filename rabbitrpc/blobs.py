@@ -0,0 +1,111 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         blobs.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Content-addressed arguments.  Large arguments to endpoints registered with `blob_args` are sent as a BlobRef
+#   holding the digest of their pickled form.  The pickled argument itself (the blob) travels in the call's 'blobs'
+#   dict only until the server has confirmed it has it cached.  The server resolves references from the blobs sent
+#   with the call first, and from its cache only for the others, so a blob too large to cache still serves its call.
+#
+
+import hashlib
+
+
+class BlobError(Exception): pass
+
+
+class BlobMissingError(BlobError):
+    """
+    Raised by the server when a call references blobs it does not hold (any more).  The client re-sends the call with
+    the blobs included.
+
+    """
+
+    def __init__(self, digests):
+        BlobError.__init__(self, digests)
+        self.digests = digests
+    #---
+
+    def __str__(self):
+        return 'Blob(s) not cached on the server: %s' % ', '.join(self.digests)
+    #---
+#---
+
+
+class BlobUnavailableError(BlobError):
+    """
+    Raised by the server when a call sent with all of its blobs still references blobs it doesn't have.  Sending the
+    call again won't help.
+
+    """
+
+    def __init__(self, digests):
+        BlobError.__init__(self, digests)
+        self.digests = digests
+    #---
+
+    def __str__(self):
+        return 'Blob(s) neither sent with the call nor cached on the server: %s' % ', '.join(self.digests)
+    #---
+#---
+
+
+class BlobRef(object):
+    """
+    Stands in for an argument whose pickled form has the given digest.
+
+    """
+    digest = None
+
+    def __init__(self, digest):
+        self.digest = digest
+    #---
+
+    def __eq__(self, other):
+        return isinstance(other, BlobRef) and other.digest == self.digest
+    #---
+
+    def __ne__(self, other):
+        return not self == other
+    #---
+
+    def __hash__(self):
+        return hash(self.digest)
+    #---
+
+    def __repr__(self):
+        return 'BlobRef(%r)' % self.digest
+    #---
+#---
+
+
+def content_digest(data):
+    """
+    Provides the digest a blob is addressed by.
+
+    :param data: The blob
+    :type data: str
+
+    :rtype: str
+
+    """
+    return hashlib.sha1(data).hexdigest()
+#---
@@ -0,0 +1,166 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         cancellation.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Cancellation of calls whose caller has given up on them.
+#
+#   With the 'cancellation' setting on in the RabbitMQ config, a client that times out waiting for a reply (or gets
+#   the other reply of a hedged call first) publishes the call's correlation id to the fanout exchange
+#   '<queue_name>.cancel' (see `routing`).  Every server consumer is bound to it and remembers the latest cancelled ids.
+#   It drops cancelled calls that have not started yet, and calls that are running can check their token, see
+#   rpcserver.cancellation_token.
+#
+
+import collections
+import contextlib
+import threading
+
+
+class CancellationError(Exception): pass
+class CallCancelledError(CancellationError): pass
+
+
+# How many cancelled call ids a server remembers
+DEFAULT_REMEMBERED = 10000
+
+
+class CancelledCalls(object):
+    """
+    The ids of the latest cancelled calls.  Thread-safe.
+
+    """
+
+    def __init__(self, size = DEFAULT_REMEMBERED):
+        """
+        Constructor
+
+        :param size: How many ids to remember.  The oldest are forgotten first.
+        :type size: int
+
+        """
+        self.size = size
+        self._ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+    #---
+
+    def __contains__(self, call_id):
+        with self._lock:
+            return call_id in self._ids
+    #---
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ids)
+    #---
+
+    def add(self, call_id):
+        """
+        Records a cancelled call.
+
+        :param call_id: The call's correlation id
+        :type call_id: str
+
+        """
+        with self._lock:
+            self._ids[call_id] = True
+
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+    #---
+#---
+
+
+class CancellationToken(object):
+    """
+    Tells a running call whether its caller has cancelled it.
+
+    """
+    call_id = None
+
+    def __init__(self, call_id = None, cancelled_calls = None):
+        """
+        Constructor
+
+        :param call_id: The call's correlation id.  Calls without one can't be cancelled.
+        :type call_id: str
+        :param cancelled_calls: The server's cancelled calls
+        :type cancelled_calls: CancelledCalls
+
+        """
+        self.call_id = call_id
+        self._cancelled_calls = cancelled_calls
+    #---
+
+    @property
+    def cancelled(self):
+        """
+        Whether the call has been cancelled.
+
+        :rtype: bool
+
+        """
+        return self.call_id is not None and self._cancelled_calls is not None and self.call_id in self._cancelled_calls
+    #---
+
+    def raise_if_cancelled(self):
+        """
+        Ends the call if it has been cancelled.
+
+        :raises: CallCancelledError
+        """
+        if self.cancelled:
+            raise CallCancelledError('Call %s was cancelled by its caller' % self.call_id)
+    #---
+#---
+
+
+_local = threading.local()
+_NEVER_CANCELLED = CancellationToken()
+
+
+def current_token():
+    """
+    Provides the cancellation token of the call running on this thread.  Outside of a call the token is never
+    cancelled.
+
+    :rtype: CancellationToken
+
+    """
+    return getattr(_local, 'token', None) or _NEVER_CANCELLED
+#---
+
+@contextlib.contextmanager
+def running(token):
+    """
+    Makes a token the current one for the calls made in the block.
+
+    :param token: The running call's token
+    :type token: CancellationToken
+
+    """
+    previous = getattr(_local, 'token', None)
+    _local.token = token
+
+    try:
+        yield
+    finally:
+        _local.token = previous
+#---
@@ -23,11 +23,23 @@
 #   RabbitMQ-based RPC client
 #
 
+import collections
+import contextlib
+import copy
 import cPickle
 import imp
 import logging
+from rabbitrpc import blobs
+from rabbitrpc import delta
+from rabbitrpc import limiter
+from rabbitrpc import routing
+from rabbitrpc import singleflight
+from rabbitrpc import stats
 from rabbitrpc.rabbitmq import producer
+from rabbitrpc.rabbitmq import scheduling
 import sys
+import threading
+import time
 
 
 _PROXY_FUNCTION="""def %(call_name)s(%(args)s):
@@ -36,6 +48,50 @@ _PROXY_FUNCTION="""def %(call_name)s(%(args)s):
     \"\"\"
     return proxy_class._proxy_handler('%(call_name)s','%(module_name)s'%(proxy_args)s)"""
 
+_PROXY_CLASS="""class %(call_name)s(object):
+    \"\"\"
+    %(doc)s
+    \"\"\"
+    def __init__(self%(args)s):
+        self._rpc_handle = proxy_class._proxy_handler('%(call_name)s','%(module_name)s'%(proxy_args)s)
+
+    def release(self):
+        \"\"\"
+        Drops the remote object.  The proxy can't be used afterwards.
+        \"\"\"
+        proxy_class._release_object(self._rpc_handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()"""
+
+_PROXY_METHOD="""def %(call_name)s(self%(args)s):
+    \"\"\"
+    %(doc)s
+    \"\"\"
+    return proxy_class._object_handler(self._rpc_handle, '%(call_name)s'%(proxy_args)s)"""
+
+
+# Options that may be set for the calls made within an RPCClient.call_options block
+CALL_OPTIONS = ('priority', 'durability')
+
+# How many results of delta endpoints (one per distinct call) the client keeps to rebuild replies from
+_DELTA_RESULTS_KEPT = 256
+
+# What the client keeps a concurrency limit for (see the `concurrency_limit` argument)
+LIMIT_PER_ENDPOINT = 'endpoint'
+LIMIT_PER_QUEUE = 'queue'
+
+# Hedging settings (see the `hedging` argument): calls to idempotent endpoints are hedged once they go without a reply
+# for this percentile of the endpoint's recent latencies ('window' calls), as soon as there are 'min_samples' of them.
+HEDGING_DEFAULTS = {
+    'percentile': 95,
+    'window': 100,
+    'min_samples': 20,
+}
+
 
 class RPCClientError(Exception): pass
 
@@ -51,25 +107,76 @@ class RPCClient(object):
     last_traceback = None
     print_tracebacks = False
     log_tracebacks = True
-
-    def __init__(self, rabbit_config, print_tracebacks = False, log_tracebacks = True):
+    blob_threshold = None
+    routing = None
+    modules = None
+    stats = None
+    concurrency_limit = None
+    hedging = None
+    tenant = None
+    _flights = None
+    _server_blobs = None
+    _delta_results = None
+    _limiters = None
+    _latencies = None
+
+    def __init__(self, rabbit_config, print_tracebacks = False, log_tracebacks = True, blob_threshold = 64 * 1024,
+                 concurrency_limit = None, hedging = None, tenant = None):
         """
         Constructor
 
         :param rabbit_config: The configuration for the RabbitMQ server.  For details see this example:
             https://github.com/nwhalen/rabbitrpc/wiki/Data-Structure-Defintions#rabbitmq-configuration
+            With 'routing' set to 'module' (see `routing`), 'modules' lists the modules to fetch definitions for.
         :type rabbit_config: dict
         :param print_tracebacks: Controls printing of rpc call tracebacks to stdout.  Defaults to ``False``.
         :type print_tracebacks: bool
         :param log_tracebacks: Controls printing of rpc call tracebacks to the error log.  Defaults to ``True``.
         :type log_tracebacks: bool
+        :param blob_threshold: Arguments to endpoints registered with `blob_args` that pickle to at least this many
+            bytes are sent by content digest once the server has them cached.
+        :type blob_threshold: int
+        :param concurrency_limit: Turns on adaptive limits for the calls in flight (see `limiter`).  Calls over a
+            limit raise limiter.ConcurrencyLimitError.  The dict holds limiter.AdaptiveLimiter keyword arguments, and
+            'per': either ``LIMIT_PER_ENDPOINT`` (the default, one limit per endpoint) or ``LIMIT_PER_QUEUE`` (one
+            per destination queue).  ``None`` (the default) leaves calls unlimited.
+        :type concurrency_limit: dict
+        :param hedging: Turns on hedging for endpoints registered as `idempotent`: a call still without a reply after a
+            percentile of the endpoint's recent latencies is sent again, and the first reply is taken.  The dict
+            overrides ``HEDGING_DEFAULTS``.  The stats count 'idempotent_calls', 'hedged_calls' and 'hedge_wins' (the
+            hedge replied first).  ``None`` (the default) never hedges.
+        :type hedging: dict
+        :param tenant: Who the calls are made for, e.g. the name of the application.  Servers with 'tenant_fairness'
+            on share their workers fairly between tenants (see `scheduling`).
+        :type tenant: str
         """
+        if concurrency_limit and concurrency_limit.get('per', LIMIT_PER_ENDPOINT) not in (LIMIT_PER_ENDPOINT,
+                                                                                          LIMIT_PER_QUEUE):
+            raise RPCClientError('Unknown concurrency limit scope %r' % concurrency_limit['per'])
+
         self.print_tracebacks = print_tracebacks
         self.log_tracebacks = log_tracebacks
+        self.blob_threshold = blob_threshold
+        self.routing = routing.routing_mode(rabbit_config)
+        self.modules = rabbit_config.get('modules')
+        self._queue_name = routing.queue_name(rabbit_config)
+        self._server_blobs = set()
+        self._delta_results = collections.OrderedDict()
+        self._delta_lock = threading.Lock()
+        self.concurrency_limit = concurrency_limit
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+        self.hedging = dict(HEDGING_DEFAULTS, **hedging) if hedging is not None else None
+        self.tenant = tenant
+        self._latencies = {}
+        self._latencies_lock = threading.Lock()
 
         self.log = logging.getLogger (__name__)
+        self.stats = stats.Counters()
+        self._flights = singleflight.SingleFlight()
+        self._local = threading.local()
 
-        self.rabbit_producer = producer.Producer(rabbit_config)
+        self.rabbit_producer = producer.Producer(rabbit_config, counters=self.stats)
     #---
 
     def __del__(self):
@@ -111,6 +218,31 @@ class RPCClient(object):
         self._build_rpc_modules()
     #---
 
+    @contextlib.contextmanager
+    def call_options(self, **options):
+        """
+        Sets options for the calls the current thread makes within the block, overriding the endpoints' defaults.
+        Blocks may be nested.  See ``CALL_OPTIONS`` for the available options.  For example::
+
+            with client.call_options(priority=9):
+                rpcendpoints.lookup(user)
+
+        :param options: Call options
+
+        """
+        unknown_options = set(options) - set(CALL_OPTIONS)
+        if unknown_options:
+            raise RPCClientError('Unknown call option(s): %s' % ', '.join(sorted(unknown_options)))
+
+        previous = getattr(self._local, 'options', {})
+        self._local.options = dict(previous, **options)
+
+        try:
+            yield
+        finally:
+            self._local.options = previous
+    #---
+
     def _proxy_handler(self, method_name, module, *varargs, **kwargs):
         """
         This handles calls to the proxy functions and does the work to send those calls on to the RPC server.
@@ -126,14 +258,13 @@ class RPCClient(object):
 
         :return: Call results
         """
-        # Set up the arguments in the proper format
-        if varargs or kwargs:
-            args = {
-                'varargs': varargs if varargs else None,
-                'kwargs': kwargs if kwargs else None,
-            }
-        else:
-            args = None
+        args = self._call_args(varargs, kwargs)
+        options = self._endpoint_options(module, method_name)
+        destination = self._destination(module, method_name, options, varargs, kwargs)
+        blob_data = {}
+
+        if args and options.get('blob_args'):
+            blob_data = self._replace_blob_args(args)
 
         call = {
             'call_name': method_name,
@@ -142,13 +273,413 @@ class RPCClient(object):
             'module': module,
         }
 
-        encoded_data = self.rabbit_producer.send(cPickle.dumps(call))
-        decoded_results = cPickle.loads(encoded_data)
+        delta_key = None
+        if options.get('delta'):
+            delta_key = cPickle.dumps((module, method_name, args), 2)
+            with self._delta_lock:
+                call['delta_base'] = self._delta_results.get(delta_key, (None, None))[0]
+
+        self.stats.increment('calls')
+
+        with self._limited(module, method_name, destination):
+            decoded_results = self._send_call(call, options, blob_data, destination)
+
+        if delta_key is not None and isinstance(decoded_results['result'], delta.DeltaReply):
+            try:
+                decoded_results['result'] = self._apply_delta(delta_key, call['delta_base'],
+                                                              decoded_results['result'])
+            except delta.DeltaBaseError:
+                # Another call replaced (or the client dropped) the result the reply builds on: ask for it in full
+                self.stats.increment('delta_resends')
+                call['delta_base'] = None
+
+                with self._limited(module, method_name, destination):
+                    decoded_results = self._send_call(call, options, blob_data, destination)
+
+                if isinstance(decoded_results['result'], delta.DeltaReply):
+                    decoded_results['result'] = self._apply_delta(delta_key, None, decoded_results['result'])
 
         results = self._result_handler(decoded_results)
         return results
     #---
 
+    def _object_handler(self, handle, method_name, *varargs, **kwargs):
+        """
+        Handles calls to the methods of remote object proxies.  They are sent to the server process holding the object.
+
+        :param handle: The remote object's handle
+        :type handle: objects.ObjectHandle
+        :param method_name: The calling method's name
+        :type method_name: str
+        :param varargs: varargs from the calling method
+        :type varargs: tuple
+        :param kwargs: kwargs from the calling method
+        :type kwargs: dict
+
+        :return: Call results
+        """
+        call = {
+            'call_name': method_name,
+            'args': self._call_args(varargs, kwargs),
+            'internal': False,
+            'module': handle.module,
+            'object_id': handle.id,
+        }
+
+        self.stats.increment('calls')
+        return self._result_handler(self._transmit(call, {}, {'routing_key': handle.route}))
+    #---
+
+    def _release_object(self, handle):
+        """
+        Has the server holding a remote object drop it.
+
+        :param handle: The remote object's handle
+        :type handle: objects.ObjectHandle
+
+        :return: Whether the server still held the object
+        :rtype: bool
+        """
+        call = {
+            'call_name': 'release_object',
+            'args': self._call_args((handle.id,), None),
+            'internal': True,
+            'module': None,
+        }
+
+        return self._result_handler(self._transmit(call, {}, {'routing_key': handle.route}))
+    #---
+
+    @contextlib.contextmanager
+    def _limited(self, module, method_name, destination):
+        """
+        Holds a concurrency limit slot for a call while it is in flight, and reports its round trip time.
+
+        :param module: The endpoint's module (short) name
+        :type module: str
+        :param method_name: The endpoint's name
+        :type method_name: str
+        :param destination: Where the call is published, see `_destination`
+        :type destination: dict
+
+        :raises: limiter.ConcurrencyLimitError if the call is over the limit
+        """
+        if not self.concurrency_limit:
+            yield
+            return
+
+        if self.concurrency_limit.get('per', LIMIT_PER_ENDPOINT) == LIMIT_PER_QUEUE:
+            key = destination.get('exchange') or destination.get('routing_key') or self._queue_name
+        else:
+            key = '%s.%s' % (module, method_name)
+
+        call_limiter = self._limiter(key)
+
+        try:
+            call_limiter.acquire()
+        except limiter.ConcurrencyLimitError:
+            self.stats.increment('limited_calls')
+            raise
+
+        started = time.time()
+        try:
+            yield
+        except producer.ReplyTimeoutError:
+            call_limiter.release(dropped=True)
+            raise
+        except Exception:
+            call_limiter.release()
+            raise
+        else:
+            call_limiter.release(time.time() - started)
+        finally:
+            self.stats.set('limit.%s' % key, int(call_limiter.limit))
+    #---
+
+    def _limiter(self, key):
+        """
+        Provides the concurrency limiter for a key, creating it on first use.
+
+        :rtype: limiter.AdaptiveLimiter
+        """
+        with self._limiters_lock:
+            if key not in self._limiters:
+                settings = dict((name, value) for name, value in self.concurrency_limit.items() if name != 'per')
+                self._limiters[key] = limiter.AdaptiveLimiter(**settings)
+
+            return self._limiters[key]
+    #---
+
+    def _latency_window(self, module, method_name):
+        """
+        Provides the window of an endpoint's recent latencies, creating it on first use.
+
+        :rtype: stats.LatencyWindow
+        """
+        key = (module, method_name)
+
+        with self._latencies_lock:
+            if key not in self._latencies:
+                self._latencies[key] = stats.LatencyWindow(self.hedging['window'])
+
+            return self._latencies[key]
+    #---
+
+    def _call_args(self, varargs, kwargs):
+        """
+        Sets up a call's arguments in the format the server expects.
+
+        :param varargs: Positional arguments
+        :type varargs: tuple
+        :param kwargs: Keyword arguments
+        :type kwargs: dict
+
+        :rtype: dict
+        """
+        if not (varargs or kwargs):
+            return None
+
+        return {
+            'varargs': varargs if varargs else None,
+            'kwargs': kwargs if kwargs else None,
+        }
+    #---
+
+    def _destination(self, module, method_name, options, varargs = (), kwargs = None):
+        """
+        Decides where a call to an endpoint is published (see `routing`).
+
+        :param module: The endpoint's module (short) name
+        :type module: str
+        :param method_name: The endpoint's name
+        :type method_name: str
+        :param options: The endpoint's options
+        :type options: dict
+        :param varargs: The call's positional arguments
+        :type varargs: tuple
+        :param kwargs: The call's keyword arguments
+        :type kwargs: dict
+
+        :return: The exchange, routing key and headers to publish with, as `Producer.send` keyword arguments.  Empty
+            for the main queue.
+        :rtype: dict
+        """
+        destination = {}
+
+        if options.get('order_by'):
+            key = self._argument(module, method_name, varargs, kwargs, options['order_by'])
+            destination['headers'] = {routing.ORDER_KEY_HEADER: routing.hash_routing_key(key)}
+
+        if options.get('route_by'):
+            key = self._argument(module, method_name, varargs, kwargs, options['route_by'])
+            destination.update(exchange=routing.hash_exchange(self._queue_name),
+                               routing_key=routing.hash_routing_key(key))
+        elif options.get('lane'):
+            destination['routing_key'] = routing.lane_queue(self._queue_name, options['lane'])
+        elif self.routing == routing.MODULE:
+            destination['routing_key'] = routing.module_queue(self._queue_name, module)
+
+        return destination
+    #---
+
+    def _argument(self, module, method_name, varargs, kwargs, name):
+        """
+        Finds the value a call passes for one of its endpoint's arguments.
+
+        :rtype: object
+        """
+        return routing.call_argument(self.definitions[module][method_name]['args'], varargs, kwargs, name)
+    #---
+
+    def _send_call(self, call, options, blob_data, destination = None):
+        """
+        Sends a call and decodes its results, attaching the blobs the server doesn't have yet.  If the server has
+        dropped a blob the call is sent again with all of its blobs, marked as complete so that the server doesn't
+        ask again.
+
+        :param call: The call request data
+        :type call: dict
+        :param options: The endpoint's options
+        :type options: dict
+        :param blob_data: digest -> pickled argument, for every argument of the call that was replaced by a reference
+        :type blob_data: dict
+        :param destination: Where to publish the call, see `_destination`
+        :type destination: dict
+
+        :return: The decoded call results
+        :rtype: dict
+
+        """
+        if blob_data:
+            call['blobs'] = dict((digest, data) for digest, data in blob_data.items()
+                                 if digest not in self._server_blobs)
+
+        decoded_results = self._transmit(call, options, destination)
+
+        if blob_data:
+            if decoded_results['error'] and isinstance(decoded_results['result'], blobs.BlobMissingError):
+                self.stats.increment('blob_misses')
+                self._server_blobs.difference_update(decoded_results['result'].digests)
+
+                call['blobs'] = blob_data
+                call['blobs_complete'] = True
+                decoded_results = self._transmit(call, options, destination)
+
+            # The server stores the blobs before running the call, so only a miss means it doesn't hold them
+            if not (decoded_results['error'] and isinstance(decoded_results['result'], blobs.BlobMissingError)):
+                self._server_blobs.update(blob_data)
+
+        return decoded_results
+    #---
+
+    def _transmit(self, call, options, destination = None):
+        """
+        Encodes a call, sends it and decodes the reply.
+
+        :param call: The call request data
+        :type call: dict
+        :param options: The endpoint's options
+        :type options: dict
+        :param destination: Where to publish the call, as `Producer.send` keyword arguments (e.g. the routing key of a
+            remote object's server).  Defaults to the main queue.
+        :type destination: dict
+
+        :return: The decoded call results
+        :rtype: dict
+
+        """
+        encoded_call = cPickle.dumps(call)
+        send_params = dict(destination or {})
+
+        priority = getattr(self._local, 'options', {}).get('priority', options.get('priority'))
+        if priority is not None:
+            send_params['priority'] = priority
+
+        durability = getattr(self._local, 'options', {}).get('durability', options.get('durability'))
+        if durability is not None:
+            send_params['durability'] = durability
+
+        if self.tenant is not None:
+            send_params['headers'] = dict(send_params.get('headers') or {}, **{scheduling.TENANT_HEADER: self.tenant})
+
+        latencies = None
+        if self.hedging and options.get('idempotent'):
+            self.stats.increment('idempotent_calls')
+            latencies = self._latency_window(call['module'], call['call_name'])
+
+            if len(latencies) >= self.hedging['min_samples']:
+                send_params['hedge_after'] = latencies.percentile(self.hedging['percentile'])
+
+        started = time.time()
+
+        # Identical concurrent calls to coalescible endpoints share one request.  Only the encoded reply is shared, each
+        # caller decodes its own copy of the result.
+        if options.get('coalesce'):
+            encoded_data, shared = self._flights.do(encoded_call, self.rabbit_producer.send, encoded_call,
+                                                    **send_params)
+            if shared:
+                self.stats.increment('coalesced_calls')
+        else:
+            encoded_data = self.rabbit_producer.send(encoded_call, **send_params)
+
+        if latencies is not None:
+            latencies.add(time.time() - started)
+
+        return cPickle.loads(encoded_data)
+    #---
+
+    def _apply_delta(self, delta_key, sent_base, delta_reply):
+        """
+        Rebuilds a delta endpoint's result from the reply and the result held for the call, and holds on to the new
+        result for the next call.
+
+        :param delta_key: Identifies the call (module, name and arguments)
+        :type delta_key: str
+        :param sent_base: The 'delta_base' version the call was sent with
+        :type sent_base: str
+        :param delta_reply: The reply's result
+        :type delta_reply: delta.DeltaReply
+
+        :return: A copy of the full result, which the caller is free to modify
+        :raises: delta.DeltaBaseError if the reply builds on a result the client no longer holds, e.g. because a
+            concurrent call for the same key replaced it
+        """
+        with self._delta_lock:
+            base_version, base_result = self._delta_results.pop(delta_key, (None, None))
+
+            if delta_reply.kind != delta.DeltaReply.FULL and (sent_base is None or base_version != sent_base):
+                if base_version is not None:
+                    self._delta_results[delta_key] = (base_version, base_result)
+                raise delta.DeltaBaseError('The result of version %s is no longer held' % sent_base)
+
+            result = delta_reply.apply(base_result)
+
+            self.stats.increment('delta_%s' % delta_reply.kind)
+            self._delta_results[delta_key] = (delta_reply.version, result)
+            while len(self._delta_results) > _DELTA_RESULTS_KEPT:
+                self._delta_results.popitem(last=False)
+
+        # Patches never modify the result they are applied to, so the held one can be copied outside the lock
+        return copy.deepcopy(result)
+    #---
+
+    def _replace_blob_args(self, args):
+        """
+        Replaces the arguments that pickle to at least `blob_threshold` bytes with references to their content, in
+        place.
+
+        :param args: The call's arguments
+        :type args: dict
+
+        :return: digest -> pickled argument for each replaced argument
+        :rtype: dict
+
+        """
+        blob_data = {}
+
+        def replace(value):
+            if isinstance(value, blobs.BlobRef):
+                return value
+
+            encoded_value = cPickle.dumps(value, 2)
+            if len(encoded_value) < self.blob_threshold:
+                return value
+
+            digest = blobs.content_digest(encoded_value)
+            blob_data[digest] = encoded_value
+            self.stats.increment('blob_args')
+            if digest in self._server_blobs:
+                self.stats.increment('blob_bytes_saved', len(encoded_value))
+
+            return blobs.BlobRef(digest)
+        #---
+
+        if args['varargs']:
+            args['varargs'] = tuple(replace(value) for value in args['varargs'])
+        if args['kwargs']:
+            args['kwargs'] = dict((key, replace(value)) for key, value in args['kwargs'].items())
+
+        return blob_data
+    #---
+
+    def _endpoint_options(self, module, method_name):
+        """
+        Provides the endpoint options the server published for a call.
+
+        :param module: The call's module name
+        :type module: str
+        :param method_name: The call's name
+        :type method_name: str
+
+        :rtype: dict
+
+        """
+        if not self.definitions:
+            return {}
+
+        return self.definitions.get(module, {}).get(method_name, {}).get('options') or {}
+    #---
+
     def _result_handler(self, decoded_result):
         """
         Handles the results from a call.  Raises exceptions if it needs to.
@@ -182,7 +713,8 @@ class RPCClient(object):
 
     def _fetch_definitions(self):
         """
-        Fetches the call definitions from the server.
+        Fetches the call definitions from the server.  With module routing and a list of modules, each module's
+        definitions are fetched from the servers consuming its queue.
 
         """
         call = {
@@ -192,6 +724,21 @@ class RPCClient(object):
             'module': None,
         }
 
+        if self.routing == routing.MODULE and self.modules:
+            definitions = {}
+
+            for module in self.modules:
+                encoded_data = self.rabbit_producer.send(cPickle.dumps(call),
+                                                         routing_key=routing.module_queue(self._queue_name, module))
+                module_definitions = cPickle.loads(encoded_data)['result']['definitions']
+
+                if module in module_definitions:
+                    definitions[module] = module_definitions[module]
+
+            self.definitions = definitions
+            self.definitions_hash = hash(cPickle.dumps(definitions))
+            return
+
         encoded_data = self.rabbit_producer.send(cPickle.dumps(call))
         def_data = cPickle.loads(encoded_data)
 
@@ -217,7 +764,7 @@ class RPCClient(object):
 
     def _build_module_functions(self, definitions, module):
         """
-        Builds a modules methods and attaches them to it
+        Builds a modules methods (and remote object classes) and attaches them to it
 
         :param definitions: Function definitions for the given module
         :type definitions: dict
@@ -240,8 +787,47 @@ class RPCClient(object):
                 'module_name': module.__name__,
             }
 
-            new_function = _PROXY_FUNCTION % function_vars
-            exec new_function in module.__dict__
+            if 'methods' in definition:
+                self._build_proxy_class(function_vars, definition['methods'], module)
+            else:
+                new_function = _PROXY_FUNCTION % function_vars
+                exec new_function in module.__dict__
+    #---
+
+    def _build_proxy_class(self, class_vars, methods, module):
+        """
+        Builds the proxy class for a remote object class and attaches it to the module.
+
+        :param class_vars: The class' template variables, as for a function
+        :type class_vars: dict
+        :param methods: The class' method definitions
+        :type methods: dict
+        :param module: The module object to operate on
+        :type module: module
+
+        """
+        class_vars = dict(class_vars, args=', %s' % class_vars['args'] if class_vars['args'] else '')
+        exec _PROXY_CLASS % class_vars in module.__dict__
+        proxy = module.__dict__[class_vars['call_name']]
+
+        for method_name, definition in methods.items():
+            args = ''
+            proxy_args = ''
+
+            if definition['args'] is not None:
+                args, proxy_args = self._convert_args_to_strings(definition['args']['defined'])
+
+            method_vars = {
+                'call_name': method_name,
+                'doc': definition['doc'],
+                'args': ', %s' % args if args else '',
+                'proxy_args': proxy_args,
+            }
+
+            # The module is the methods' globals, so they find `proxy_class` like the module functions do
+            namespace = {}
+            exec _PROXY_METHOD % method_vars in module.__dict__, namespace
+            setattr(proxy, method_name, namespace[method_name])
     #---
 
     def _convert_args_to_strings(self, func_args):
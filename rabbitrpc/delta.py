@@ -0,0 +1,190 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         delta.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Delta-encoded results for endpoints registered with `delta`.  The client sends the version of the last result it
+#   holds as the call's 'delta_base', and the server replies with a DeltaReply: unchanged, a structural patch against
+#   that version, or the full result when it no longer has the base.
+#
+#   Patches descend into dicts, and into lists whose length did not change (plain dict and list only, not subclasses).
+#   Anything else that changed is replaced whole.
+#
+
+import hashlib
+
+
+class DeltaError(Exception): pass
+class DeltaBaseError(DeltaError): pass
+
+
+# Patch forms
+_REPLACE = 'replace'
+_DICT = 'dict'
+_LIST = 'list'
+
+
+class DeltaReply(object):
+    """
+    The result of a delta-encoded call, as it travels back to the client.
+
+    """
+    UNCHANGED = 'unchanged'
+    PATCH = 'patch'
+    FULL = 'full'
+
+    version = None
+    kind = None
+    payload = None
+
+    def __init__(self, version, kind, payload = None):
+        """
+        Constructor
+
+        :param version: Version of the new result
+        :type version: str
+        :param kind: One of UNCHANGED, PATCH or FULL
+        :type kind: str
+        :param payload: The patch for PATCH, the result for FULL
+        """
+        self.version = version
+        self.kind = kind
+        self.payload = payload
+    #---
+
+    def apply(self, base):
+        """
+        Rebuilds the full result from the base the client holds.
+
+        :param base: The result the call's 'delta_base' version refers to
+
+        :return: The new result
+        """
+        if self.kind == self.UNCHANGED:
+            return base
+        elif self.kind == self.PATCH:
+            return apply_patch(base, self.payload)
+        elif self.kind == self.FULL:
+            return self.payload
+
+        raise DeltaError('Unknown delta reply kind %r' % self.kind)
+    #---
+#---
+
+
+def version_of(encoded_value):
+    """
+    Provides the version identifier for a pickled result.
+
+    :param encoded_value: The pickled result
+    :type encoded_value: str
+
+    :rtype: str
+
+    """
+    return hashlib.sha1(encoded_value).hexdigest()
+#---
+
+def make_patch(old, new):
+    """
+    Builds a structural patch that turns `old` into `new`.
+
+    :param old: The previous value
+    :param new: The current value
+
+    :return: The patch, or ``None`` if the values are equal
+    """
+    if type(old) is not type(new):
+        return (_REPLACE, new)
+
+    if type(new) is dict:
+        changed = {}
+        nested = {}
+
+        for key, value in new.iteritems():
+            if key not in old:
+                changed[key] = value
+            elif old[key] != value:
+                sub_patch = make_patch(old[key], value)
+                if sub_patch is None:
+                    continue
+                elif sub_patch[0] == _REPLACE:
+                    changed[key] = value
+                else:
+                    nested[key] = sub_patch
+
+        removed = [key for key in old if key not in new]
+
+        if not (changed or nested or removed):
+            return None
+
+        return (_DICT, changed, nested, removed)
+
+    if type(new) is list and len(old) == len(new):
+        items = dict((index, make_patch(old_item, new_item))
+                     for index, (old_item, new_item) in enumerate(zip(old, new)) if old_item != new_item)
+
+        if not items:
+            return None
+
+        return (_LIST, items)
+
+    if old == new:
+        return None
+
+    return (_REPLACE, new)
+#---
+
+def apply_patch(old, patch):
+    """
+    Applies a patch built by `make_patch`.  `old` is not modified, but parts of it that the patch leaves alone are
+    shared with the returned value.
+
+    :param old: The value the patch was made against
+    :param patch: The patch
+
+    :return: The patched value
+    """
+    if patch is None:
+        return old
+
+    form = patch[0]
+
+    if form == _REPLACE:
+        return patch[1]
+
+    if form == _DICT:
+        form, changed, nested, removed = patch
+        new = dict(old)
+        new.update(changed)
+        for key, sub_patch in nested.iteritems():
+            new[key] = apply_patch(old[key], sub_patch)
+        for key in removed:
+            del new[key]
+        return new
+
+    if form == _LIST:
+        new = list(old)
+        for index, sub_patch in patch[1].iteritems():
+            new[index] = apply_patch(old[index], sub_patch)
+        return new
+
+    raise DeltaError('Unknown patch form %r' % form)
+#---
@@ -0,0 +1,145 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         limiter.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Adaptive concurrency limit (TCP Vegas style) for calls in flight.
+#
+#   The limiter compares each call's round trip time with the lowest seen, which stands for the time a call takes when
+#   nothing is queued.  limit x (1 - lowest / rtt) estimates how many calls are queued somewhere along the way: while
+#   it is below alpha x log10(limit) the limit grows, above beta x log10(limit) it shrinks, and a timed out call cuts it
+#   by `backoff`.  Calls beyond the limit wait up to `queue_timeout` for a slot, then fail fast with
+#   ConcurrencyLimitError instead of adding to a backlog.
+#
+
+import math
+import threading
+import time
+
+
+class LimiterError(Exception): pass
+class ConcurrencyLimitError(LimiterError): pass
+
+
+class AdaptiveLimiter(object):
+    """
+    A concurrency limit that follows the observed round trip times.
+
+    """
+    limit = None
+    min_limit = None
+    max_limit = None
+    in_flight = None
+
+    # Estimated queued calls (per log10 of the limit) below which the limit grows, and above which it shrinks
+    alpha = 3
+    beta = 6
+    # Multiplicative decrease on a dropped (timed out) call
+    backoff = 0.9
+    # Samples after which the lowest round trip time is measured afresh, so it follows slow drifts (e.g. a new route)
+    probe_after = 1000
+
+    def __init__(self, initial_limit = 20, min_limit = 1, max_limit = 200, queue_timeout = 0):
+        """
+        Constructor
+
+        :param initial_limit: Calls allowed in flight to begin with
+        :type initial_limit: int
+        :param min_limit: Lowest the limit goes
+        :type min_limit: int
+        :param max_limit: Highest the limit goes
+        :type max_limit: int
+        :param queue_timeout: Seconds a call beyond the limit waits for a slot before it is refused.  0 refuses it at
+            once.
+        :type queue_timeout: float
+
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+
+        self._min_rtt = None
+        self._samples = 0
+        self._slots = threading.Condition(threading.Lock())
+    #---
+
+    def acquire(self):
+        """
+        Takes a slot for a call.
+
+        :raises: ConcurrencyLimitError if no slot frees up within the queue timeout
+        """
+        with self._slots:
+            deadline = time.time() + self.queue_timeout
+
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ConcurrencyLimitError('%i calls in flight, at the limit of %i' %
+                                                (self.in_flight, int(self.limit)))
+                self._slots.wait(remaining)
+
+            self.in_flight += 1
+    #---
+
+    def release(self, rtt = None, dropped = False):
+        """
+        Gives a call's slot back and adjusts the limit.
+
+        :param rtt: The call's round trip time in seconds, ``None`` if it failed without one
+        :type rtt: float
+        :param dropped: Whether the call timed out
+        :type dropped: bool
+
+        """
+        with self._slots:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+
+            if dropped:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            elif rtt is not None:
+                self._sample(rtt, in_flight)
+
+            self._slots.notify()
+    #---
+
+    def _sample(self, rtt, in_flight):
+        """
+        Adjusts the limit for a round trip time.  Must be called with the lock held.
+
+        """
+        self._samples += 1
+        if self._min_rtt is None or self._samples % self.probe_after == 0:
+            self._min_rtt = rtt
+        self._min_rtt = min(self._min_rtt, rtt)
+
+        queued = self.limit * (1 - self._min_rtt / rtt) if rtt > 0 else 0
+        scale = math.log10(self.limit)
+
+        # Only grow a limit that is being used, or an idle client's limit would creep up to the maximum
+        if queued < max(1, self.alpha * scale) and in_flight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1)
+        elif queued > max(2, self.beta * scale):
+            self.limit = max(self.min_limit, self.limit - 1)
+    #---
+#---
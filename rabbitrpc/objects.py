@@ -0,0 +1,184 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         objects.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Remote objects.  Instances of classes registered with `register.RPCClass` live in the server process that created
+#   them; clients hold an ObjectHandle, which names the object and the queue of the server process holding it.
+#
+
+import threading
+import time
+import uuid
+
+
+class ObjectError(Exception): pass
+
+
+class ObjectHandle(object):
+    """
+    Client-side reference to an object held by a server process.
+
+    """
+    id = None
+    route = None
+    module = None
+    class_name = None
+
+    def __init__(self, object_id, route, module, class_name):
+        """
+        Constructor
+
+        :param object_id: The object's id within the server process
+        :type object_id: str
+        :param route: Routing key (queue name) reaching the server process holding the object
+        :type route: str
+        :param module: Short name of the module the class is registered in
+        :type module: str
+        :param class_name: Name of the object's class
+        :type class_name: str
+
+        """
+        self.id = object_id
+        self.route = route
+        self.module = module
+        self.class_name = class_name
+    #---
+
+    def __repr__(self):
+        return '<ObjectHandle %s.%s %s@%s>' % (self.module, self.class_name, self.id, self.route)
+    #---
+#---
+
+
+class ObjectRegistry(object):
+    """
+    The objects held by a server process.  Objects that go unused for longer than their TTL are dropped.
+
+    """
+    sweep_interval = None
+
+    def __init__(self, sweep_interval = 1.0):
+        """
+        Constructor
+
+        :param sweep_interval: Minimum number of seconds between sweeps for idle objects
+        :type sweep_interval: float
+
+        """
+        self.sweep_interval = sweep_interval
+
+        self._objects = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+    #---
+
+    def __len__(self):
+        with self._lock:
+            return len(self._objects)
+    #---
+
+    def add(self, instance, module, class_name, ttl):
+        """
+        Starts holding an object.
+
+        :param instance: The object
+        :param module: Short name of the module its class is registered in
+        :type module: str
+        :param class_name: Name of its class
+        :type class_name: str
+        :param ttl: Seconds the object may go unused before it is dropped.  ``None`` keeps it until it is released.
+        :type ttl: float
+
+        :return: The new object's id
+        :rtype: str
+
+        """
+        object_id = uuid.uuid4().hex
+
+        with self._lock:
+            self._objects[object_id] = [instance, module, class_name, ttl, time.time()]
+
+        return object_id
+    #---
+
+    def get(self, object_id):
+        """
+        Provides a held object, and marks it as used.
+
+        :param object_id: The object's id
+        :type object_id: str
+
+        :return: tuple of the object[0], its module[1] and its class name[2]
+        :raises: ObjectError if the object is not held (any more)
+
+        """
+        with self._lock:
+            entry = self._objects.get(object_id)
+
+            if entry is None:
+                raise ObjectError('Object %s is not held by this server, it may have been released or expired' %
+                                  object_id)
+
+            entry[4] = time.time()
+
+            return tuple(entry[:3])
+    #---
+
+    def release(self, object_id):
+        """
+        Stops holding an object.
+
+        :param object_id: The object's id
+        :type object_id: str
+
+        :return: Whether the object was held
+        :rtype: bool
+
+        """
+        with self._lock:
+            return self._objects.pop(object_id, None) is not None
+    #---
+
+    def expire(self):
+        """
+        Drops the objects which have been idle for longer than their TTL.  Does nothing if the last sweep was less than
+        `sweep_interval` ago, so it is cheap to call often.
+
+        :return: Number of objects dropped
+        :rtype: int
+
+        """
+        now = time.time()
+
+        with self._lock:
+            if now - self._last_sweep < self.sweep_interval:
+                return 0
+
+            self._last_sweep = now
+            expired = [object_id for object_id, (instance, module, class_name, ttl, last_used)
+                       in self._objects.items() if ttl is not None and now - last_used > ttl]
+
+            for object_id in expired:
+                del self._objects[object_id]
+
+        return len(expired)
+    #---
+#---
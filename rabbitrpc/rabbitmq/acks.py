@@ -0,0 +1,218 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         acks.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Batched message acknowledgements.
+#
+#   An AckBatcher holds back the acks of one channel and sends many at once, as a single basic_ack with `multiple`
+#   set, once `max_batch` are waiting or the oldest has waited `max_delay`.  Held back acks keep their messages
+#   counted against the channel's prefetch, so with a prefetch given the batch never grows past half of it: the broker
+#   keeps delivering while a batch fills, instead of the window sitting idle until `max_delay` runs out.
+#
+#   A multiple ack covers every earlier delivery on the channel, including messages still being worked on, so the
+#   batcher keeps the channel's deliveries in order and the multiple ack only goes up to the first one that is not
+#   finished yet.  Finished messages behind that one are acked one by one in the same flush, so a slow message doesn't
+#   hold their prefetch slots.  Messages are thus never acked before they are done, and a lost connection redelivers
+#   the unacked ones as before: at least once.
+#
+#   The batched acks go out on the underlying pika channel (see `channels`) without waiting for the write, as do the
+#   consumer's replies when batching is on, so a round of them is written together the next time the connection is
+#   serviced.  Replies are queued before their message's ack, and the connection writes frames in order.
+#
+
+import collections
+import time
+
+from rabbitrpc import stats
+from rabbitrpc.rabbitmq import channels
+
+
+# States of a delivery
+_RUNNING = 0
+_ACKED = 1
+_REJECTED = 2
+
+
+class AckBatcher(object):
+    """
+    Batches the acks of one channel.  Like the channel, it may only be used from the connection's thread.
+
+    """
+    max_batch = None
+    max_delay = None
+    prefetch = None
+
+    def __init__(self, channel, max_batch = 50, max_delay = 0.05, prefetch = None, counters = None, clock = time.time):
+        """
+        Constructor
+
+        :param channel: The channel whose deliveries are acknowledged
+        :type channel: pika.adapters.blocking_connection.BlockingChannel
+        :param max_batch: Acks waiting that trigger a flush
+        :type max_batch: int
+        :param max_delay: Seconds an ack may wait
+        :type max_delay: float
+        :param prefetch: The channel's prefetch count, half of which caps the batch.  ``None`` for no cap.
+        :type prefetch: int
+        :param counters: Where to count 'ack_batches', the 'batched_acks' in them and the 'unbatched_acks' sent one by
+            one.  Defaults to a counter set of its own.
+        :type counters: stats.Counters
+        :param clock: Provides the time
+        :type clock: func
+
+        """
+        self.channel = channel
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.prefetch = prefetch
+        self.stats = counters or stats.Counters()
+        self._clock = clock
+
+        # delivery tag -> state, in delivery order
+        self._deliveries = collections.OrderedDict()
+        self._waiting = 0
+        self._oldest = None
+    #---
+
+    def __len__(self):
+        """
+        Acks waiting to be sent.
+
+        """
+        return self._waiting
+    #---
+
+    def delivered(self, delivery_tag):
+        """
+        Records a delivery that will be acked or rejected.
+
+        :param delivery_tag: The delivery's tag
+        :type delivery_tag: int
+
+        """
+        self._deliveries[delivery_tag] = _RUNNING
+    #---
+
+    def ack(self, delivery_tag):
+        """
+        Acknowledges a finished message, in the next batch.  Messages that weren't recorded as delivered are
+        acknowledged at once.
+
+        :param delivery_tag: The delivery's tag
+        :type delivery_tag: int
+
+        """
+        if delivery_tag not in self._deliveries:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+            return
+
+        self._deliveries[delivery_tag] = _ACKED
+        self._waiting += 1
+
+        if self._oldest is None:
+            self._oldest = self._clock()
+
+        if self._waiting >= self.batch_size:
+            self.flush()
+    #---
+
+    @property
+    def batch_size(self):
+        """
+        Acks waiting that trigger a flush: `max_batch`, or half the prefetch if that is less.
+
+        :rtype: int
+        """
+        if self.prefetch is None:
+            return self.max_batch
+
+        return max(1, min(self.max_batch, self.prefetch // 2))
+    #---
+
+    def reject(self, delivery_tag, requeue):
+        """
+        Rejects a message, at once.
+
+        :param delivery_tag: The delivery's tag
+        :type delivery_tag: int
+        :param requeue: Whether the broker should requeue it
+        :type requeue: bool
+
+        """
+        self.channel.basic_reject(delivery_tag=delivery_tag, requeue=requeue)
+
+        if delivery_tag in self._deliveries:
+            self._deliveries[delivery_tag] = _REJECTED
+    #---
+
+    def due(self):
+        """
+        Whether the oldest waiting ack has waited long enough.
+
+        :rtype: bool
+        """
+        return self._oldest is not None and self._clock() - self._oldest >= self.max_delay
+    #---
+
+    def flush(self):
+        """
+        Acknowledges every finished message: those up to the first unfinished one with a single ack, and those behind
+        it one by one.
+
+        """
+        settled = []
+        last_acked = None
+        acked = 0
+        # Finished messages behind an unfinished one
+        behind = []
+        blocked = False
+
+        for delivery_tag, state in self._deliveries.iteritems():
+            if state == _RUNNING:
+                blocked = True
+                continue
+
+            settled.append(delivery_tag)
+
+            if state == _ACKED and blocked:
+                behind.append(delivery_tag)
+            elif state == _ACKED:
+                last_acked = delivery_tag
+                acked += 1
+
+        for delivery_tag in settled:
+            del self._deliveries[delivery_tag]
+
+        if last_acked is not None:
+            channels.underlying(self.channel).basic_ack(delivery_tag=last_acked, multiple=True)
+            self.stats.increment('ack_batches')
+            self.stats.increment('batched_acks', acked)
+
+        for delivery_tag in behind:
+            channels.underlying(self.channel).basic_ack(delivery_tag=delivery_tag)
+
+        if behind:
+            self.stats.increment('unbatched_acks', len(behind))
+
+        self._waiting = 0
+        self._oldest = None
+    #---
+#---
@@ -0,0 +1,228 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         adaptive.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Sizes the consumer's worker pool (and its prefetch) from measurements instead of by hand.
+#
+#   Every interval the controller looks at the calls that arrived and completed since the last decision: the arrival
+#   rate, the mean service time and the mean wait for a worker.  It then runs an AIMD loop:
+#
+#   * Service time well above the best seen means the workers are contending for something (CPU, a lock, a database),
+#     so the pool backs off multiplicatively.
+#   * If the workers are nearly always busy, or latency is over target, the pool grows by one, or straight to the size
+#     Little's law says the offered load needs (arrival rate x uncontended service time) plus headroom.
+#   * If the workers are mostly idle and latency is well within target, the pool shrinks by one.
+#
+
+import math
+from rabbitrpc import stats
+import threading
+import time
+
+
+class AdaptiveController(object):
+    """
+    Decides the worker pool size and prefetch count for a latency target.
+
+    """
+    target_latency = None
+    min_workers = None
+    max_workers = None
+    interval = None
+    workers = None
+    prefetch = None
+    stats = None
+
+    # Busy fraction above which the pool counts as saturated, and below which it counts as oversized
+    high_utilization = 0.85
+    low_utilization = 0.5
+    # Service time this many times the best seen counts as contention
+    contention = 2.0
+    # Multiplicative decrease on contention
+    backoff = 0.7
+    # Fraction by which the best service time seen is allowed to drift up per decision, so it follows the load's mix
+    baseline_drift = 0.02
+
+    def __init__(self, target_latency, min_workers = 1, max_workers = 64, interval = 1.0, prefetch_ratio = 1.0,
+                 workers = None, counters = None, clock = time.time):
+        """
+        Constructor
+
+        :param target_latency: Mean latency (wait for a worker plus service time) to aim for, in seconds
+        :type target_latency: float
+        :param min_workers: Smallest pool size
+        :type min_workers: int
+        :param max_workers: Largest pool size
+        :type max_workers: int
+        :param interval: Seconds between decisions
+        :type interval: float
+        :param prefetch_ratio: Prefetch count per worker
+        :type prefetch_ratio: float
+        :param workers: Starting pool size.  Defaults to `min_workers`.
+        :type workers: int
+        :param counters: Where to keep the 'adaptive.*' metrics.  Defaults to a counter set of its own.
+        :type counters: stats.Counters
+        :param clock: Time source, replaceable for simulations
+        :type clock: func
+
+        """
+        self.target_latency = target_latency
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.prefetch_ratio = prefetch_ratio
+        self.clock = clock
+        self.stats = counters or stats.Counters()
+
+        self._lock = threading.Lock()
+        self._baseline_service = None
+        self._in_flight = 0
+        self._set_workers(workers or min_workers)
+        self._reset_window(clock())
+    #---
+
+    def delivered(self):
+        """
+        Records a call handed to the pool.
+
+        """
+        with self._lock:
+            self._in_flight += 1
+            self._arrivals += 1
+    #---
+
+    def completed(self, wait, service):
+        """
+        Records a completed call.
+
+        :param wait: Seconds it waited for a worker
+        :type wait: float
+        :param service: Seconds the worker spent on it
+        :type service: float
+
+        """
+        with self._lock:
+            self._in_flight -= 1
+            self._count += 1
+            self._wait_total += wait
+            self._service_total += service
+    #---
+
+    def dropped(self):
+        """
+        Records a call that was handed to the pool but dropped without being run, e.g. for missing its deadline.
+
+        """
+        with self._lock:
+            self._in_flight -= 1
+    #---
+
+    def due(self):
+        """
+        Whether the next decision is due.
+
+        :rtype: bool
+
+        """
+        return self.clock() - self._window_start >= self.interval
+    #---
+
+    def adjust(self):
+        """
+        Makes a decision from the calls completed since the last one.
+
+        :return: tuple of the new pool size[0] and prefetch count[1]
+
+        """
+        now = self.clock()
+
+        with self._lock:
+            count, wait_total, service_total = self._count, self._wait_total, self._service_total
+            arrivals = self._arrivals
+            elapsed = max(now - self._window_start, 1e-9)
+            in_flight = self._in_flight
+            self._reset_window(now)
+
+        if not count:
+            # Nothing finished: either idle, or everything is stuck behind slow calls
+            if in_flight == 0 and self.workers > self.min_workers:
+                return self._decide(self.workers - 1, 'decrease')
+            return self.workers, self.prefetch
+
+        service = service_total / count
+        wait = wait_total / count
+        latency = wait + service
+        throughput = count / elapsed
+        utilization = service_total / (elapsed * self.workers)
+
+        if self._baseline_service is None:
+            self._baseline_service = service
+        else:
+            self._baseline_service = min(service, self._baseline_service * (1 + self.baseline_drift))
+
+        # Little's law: the workers the offered load keeps busy when they don't contend, with headroom to stay below
+        # high_utilization.  Contended service times would overstate it, and more workers would only add contention.
+        needed = int(math.ceil(arrivals / elapsed * self._baseline_service / self.high_utilization))
+
+        self.stats.set('adaptive.service_ms', int(service * 1000))
+        self.stats.set('adaptive.wait_ms', int(wait * 1000))
+        self.stats.set('adaptive.latency_ms', int(latency * 1000))
+        self.stats.set('adaptive.throughput', int(throughput))
+        self.stats.set('adaptive.utilization_pct', int(utilization * 100))
+
+        if service > self._baseline_service * self.contention and self.workers > self.min_workers:
+            return self._decide(int(self.workers * self.backoff), 'backoff')
+
+        if utilization >= self.high_utilization or latency > self.target_latency:
+            return self._decide(max(self.workers + 1, needed), 'increase')
+
+        if utilization < self.low_utilization and latency < self.target_latency / 2 and self.workers > needed:
+            return self._decide(self.workers - 1, 'decrease')
+
+        return self.workers, self.prefetch
+    #---
+
+    def _decide(self, workers, decision):
+        """
+        Applies a new pool size within the bounds, and records the decision.
+
+        """
+        self._set_workers(workers)
+        self.stats.increment('adaptive.%s' % decision)
+
+        return self.workers, self.prefetch
+    #---
+
+    def _set_workers(self, workers):
+        self.workers = max(self.min_workers, min(self.max_workers, workers))
+        self.prefetch = max(1, int(math.ceil(self.workers * self.prefetch_ratio)))
+        self.stats.set('adaptive.workers', self.workers)
+        self.stats.set('adaptive.prefetch', self.prefetch)
+    #---
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._count = 0
+        self._arrivals = 0
+        self._wait_total = 0.0
+        self._service_total = 0.0
+    #---
+#---
@@ -0,0 +1,45 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         channels.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Access to the pika channel under a BlockingChannel.
+#
+#   BlockingChannel waits for the broker on every call that has a reply, and only offers confirms that wait for each
+#   publish.  Batched acks, replies written along with them and pipelined publisher confirms (see `acks` and
+#   `confirms`) instead use the underlying pika.channel.Channel, whose methods only buffer frames for the next time
+#   the connection is serviced.  BlockingChannel keeps that channel in the private `_impl` attribute, as of pika 0.10;
+#   this is the one place that relies on it.
+#
+
+
+def underlying(channel):
+    """
+    Provides the pika channel a BlockingChannel runs on.  Its methods don't wait for the broker, and like the
+    BlockingChannel it may only be used from the connection's thread.
+
+    :param channel: The blocking channel
+    :type channel: pika.adapters.blocking_connection.BlockingChannel
+
+    :rtype: pika.channel.Channel
+    """
+    # Private in pika 0.10's BlockingChannel
+    return channel._impl
+#---
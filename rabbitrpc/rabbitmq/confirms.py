@@ -0,0 +1,270 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         confirms.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Pipelined publisher confirms.
+#
+#   pika's BlockingChannel.confirm_delivery makes every publish wait for the broker's confirm, a round trip each.
+#   ConfirmTracker instead puts the channel in confirm mode with its own callback and numbers the publishes the way
+#   the broker does (1, 2, ... per channel), so publishing carries on while up to `max_unconfirmed` messages await
+#   their confirms.  Acks (single or `multiple`) settle them, and nacked messages are published again, up to
+#   `max_retries` times, the next time the tracker is used.  `wait` blocks until everything published is settled,
+#   `waitFor` until one message is, its retries included.
+#
+#   Every publish on a tracked channel must go through its tracker, or the numbering drifts from the broker's.
+#
+
+import collections
+import logging
+import time
+
+from pika import spec
+from rabbitrpc import stats
+from rabbitrpc.rabbitmq import channels
+
+
+class ConfirmError(Exception): pass
+class ConfirmTimeoutError(ConfirmError): pass
+class PublishFailedError(ConfirmError): pass
+
+
+class ConfirmTracker(object):
+    """
+    Tracks the publisher confirms of one channel.  Like the channel, it may only be used from the connection's thread.
+
+    """
+    max_unconfirmed = None
+    max_retries = None
+    poll_interval = None
+    failed = None
+
+    def __init__(self, connection, channel, max_unconfirmed = 1000, max_retries = 3, poll_interval = 0.01,
+                 counters = None):
+        """
+        Constructor
+
+        :param connection: The channel's connection, serviced while waiting for confirms
+        :type connection: pika.BlockingConnection
+        :param channel: The channel to track
+        :type channel: pika.adapters.blocking_connection.BlockingChannel
+        :param max_unconfirmed: Messages that may await their confirm before publishing waits
+        :type max_unconfirmed: int
+        :param max_retries: Times a nacked message is published again before it is given up on
+        :type max_retries: int
+        :param poll_interval: Longest time (in seconds) the connection is serviced for at a time while waiting for
+            confirms, so waiting blocks instead of spinning
+        :type poll_interval: float
+        :param counters: Where to count confirms ('confirms.acked', 'confirms.nacked', 'confirms.retried' and
+            'confirms.failed').  Defaults to a counter set of its own.
+        :type counters: stats.Counters
+
+        """
+        self.log = logging.getLogger('rabbitmq.confirms')
+        self.connection = connection
+        self.channel = channel
+        self.max_unconfirmed = max_unconfirmed
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.stats = counters or stats.Counters()
+        # Messages given up on since the last `wait`
+        self.failed = 0
+
+        # delivery tag -> (publish arguments, attempts, message), in publishing order.  A message is known by the tag
+        # it was first published under, which its retries keep.
+        self._unconfirmed = collections.OrderedDict()
+        self._nacked = collections.deque()
+        self._last_tag = 0
+        # Messages not settled yet, and those given up on since the last `wait`
+        self._pending = set()
+        self._given_up = set()
+    #---
+
+    def __len__(self):
+        return len(self._unconfirmed) + len(self._nacked)
+    #---
+
+    def start(self):
+        """
+        Puts the channel in confirm mode.  Must be called before anything is published on it.
+
+        """
+        # The underlying channel, as the blocking one only offers confirms that wait for each publish
+        channels.underlying(self.channel).confirm_delivery(self._onConfirm, nowait=True)
+    #---
+
+    def publish(self, **publish_args):
+        """
+        Publishes a message, waiting first if too many are unconfirmed.
+
+        :param publish_args: Arguments for the channel's ``basic_publish``
+        :type publish_args: dict
+
+        :return: The message's delivery tag, for `waitFor`
+        :rtype: int
+        """
+        self.resendNacked()
+
+        while len(self._unconfirmed) >= self.max_unconfirmed:
+            self._processEvents()
+
+        message = self._last_tag + 1
+        self._pending.add(message)
+        self._publish(publish_args, 1, message)
+
+        return message
+    #---
+
+    def resendNacked(self):
+        """
+        Publishes nacked messages again.  Done from here rather than the confirm callback, which runs while pika is
+        dispatching events.
+
+        """
+        while self._nacked:
+            publish_args, attempts, message = self._nacked.popleft()
+            self._publish(publish_args, attempts + 1, message)
+            self.stats.increment('confirms.retried')
+    #---
+
+    def wait(self, timeout = None):
+        """
+        Waits until every message published so far is confirmed.
+
+        :param timeout: Seconds to wait at most, ``None`` for no limit
+        :type timeout: float
+
+        :raises: ConfirmTimeoutError if messages are still unconfirmed at the timeout, PublishFailedError if messages
+            were given up on
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while len(self):
+            self.resendNacked()
+
+            if deadline is not None and time.time() >= deadline:
+                raise ConfirmTimeoutError('%i messages still unconfirmed after %ss' % (len(self), timeout))
+
+            self._processEvents(deadline)
+
+        failed, self.failed = self.failed, 0
+        self._given_up.clear()
+
+        if failed:
+            raise PublishFailedError('%i messages were nacked by the broker %i times' % (failed, self.max_retries + 1))
+    #---
+
+    def waitFor(self, delivery_tag, timeout = None):
+        """
+        Waits until one message is confirmed, whatever else is still unconfirmed.
+
+        :param delivery_tag: The message's delivery tag, as returned by `publish`
+        :type delivery_tag: int
+        :param timeout: Seconds to wait at most, ``None`` for no limit
+        :type timeout: float
+
+        :raises: ConfirmTimeoutError if the message is still unconfirmed at the timeout, PublishFailedError if it was
+            given up on
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while delivery_tag in self._pending:
+            self.resendNacked()
+
+            if deadline is not None and time.time() >= deadline:
+                raise ConfirmTimeoutError('Message %i still unconfirmed after %ss' % (delivery_tag, timeout))
+
+            self._processEvents(deadline)
+
+        # Reported here, so not again by `wait`
+        if delivery_tag in self._given_up:
+            self._given_up.discard(delivery_tag)
+            self.failed -= 1
+            raise PublishFailedError('Message %i was nacked by the broker %i times' %
+                                     (delivery_tag, self.max_retries + 1))
+    #---
+
+    def _processEvents(self, deadline = None):
+        """
+        Services the connection for up to the poll interval, or until the deadline if that is sooner.  The connection
+        returns as soon as it has dispatched something, such as a confirm.
+
+        :param deadline: Time to stop waiting at, ``None`` for none
+        :type deadline: float
+
+        """
+        time_limit = self.poll_interval
+        if deadline is not None:
+            time_limit = max(0, min(time_limit, deadline - time.time()))
+
+        self.connection.process_data_events(time_limit=time_limit)
+    #---
+
+    def _publish(self, publish_args, attempts, message):
+        """
+        Publishes a message under the next delivery tag.
+
+        """
+        self._last_tag += 1
+        self._unconfirmed[self._last_tag] = (publish_args, attempts, message)
+        self.channel.basic_publish(**publish_args)
+    #---
+
+    def _onConfirm(self, frame):
+        """
+        Settles the messages a Basic.Ack or Basic.Nack covers.
+
+        :param frame: The confirm
+        :type frame: pika.frame.Method
+
+        """
+        method = frame.method
+        nacked = isinstance(method, spec.Basic.Nack)
+
+        if method.multiple:
+            tags = []
+            for tag in self._unconfirmed:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            publish_args, attempts, message = self._unconfirmed.pop(tag, (None, 0, None))
+
+            if publish_args is None:
+                continue
+            elif not nacked:
+                self.stats.increment('confirms.acked')
+                self._pending.discard(message)
+            elif attempts <= self.max_retries:
+                self.stats.increment('confirms.nacked')
+                self._nacked.append((publish_args, attempts, message))
+            else:
+                self.stats.increment('confirms.nacked')
+                self.stats.increment('confirms.failed')
+                self._pending.discard(message)
+                self._given_up.add(message)
+                self.failed += 1
+                self.log.error('Giving up on a message to %r nacked %i times' %
+                               (publish_args.get('routing_key'), attempts))
+    #---
+#---
@@ -24,9 +24,25 @@
 #
 
 
+import collections
+import copy
 import logging
 import pika
 from pika.exceptions import AMQPConnectionError
+import Queue
+from rabbitrpc import admission
+from rabbitrpc import cancellation
+from rabbitrpc import routing
+from rabbitrpc import stats
+from rabbitrpc.rabbitmq import acks
+from rabbitrpc.rabbitmq import adaptive
+from rabbitrpc.rabbitmq import channels
+from rabbitrpc.rabbitmq import confirms
+from rabbitrpc.rabbitmq import lanes
+from rabbitrpc.rabbitmq import retry
+from rabbitrpc.rabbitmq import scheduling
+from rabbitrpc.rabbitmq import workers
+import time
 import traceback
 
 
@@ -36,6 +52,84 @@ class CredentialsError(ConsumerError): pass
 class InvalidMessageError(ConsumerError): pass
 
 
+# Settings that may be left out of the config, with their defaults
+OPTIONAL_SETTINGS = {
+    # Threads running the callback.  With 1 the callback runs on the connection's thread.
+    'workers': 1,
+    # Unacknowledged messages the broker may push to this consumer.  Defaults to the number of workers.
+    'prefetch_count': None,
+    # How often (in seconds) the connection thread checks for finished work when there are several workers
+    'poll_interval': 0.01,
+    # How often (in seconds) the depth of each lane's queue is read from the broker
+    'depth_interval': 5,
+    # Highest message priority the queues support (their x-max-priority).  ``None`` declares them without priorities.
+    # RabbitMQ refuses to redeclare an existing queue with a different value, so changing it means recreating them.
+    'max_priority': None,
+    # Mean latency (in seconds, from delivery to finish) to size the worker pool for.  When set, the pool starts at
+    # `workers` and an adaptive.AdaptiveController grows or shrinks it, and the prefetch with it, between min_workers
+    # and max_workers.  A `prefetch_count` set alongside it fixes the prefetch per worker.
+    'latency_target': None,
+    'min_workers': 1,
+    'max_workers': 32,
+    # How often (in seconds) the adaptive controller resizes the pool
+    'adjust_interval': 1,
+    # Listen for cancelled calls (see `cancellation`).  Clients must have it on too, to send them.
+    'cancellation': False,
+    # Retry failed messages after a delay, and dead-letter those out of attempts (see `retry`).  A dict of
+    # retry.RetryPolicy arguments, e.g. {'max_attempts': 3}.  ``None`` requeues a failed message once, at once.
+    'retry': None,
+    # Have the broker confirm replies and retried messages, and publish nacked ones again (see `confirms`).  True, or
+    # a dict of confirms.ConfirmTracker arguments, e.g. {'max_unconfirmed': 500}.
+    'publisher_confirms': None,
+    # Acknowledge finished messages in batches of up to this many, held back at most ack_batch_delay seconds, and
+    # write replies a round at a time (see `acks`).  1 acknowledges each message as soon as it is finished.  A batch
+    # never grows past half its channel's prefetch (prefetch_count, or `workers` without one), so the broker keeps
+    # delivering while it fills: a larger ack_batch_size needs a larger prefetch to have any effect.
+    'ack_batch_size': 1,
+    'ack_batch_delay': 0.05,
+    # Channels consuming the queues, on the one connection.  Each has a consumer per queue and the prefetch of its own,
+    # and they all feed the same worker pool.
+    'channels': 1,
+    # Share of the worker pool for the main queue (and the queues added with addQueue), relative to the weights of the
+    # queues added with addWeightedQueue
+    'queue_weight': 1,
+    # Share the worker pool fairly between the tenants the calls are made for (see `scheduling`), rather than serving
+    # calls in the order they arrived.  True, or a dict of scheduling.WeightedFairQueue arguments, e.g.
+    # {'weights': {'billing': 2}, 'default_max_running': 4}.  The prefetch is the window the calls are picked from.
+    # With caps ('max_running'), a capped tenant's waiting calls still hold their place in the window until they run,
+    # so set the prefetch above the largest burst a tenant sends, or a burst fills the window and locks the other
+    # tenants out until it drains (see benchmarks/bench_tenants.py).
+    'tenant_fairness': None,
+    # Run the calls the caller needs soonest first, and drop those too close to their deadline to make it, rather than
+    # serve calls in the order they arrived (see `scheduling`).  True, or a dict of scheduling.EarliestDeadlineFirst
+    # arguments, e.g. {'min_remaining': 0.05}.  The prefetch is the window the calls are picked from.
+    'deadline_scheduling': None,
+}
+
+# What the worker pool is shared by, and the prefix of the metrics kept for each share
+SCHEDULE_BY_QUEUE = 'queue'
+SCHEDULE_BY_TENANT = 'tenant'
+SCHEDULE_BY_DEADLINE = 'deadline'
+
+# Outcome of a call that was cancelled before it started: acknowledged, without a reply
+_CANCELLED = object()
+
+
+class _FailedMessage(object):
+    """
+    Outcome of a message whose callback failed, under a retry policy.
+
+    """
+
+    def __init__(self, body, error, poison = False):
+        self.body = body
+        self.error = error
+        # Whether retrying is pointless, e.g. for a message that can't be decoded
+        self.poison = poison
+    #---
+#---
+
+
 class Consumer(object):
     """
     Implements a consumer for RabbitMQ (with callbacks)
@@ -67,23 +161,143 @@ class Consumer(object):
         """
         self.log = logging.getLogger('rabbitmq.consumer')
         self.callback = callback
+        self._pool = None
+        self._adaptive = None
+        self._prefetch = None
+        # (consumer tag, delivery tag) -> delivery time, for the adaptive controller's wait measurements.  Delivery tags
+        # are only unique within a channel.
+        self._delivered = {}
+        self._completed = Queue.Queue()
+        self._running = False
+        self._queues = []
+        self._lanes = []
+        self._last_depth_check = 0
+        self.stats = stats.Counters()
+        self.cancelled_calls = cancellation.CancelledCalls()
+        # consumer tag -> the queue it consumes, so failed messages can be retried on their own queue
+        self._consumer_queues = {}
+        self._retry_queues = set()
+        self._retry_policy = None
+        # channel -> its confirms.ConfirmTracker, when publisher confirms are on
+        self._confirms = {}
+        # channel -> its acks.AckBatcher, when acks are batched
+        self._ack_batchers = {}
+        # Channels opened beyond the main one (see the 'channels' setting), and consumer tag -> channel for all
+        self._extra_channels = []
+        self._consumer_channels = {}
+        # queue name -> (weight, prefetch count, channel) for the weighted queues, the scheduler sharing the pool
+        # (between them and the main queue, between tenants, or by deadline), what it schedules by (SCHEDULE_BY_*) and
+        # the messages it has handed to the pool that are not finished yet
+        self._weighted_queues = {}
+        self._scheduler = None
+        self._schedule_by = None
+        self._scheduled_running = 0
+        # order key -> messages held back behind the key's message in the scheduler, as the scheduler may reorder them
+        self._held = {}
+
+        # The class' config holds the defaults, each consumer gets a copy of its own
+        self.config = copy.deepcopy(self.config)
 
         if rabbit_config:
             self.config.update(rabbit_config)
 
+        if self._setting('retry') is not None:
+            self._retry_policy = retry.RetryPolicy(**self._setting('retry'))
+
         if 'username' and 'password' in self.config['connection_settings']:
             self._createCredentials()
 
         self._configureConnection()
     #---
 
+    def addQueue(self, queue_name, bindings = (), **declare_args):
+        """
+        Has the consumer also take messages from another queue, which it declares when it connects.  Must be called
+        before `run`.
+
+        :param queue_name: Name of the queue
+        :type queue_name: str
+        :param bindings: (exchange, exchange type, routing key) for each exchange to declare (durable) and bind the
+            queue to
+        :type bindings: list
+        :param declare_args: Passed to ``queue_declare``, e.g. ``exclusive=True``
+        :type declare_args: dict
+
+        """
+        self._queues.append((queue_name, bindings, declare_args))
+    #---
+
+    def addWeightedQueue(self, queue_name, weight = 1, prefetch_count = None):
+        """
+        Has the consumer take messages from a durable queue, consumed on its own channel, that shares the worker pool
+        with the main queue by weight (see `scheduling`).  A queue with twice the weight of another gets twice the
+        workers while both have work waiting, and whatever the other leaves idle.  Must be called before `run`.
+
+        The consumer keeps these metrics for each weighted queue, and the main queue, in `stats`:
+        'queue.<name>.messages', 'queue.<name>.wait_ms' (total time messages waited for a worker after delivery) and
+        'queue.<name>.backlog' (delivered messages waiting for a worker).
+
+        :param queue_name: Name of the queue
+        :type queue_name: str
+        :param weight: Share of the worker pool, relative to the main queue's 'queue_weight' and the other queues'
+        :type weight: float
+        :param prefetch_count: Unacknowledged messages the broker may push to the queue.  Defaults to the consumer's
+            prefetch.
+        :type prefetch_count: int
+
+        """
+        self._weighted_queues[queue_name] = (weight, prefetch_count, None)
+    #---
+
+    def addLane(self, name, queue_name, workers = 1, prefetch_count = None):
+        """
+        Has the consumer take messages from a lane: a durable queue consumed on its own channel and run by its own
+        worker pool.  Must be called before `run`.
+
+        The consumer keeps these metrics for each lane, in `stats`: 'lane.<name>.messages', 'lane.<name>.wait_ms' (total
+        time messages waited for a worker after delivery), 'lane.<name>.backlog' (delivered messages waiting for a
+        worker) and 'lane.<name>.depth' (messages waiting in the broker queue).
+
+        :param name: Lane name
+        :type name: str
+        :param queue_name: The lane's queue
+        :type queue_name: str
+        :param workers: Threads running the lane's messages
+        :type workers: int
+        :param prefetch_count: Unacknowledged messages the broker may push to the lane.  Defaults to `workers`.
+        :type prefetch_count: int
+
+        """
+        self._lanes.append(lanes.Lane(name, queue_name, workers, prefetch_count))
+    #---
+
     def stop(self):
         """
         Disconnects from the RabbitMQ server
 
         """
-        self.channel.stop_consuming()
-        self.channel.close()
+        self._running = False
+
+        if self._pool:
+            self._pool.stop()
+            self._pool = None
+
+        for batcher in self._ack_batchers.values():
+            batcher.flush()
+
+        for lane in self._lanes:
+            if lane.pool:
+                lane.pool.stop()
+                lane.pool = None
+            if lane.channel:
+                lane.channel.stop_consuming()
+                lane.channel.close()
+
+        weighted_channels = [channel for _, _, channel in self._weighted_queues.values() if channel]
+
+        for channel in [self.channel] + self._extra_channels + weighted_channels:
+            channel.stop_consuming()
+            channel.close()
     #---
 
     def run(self):
@@ -91,14 +305,343 @@ class Consumer(object):
         Starts the consumer.
 
         """
+        if self._setting('latency_target') is not None:
+            self._adaptive = self._createController()
+
+        self._createScheduler()
         self._connect()
-        self.channel.start_consuming()
+
+        for lane in self._lanes:
+            lane.pool = workers.WorkerPool(lane.workers, self._runLaneTask, name='rabbitrpc-lane-%s' % lane.name)
+
+        if self._adaptive:
+            self._pool = workers.WorkerPool(self._adaptive.workers, self._runTask)
+        elif self._setting('workers') > 1 or self._scheduler is not None:
+            self._pool = workers.WorkerPool(self._setting('workers'), self._runTask)
+
+        if self._pool or self._lanes or self._confirms or self._ack_batchers:
+            self._processLoop()
+        else:
+            self.channel.start_consuming()
+    #---
+
+    def _processLoop(self):
+        """
+        Connection loop for the threaded mode.  Services the connection and finishes off (replies to and acknowledges)
+        messages the workers are done with.  Channels may only be used from this thread.
+
+        """
+        self._running = True
+
+        while self._running:
+            self.connection.process_data_events(time_limit=self._setting('poll_interval'))
+            self._finishCompleted()
+
+            for tracker in self._confirms.values():
+                tracker.resendNacked()
+
+            for batcher in self._ack_batchers.values():
+                if batcher.due():
+                    batcher.flush()
+
+            if self._lanes and time.time() - self._last_depth_check >= self._setting('depth_interval'):
+                self._updateLaneDepths()
+
+            if self._adaptive and self._adaptive.due():
+                self._adapt()
+    #---
+
+    def _createScheduler(self):
+        """
+        Creates the scheduler sharing the worker pool, if the config or the weighted queues call for one.
+
+        :raises: ConsumerError if more than one way of scheduling is asked for
+        """
+        tenant_fairness = self._setting('tenant_fairness')
+        deadline_scheduling = self._setting('deadline_scheduling')
+
+        if sum(1 for wanted in (self._weighted_queues, tenant_fairness, deadline_scheduling) if wanted) > 1:
+            raise ConsumerError('Only one of weighted queues, tenant fairness and deadline scheduling can be used')
+
+        if tenant_fairness:
+            options = tenant_fairness if isinstance(tenant_fairness, dict) else {}
+            self._scheduler = scheduling.WeightedFairQueue(**options)
+            self._schedule_by = SCHEDULE_BY_TENANT
+        elif deadline_scheduling:
+            options = dict(default_timeout=self.config['reply_timeout'])
+            options.update(deadline_scheduling if isinstance(deadline_scheduling, dict) else {})
+            self._scheduler = scheduling.EarliestDeadlineFirst(**options)
+            self._schedule_by = SCHEDULE_BY_DEADLINE
+        elif self._weighted_queues:
+            self._schedule_by = SCHEDULE_BY_QUEUE
+            self._scheduler = scheduling.DeficitRoundRobin()
+            self._scheduler.add(self.config['queue_name'], self._setting('queue_weight'))
+            for queue_name, (weight, _, _) in self._weighted_queues.items():
+                self._scheduler.add(queue_name, weight)
+    #---
+
+    def _createController(self):
+        """
+        Creates the adaptive controller from the config.  It keeps its metrics in `stats`.
+
+        :rtype: adaptive.AdaptiveController
+
+        """
+        start = self._setting('workers')
+        prefetch_ratio = float(self._setting('prefetch_count') or start) / start
+
+        return adaptive.AdaptiveController(self._setting('latency_target'), min_workers=self._setting('min_workers'),
+                                           max_workers=self._setting('max_workers'),
+                                           interval=self._setting('adjust_interval'), prefetch_ratio=prefetch_ratio,
+                                           workers=start, counters=self.stats)
+    #---
+
+    def _adapt(self):
+        """
+        Applies the adaptive controller's next decision to the worker pool and the prefetch of the channels.
+
+        """
+        pool_size, prefetch = self._adaptive.adjust()
+
+        if pool_size != self._pool.size:
+            self.log.debug('Resizing the worker pool from %i to %i' % (self._pool.size, pool_size))
+            self._pool.resize(pool_size)
+
+        if prefetch != self._prefetch:
+            for channel in [self.channel] + self._extra_channels:
+                channel.basic_qos(prefetch_count=prefetch)
+                if channel in self._ack_batchers:
+                    self._ack_batchers[channel].prefetch = prefetch
+            self._prefetch = prefetch
+    #---
+
+    def _updateLaneDepths(self):
+        """
+        Reads the depth of each lane's queue from the broker, and the backlog of its worker pool.
+
+        """
+        self._last_depth_check = time.time()
+
+        for lane in self._lanes:
+            frame = lane.channel.queue_declare(queue=lane.queue_name, durable=True, passive=True)
+            self.stats.set(lane.metric('depth'), frame.method.message_count)
+            self.stats.set(lane.metric('backlog'), lane.pool.backlog())
+    #---
+
+    def _runTask(self, task):
+        """
+        Worker side of the threaded mode: runs the callback for a message and hands the outcome back to the connection
+        thread.
+
+        :param task: The message's method, properties and body
+        :type task: tuple
+
+        """
+        method, props, body = task
+
+        if not self._adaptive:
+            response, requeue = self._invokeCallback(method, body, props)
+        else:
+            started = time.time()
+            wait = started - self._delivered.pop((method.consumer_tag, method.delivery_tag), started)
+            response, requeue = self._invokeCallback(method, body, props)
+            self._adaptive.completed(wait, time.time() - started)
+
+        self._completed.put((method, props, response, requeue))
+    #---
+
+    def _runLaneTask(self, task):
+        """
+        Worker side of a lane: runs the callback for a message and hands the outcome back to the connection thread.
+
+        :param task: The message's lane, method, properties, body and delivery time
+        :type task: tuple
+
+        """
+        lane, method, props, body, delivered_at = task
+
+        self.stats.increment(lane.metric('messages'))
+        self.stats.increment(lane.metric('wait_ms'), int((time.time() - delivered_at) * 1000))
+
+        response, requeue = self._invokeCallback(method, body, props)
+        lane.completed.put((method, props, response, requeue))
+    #---
+
+    def _finishCompleted(self):
+        """
+        Finishes every message the workers (and the lanes' workers) have completed so far.
+
+        """
+        finished = self._drainCompleted(self._completed, None)
+
+        if self._scheduler is not None:
+            for method, props in finished:
+                self._scheduler.done(self._scheduleKey(method, props))
+
+            self._scheduled_running -= len(finished)
+            self._dispatchScheduled()
+
+        for lane in self._lanes:
+            self._drainCompleted(lane.completed, lane.channel)
+    #---
+
+    def _drainCompleted(self, completed, channel):
+        """
+        Finishes the messages in a queue of completed work.
+
+        :param completed: Outcomes handed back by workers
+        :type completed: Queue.Queue
+        :param channel: The channel the messages came in on, ``None`` to look it up for each message
+
+        :return: The method and properties of each message finished
+        :rtype: list
+        """
+        finished = []
+
+        while True:
+            try:
+                method, props, response, requeue = completed.get_nowait()
+            except Queue.Empty:
+                return finished
+
+            self._finishMessage(method, props, response, requeue, channel)
+            finished.append((method, props))
+    #---
+
+    def _schedule(self, method, props, body):
+        """
+        Queues a delivered message with the scheduler and hands the pool what it has room for.  Only one message per
+        ordering key is in the scheduler at a time, the rest waiting behind it in delivery order.
+
+        """
+        scheduled = (method, props, body, time.time())
+        order_key = self._orderKey(props)
+
+        if order_key is not None:
+            if order_key in self._held:
+                self._held[order_key].append(scheduled)
+                return
+
+            self._held[order_key] = collections.deque()
+
+        self._pushScheduled(scheduled)
+        self._dispatchScheduled()
+    #---
+
+    def _pushScheduled(self, scheduled):
+        """
+        Queues a message with the scheduler.
+
+        :param scheduled: The message's method, properties, body and time of delivery
+        :type scheduled: tuple
+
+        """
+        method, props, body, delivered_at = scheduled
+        key = self._scheduleKey(method, props)
+
+        if self._schedule_by == SCHEDULE_BY_DEADLINE:
+            self._scheduler.push(key, scheduled, admission.deadline(getattr(props, 'headers', None)))
+        else:
+            self._scheduler.push(key, scheduled)
+
+        self.stats.set('%s.%s.backlog' % (self._schedule_by, key), self._scheduler.backlog(key))
+    #---
+
+    def _releaseOrderKey(self, props):
+        """
+        Queues the next message held back behind one that has left the scheduler, or forgets its ordering key if there
+        is none.  The worker pool keeps the order from there.
+
+        """
+        order_key = self._orderKey(props)
+        if order_key is None:
+            return
+
+        held = self._held[order_key]
+        if held:
+            self._pushScheduled(held.popleft())
+        else:
+            del self._held[order_key]
+    #---
+
+    def _scheduleKey(self, method, props):
+        """
+        Provides what a message is scheduled under: the weighted queue it came from (or the main queue, which is also
+        what calls are scheduled under by deadline), or the tenant its call is made for.
+
+        :rtype: str
+        """
+        if self._schedule_by == SCHEDULE_BY_TENANT:
+            headers = getattr(props, 'headers', None)
+            tenant = headers.get(scheduling.TENANT_HEADER) if isinstance(headers, dict) else None
+            return tenant or scheduling.UNKNOWN_TENANT
+
+        queue_name = self._consumer_queues.get(getattr(method, 'consumer_tag', None))
+        if queue_name not in self._weighted_queues:
+            queue_name = self.config['queue_name']
+
+        return queue_name
+    #---
+
+    def _dispatchScheduled(self):
+        """
+        Hands scheduled messages to the worker pool, in the scheduler's order, while it has idle workers.  Keeping the
+        rest back here, rather than in the pool's queue, is what lets the weights decide who runs next.
+
+        """
+        if self._schedule_by == SCHEDULE_BY_DEADLINE:
+            self._dropExpired()
+
+        while self._scheduled_running < self._pool.size:
+            scheduled = self._scheduler.pop()
+            if scheduled is None:
+                return
+
+            key, (method, props, body, delivered_at) = scheduled
+            metric = '%s.%s.' % (self._schedule_by, key)
+            self._scheduled_running += 1
+            self.stats.increment(metric + 'messages')
+            self.stats.increment(metric + 'wait_ms', int((time.time() - delivered_at) * 1000))
+            self.stats.set(metric + 'backlog', self._scheduler.backlog(key))
+            self._submit(method, props, body)
+            self._releaseOrderKey(props)
+    #---
+
+    def _dropExpired(self):
+        """
+        Drops the scheduled calls too close to their deadline to make it: they are acknowledged without a reply, as
+        their callers are giving up on them.
+
+        """
+        for key, (method, props, body, delivered_at) in self._scheduler.expired():
+            self.log.debug('Dropping call %s, too close to its deadline' % getattr(props, 'correlation_id', None))
+            if self._adaptive:
+                self._delivered.pop((method.consumer_tag, method.delivery_tag), None)
+                self._adaptive.dropped()
+            self.stats.increment('expired_calls')
+            self.stats.increment('%s.%s.expired' % (self._schedule_by, key))
+            self.stats.set('%s.%s.backlog' % (self._schedule_by, key), self._scheduler.backlog(key))
+            self._ack(self._channelOf(method), method.delivery_tag)
+            self._releaseOrderKey(props)
+    #---
+
+    def _submit(self, method, props, body):
+        """
+        Hands a message to the worker pool.
+
+        """
+        order_key = self._orderKey(props)
+        if order_key is None:
+            self._pool.submit((method, props, body))
+        else:
+            self._pool.submit((method, props, body), order_key)
     #---
 
     def _consumerCallback(self, ch, method, props, body):
         """
         Accepts incoming message, routes them to the RPC callback, then replies to the message with whatever the RPC
-        callback returned.
+        callback returned.  With several workers the message is handed to the worker pool instead, and finished off
+        later by the connection loop.
 
         :param ch: Channel
         :type ch: pika.channel.Channel
@@ -107,33 +650,293 @@ class Consumer(object):
         :param props: Properties from the consumer callback
         :type props: pika.amqp_object.Properties
         """
+        self._recordDelivery(self._channelOf(method), method)
+
+        if self._pool:
+            if self._adaptive:
+                self._delivered[(method.consumer_tag, method.delivery_tag)] = time.time()
+                self._adaptive.delivered()
+
+            if self._scheduler is not None:
+                self._schedule(method, props, body)
+            else:
+                self._submit(method, props, body)
+            return
+
+        response, requeue = self._invokeCallback(method, body, props)
+        self._finishMessage(method, props, response, requeue)
+    #---
+
+    def _cancelCallback(self, ch, method, props, body):
+        """
+        Records a cancelled call.
+
+        :param body: The call's correlation id
+        :type body: str
+        """
+        self.cancelled_calls.add(body)
+        self.stats.increment('cancellations')
+    #---
+
+    def _laneCallback(self, lane):
+        """
+        Provides the consumer callback for a lane's channel, which hands the lane's messages to its worker pool.
+
+        :param lane: The lane
+        :type lane: lanes.Lane
+
+        :rtype: func
+
+        """
+        def callback(ch, method, props, body):
+            self._recordDelivery(lane.channel, method)
+            lane.pool.submit((lane, method, props, body, time.time()), self._orderKey(props))
+        #---
+
+        return callback
+    #---
+
+    def _orderKey(self, props):
+        """
+        Provides a message's ordering key, if it has one.
+
+        :param props: Properties from the consumer callback
+        :type props: pika.amqp_object.Properties
+
+        :rtype: str
+        """
+        headers = getattr(props, 'headers', None)
+
+        if isinstance(headers, dict):
+            return headers.get(routing.ORDER_KEY_HEADER)
+
+        return None
+    #---
+
+    def _invokeCallback(self, method, body, props = None):
+        """
+        Runs the RPC callback for a message, deciding what to do with the message if the callback fails.  Cancelled
+        calls are skipped, and running calls can check their cancellation token and how long they waited, and pass
+        their deadline on to the calls they make.
+
+        :param method: Method from the consumer callback
+        :type method: pika.amqp_object.Method
+        :param body: The message body
+        :type body: str
+        :param props: Properties from the consumer callback
+        :type props: pika.amqp_object.Properties
+
+        :return: tuple of the callback's response[0] and, if the message must be rejected, whether to requeue it[1].
+            The second item is ``None`` when the callback succeeded.
+        """
+        call_id = getattr(props, 'correlation_id', None)
+        headers = getattr(props, 'headers', None)
+        wait = admission.waited(headers)
+
+        if call_id is not None and call_id in self.cancelled_calls:
+            self.log.debug('Skipping cancelled call %s' % call_id)
+            self.stats.increment('cancelled_calls')
+            return _CANCELLED, None
+
         try:
-            callback_response = self.callback(body)
+            with cancellation.running(cancellation.CancellationToken(call_id, self.cancelled_calls)):
+                with admission.running(wait, admission.deadline(headers)):
+                    return self.callback(body), None
         except InvalidMessageError as error:
             self.log.error('This consumer encountered an improperly formed message: %s' % body)
-            self.channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
-            return
+            if self._retry_policy:
+                return _FailedMessage(body, 'InvalidMessageError', poison=True), False
+            return None, False
         except Exception as error:
-            if method.redelivered:
+            if self._retry_policy:
+                self.log.error('Unexpected exception raised while calling the consumer callback, retrying the message '
+                               'later:\n\n%s\n' % traceback.format_exc())
+                return _FailedMessage(body, '%s: %s' % (error.__class__.__name__, error)), False
+            elif method.redelivered:
                 self.log.error('This message is causing persistent problems with the consumer, dropping it: \n%s\n\n'
                                '%s' % (body, traceback.format_exc()))
-                self.channel.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+                return None, False
             else:
                 self.log.error('Unexpected exception raised while calling the consumer callback:\n\n%s\n' %
                                traceback.format_exc())
                 self.log.debug('Message Data: %s\n' % body)
-                self.channel.basic_reject(delivery_tag=method.delivery_tag)
+                return None, True
+    #---
+
+    def _finishMessage(self, method, props, response, requeue, channel = None):
+        """
+        Replies to and acknowledges a processed message, or rejects it if its callback failed.  Must be called from
+        the connection's thread.
+
+        :param method: Method from the consumer callback
+        :type method: pika.amqp_object.Method
+        :param props: Properties from the consumer callback
+        :type props: pika.amqp_object.Properties
+        :param response: What the callback returned
+        :type response: str
+        :param requeue: ``None`` if the callback succeeded, otherwise whether the rejected message should be requeued
+        :type requeue: bool
+        :param channel: The channel the message came in on.  Defaults to the main channel.
+        :type channel: pika.channel.Channel
+
+        """
+        channel = channel or self._channelOf(method)
+
+        if response is _CANCELLED:
+            self._ack(channel, method.delivery_tag)
+            return
+
+        if isinstance(response, _FailedMessage):
+            self._retryMessage(channel, method, props, response)
+            self._ack(channel, method.delivery_tag)
+            return
+
+        if requeue is not None:
+            self._reject(channel, method.delivery_tag, requeue)
             return
 
         # If a response was requested, send it
         if hasattr(props, 'reply_to'):
-            pub_props = pika.BasicProperties(delivery_mode=2, correlation_id=props.correlation_id)
+            # Replies to transient ('fast' durability) calls are transient too, the rest persistent
+            delivery_mode = 1 if getattr(props, 'delivery_mode', None) == 1 else 2
+            pub_props = pika.BasicProperties(delivery_mode=delivery_mode, correlation_id=props.correlation_id)
 
-            self.channel.basic_publish(exchange=self.config['exchange'], routing_key=props.reply_to,
-                                       properties=pub_props, body=callback_response)
+            self._publish(channel, exchange=self.config['exchange'], routing_key=props.reply_to,
+                          properties=pub_props, body=response)
 
         # Tell Rabbit we're done processing the message
-        self.channel.basic_ack(delivery_tag=method.delivery_tag)
+        self._ack(channel, method.delivery_tag)
+    #---
+
+    def _retryMessage(self, channel, method, props, failed):
+        """
+        Publishes a failed message to the delay queue for its next attempt, or to the dead letter exchange once it is
+        out of attempts.  The caller acknowledges the original.
+
+        :param channel: The channel the message came in on
+        :type channel: pika.channel.Channel
+        :param method: Method from the consumer callback
+        :type method: pika.amqp_object.Method
+        :param props: Properties from the consumer callback
+        :type props: pika.amqp_object.Properties
+        :param failed: The failure
+        :type failed: _FailedMessage
+
+        """
+        attempts = retry.attempts(props) + 1
+        headers = dict(getattr(props, 'headers', None) or {})
+        headers[retry.ATTEMPTS_HEADER] = attempts
+
+        if failed.poison or self._retry_policy.exhausted(attempts):
+            headers[retry.ERROR_HEADER] = failed.error
+            exchange = routing.dead_letter_exchange(self.config['queue_name'])
+            routing_key = ''
+            self.stats.increment('dead_lettered_messages')
+        else:
+            queue_name = self._consumer_queues.get(getattr(method, 'consumer_tag', None), self.config['queue_name'])
+            delay = self._retry_policy.delay(attempts)
+            exchange = ''
+            routing_key = routing.retry_queue(queue_name, delay)
+            self.stats.increment('retried_messages')
+
+            if routing_key not in self._retry_queues:
+                channel.queue_declare(queue=routing_key, durable=True,
+                                      arguments=self._retry_policy.queue_arguments(queue_name, delay))
+                self._retry_queues.add(routing_key)
+
+        properties = pika.BasicProperties(headers=headers, delivery_mode=2,
+                                          reply_to=getattr(props, 'reply_to', None),
+                                          correlation_id=getattr(props, 'correlation_id', None),
+                                          priority=getattr(props, 'priority', None))
+        self._publish(channel, exchange=exchange, routing_key=routing_key, properties=properties, body=failed.body)
+    #---
+
+    def _publish(self, channel, **publish_args):
+        """
+        Publishes a message on a channel, through its confirm tracker when publisher confirms are on.
+
+        :param channel: The channel to publish on
+        :type channel: pika.channel.Channel
+        :param publish_args: Arguments for the channel's ``basic_publish``
+        :type publish_args: dict
+
+        """
+        tracker = self._confirms.get(channel)
+
+        if tracker is not None:
+            tracker.publish(**publish_args)
+        elif channel in self._ack_batchers:
+            # Written along with the batch's ack the next time the connection is serviced
+            channels.underlying(channel).basic_publish(**publish_args)
+        else:
+            channel.basic_publish(**publish_args)
+    #---
+
+    def _recordDelivery(self, channel, method):
+        """
+        Records a delivery with its channel's ack batcher, if acks are batched.
+
+        """
+        batcher = self._ack_batchers.get(channel)
+
+        if batcher is not None:
+            batcher.delivered(method.delivery_tag)
+    #---
+
+    def _ack(self, channel, delivery_tag):
+        """
+        Acknowledges a message, in a batch if acks are batched.
+
+        """
+        batcher = self._ack_batchers.get(channel)
+
+        if batcher is not None:
+            batcher.ack(delivery_tag)
+        else:
+            channel.basic_ack(delivery_tag=delivery_tag)
+    #---
+
+    def _reject(self, channel, delivery_tag, requeue):
+        """
+        Rejects a message, keeping its channel's ack batcher in step.
+
+        """
+        batcher = self._ack_batchers.get(channel)
+
+        if batcher is not None:
+            batcher.reject(delivery_tag, requeue)
+        else:
+            channel.basic_reject(delivery_tag=delivery_tag, requeue=requeue)
+    #---
+
+    def _batchAcks(self, channel, prefetch):
+        """
+        Batches a channel's acks, if ack_batch_size is over 1.
+
+        :param channel: The channel
+        :type channel: pika.channel.Channel
+        :param prefetch: The channel's prefetch count
+        :type prefetch: int
+
+        """
+        if self._setting('ack_batch_size') > 1:
+            self._ack_batchers[channel] = acks.AckBatcher(channel, self._setting('ack_batch_size'),
+                                                          self._setting('ack_batch_delay'), prefetch=prefetch,
+                                                          counters=self.stats)
+    #---
+
+    def _trackConfirms(self, channel):
+        """
+        Puts a channel in confirm mode, if publisher confirms are on.
+
+        """
+        options = self._setting('publisher_confirms')
+
+        if options:
+            tracker = confirms.ConfirmTracker(self.connection, channel, counters=self.stats,
+                                              **(options if isinstance(options, dict) else {}))
+            tracker.start()
+            self._confirms[channel] = tracker
     #---
 
     def _connect(self):
@@ -147,10 +950,118 @@ class Consumer(object):
             raise ConnectionError('Failed to connect to RabbitMQ server: %s' %error)
 
         self.channel = self.connection.channel()
-        self.channel.queue_declare(queue=self.config['queue_name'], durable=True)
+        self._trackConfirms(self.channel)
+        self.channel.queue_declare(queue=self.config['queue_name'], durable=True, **self._queueArguments())
 
-        self.channel.basic_qos(prefetch_count=1)
-        self.channel.basic_consume(self._consumerCallback, queue=self.config['queue_name'])
+        if self._adaptive:
+            self._prefetch = self._adaptive.prefetch
+        else:
+            self._prefetch = self._setting('prefetch_count') or self._setting('workers')
+
+        self._batchAcks(self.channel, self._prefetch)
+        self.channel.basic_qos(prefetch_count=self._prefetch)
+        self._consume(self.channel, self._consumerCallback, self.config['queue_name'])
+
+        for queue_name, bindings, declare_args in self._queues:
+            self.channel.queue_declare(queue=queue_name, **dict(self._queueArguments(), **declare_args))
+
+            for exchange, exchange_type, routing_key in bindings:
+                self.channel.exchange_declare(exchange=exchange, exchange_type=exchange_type, durable=True)
+                self.channel.queue_bind(queue=queue_name, exchange=exchange, routing_key=routing_key)
+
+            self._consume(self.channel, self._consumerCallback, queue_name)
+
+        # Further channels consume the same queues, after the main channel has declared them
+        for _ in range(self._setting('channels') - 1):
+            channel = self.connection.channel()
+            self._trackConfirms(channel)
+            self._batchAcks(channel, self._prefetch)
+            channel.basic_qos(prefetch_count=self._prefetch)
+
+            for queue_name in [self.config['queue_name']] + [queue[0] for queue in self._queues]:
+                self._consume(channel, self._consumerCallback, queue_name)
+
+            self._extra_channels.append(channel)
+
+        if self._setting('cancellation'):
+            exchange = routing.cancel_exchange(self.config['queue_name'])
+            self.channel.exchange_declare(exchange=exchange, exchange_type=routing.CANCEL_EXCHANGE_TYPE, durable=True)
+            cancel_queue = self.channel.queue_declare(exclusive=True).method.queue
+            self.channel.queue_bind(queue=cancel_queue, exchange=exchange)
+            self.channel.basic_consume(self._cancelCallback, queue=cancel_queue, no_ack=True)
+
+        # Weighted queues get their own channels too, for their prefetch, but share the worker pool
+        for queue_name, (weight, prefetch_count, _) in sorted(self._weighted_queues.items()):
+            channel = self.connection.channel()
+            self._trackConfirms(channel)
+            self._batchAcks(channel, prefetch_count or self._prefetch)
+            channel.queue_declare(queue=queue_name, durable=True, **self._queueArguments())
+            channel.basic_qos(prefetch_count=prefetch_count or self._prefetch)
+            self._consume(channel, self._consumerCallback, queue_name)
+            self._weighted_queues[queue_name] = (weight, prefetch_count, channel)
+
+        # Each lane gets its own channel, so its prefetch only limits its own queue
+        for lane in self._lanes:
+            lane.channel = self.connection.channel()
+            self._trackConfirms(lane.channel)
+            self._batchAcks(lane.channel, lane.prefetch_count)
+            lane.channel.queue_declare(queue=lane.queue_name, durable=True, **self._queueArguments())
+            lane.channel.basic_qos(prefetch_count=lane.prefetch_count)
+            self._consume(lane.channel, self._laneCallback(lane), lane.queue_name)
+
+        if self._retry_policy:
+            exchange = routing.dead_letter_exchange(self.config['queue_name'])
+            dead_letters = routing.dead_letter_queue(self.config['queue_name'])
+            self.channel.exchange_declare(exchange=exchange, exchange_type=routing.DEAD_LETTER_EXCHANGE_TYPE,
+                                          durable=True)
+            self.channel.queue_declare(queue=dead_letters, durable=True)
+            self.channel.queue_bind(queue=dead_letters, exchange=exchange)
+    #---
+
+    def _consume(self, channel, callback, queue_name):
+        """
+        Starts consuming a queue, remembering which queue and channel the consumer tag belongs to.
+
+        """
+        consumer_tag = channel.basic_consume(callback, queue=queue_name)
+        self._consumer_queues[consumer_tag] = queue_name
+        self._consumer_channels[consumer_tag] = channel
+    #---
+
+    def _channelOf(self, method):
+        """
+        Provides the channel a message came in on, from its consumer tag.  Defaults to the main channel.
+
+        :param method: Method from the consumer callback
+        :type method: pika.amqp_object.Method
+
+        :rtype: pika.channel.Channel
+        """
+        return self._consumer_channels.get(getattr(method, 'consumer_tag', None), self.channel)
+    #---
+
+    def _queueArguments(self):
+        """
+        Provides the extra ``queue_declare`` arguments for the consumer's queues.
+
+        :rtype: dict
+
+        """
+        if self._setting('max_priority') is None:
+            return {}
+
+        return {'arguments': {'x-max-priority': self._setting('max_priority')}}
+    #---
+
+    def _setting(self, name):
+        """
+        Reads an optional setting from the config.
+
+        :param name: Setting name, one of ``OPTIONAL_SETTINGS``
+        :type name: str
+
+        """
+        return self.config.get(name, OPTIONAL_SETTINGS[name])
     #---
 
     def _configureConnection(self):
@@ -0,0 +1,77 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         lanes.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Lanes (bulkheads) for the consumer.  A lane is a queue consumed on its own channel, with its own prefetch and its own
+#   worker pool, so a burst of calls in one lane can't hold up the calls in another.
+#
+
+import Queue
+
+
+class Lane(object):
+    """
+    One lane's settings and runtime state.  The consumer opens the channel and starts the pool.
+
+    """
+    name = None
+    queue_name = None
+    workers = None
+    prefetch_count = None
+    channel = None
+    pool = None
+    completed = None
+
+    def __init__(self, name, queue_name, workers = 1, prefetch_count = None):
+        """
+        Constructor
+
+        :param name: Lane name, used in the metric names
+        :type name: str
+        :param queue_name: The lane's queue
+        :type queue_name: str
+        :param workers: Threads running the lane's calls, i.e. its concurrency limit
+        :type workers: int
+        :param prefetch_count: Unacknowledged messages the broker may push to the lane.  Defaults to `workers`.
+        :type prefetch_count: int
+
+        """
+        self.name = name
+        self.queue_name = queue_name
+        self.workers = workers
+        self.prefetch_count = prefetch_count or workers
+        # Outcomes the lane's workers hand back to the connection thread
+        self.completed = Queue.Queue()
+    #---
+
+    def metric(self, name):
+        """
+        Provides the name of one of the lane's metrics.
+
+        :param name: Metric name, e.g. 'depth'
+        :type name: str
+
+        :rtype: str
+
+        """
+        return 'lane.%s.%s' % (self.name, name)
+    #---
+#---
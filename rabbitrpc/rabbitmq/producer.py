@@ -22,19 +22,70 @@
 # DESCRIPTION:
 #   Implements a RabbitMQ Producer
 #
+#   Calls from several threads can be in flight at once on the one connection.  pika's connection isn't thread-safe,
+#   so a thread only holds it to publish, or to service it while it waits for a reply; the replies that come in are
+#   matched to their calls by correlation id, whichever thread reads them.
+#
 
 import logging
 import pika
 from pika.exceptions import AMQPConnectionError
+from rabbitrpc import admission
+from rabbitrpc import routing
+from rabbitrpc import stats
+from rabbitrpc.rabbitmq import confirms
+import threading
+import time
 import uuid
 
 class ProducerError(Exception): pass
 class ConnectionError(ProducerError): pass
 class ReplyTimeoutError(ProducerError): pass
+class PublishConfirmError(ProducerError): pass
+
+
+# Durability profiles for `send`, with the delivery mode of their messages.  'fast' calls are transient, so the broker
+# keeps them (and the server their replies) in memory only.  'safe' calls are persistent and, with publisher confirms
+# on, confirmed by the broker before `send` goes on to wait for the reply.
+DURABILITY_FAST = 'fast'
+DURABILITY_SAFE = 'safe'
+DURABILITY_PROFILES = {
+    DURABILITY_FAST: 1,
+    DURABILITY_SAFE: 2,
+}
+
+# How long (in seconds) a thread waiting for a reply services the connection at a time, before it lets others
+# publish.  Set 'poll_interval' in the config to change it.
+DEFAULT_POLL_INTERVAL = 0.01
+
+
+class _PendingCall(object):
+    """
+    A call waiting for its reply.
+
+    """
+    correlation_id = None
+    # Time by which the reply is due, and the time the call is hedged at (``None`` not to)
+    deadline = None
+    hedge_at = None
+    # The hedge's correlation id, and the message to send as the hedge
+    hedge_id = None
+    hedge_message = None
+    # The reply, and the correlation id it came under
+    reply = None
+    reply_id = None
+
+    def __init__(self, correlation_id, deadline):
+        self.correlation_id = correlation_id
+        self.deadline = deadline
+        self.replied = threading.Event()
+    #---
+#---
+
 
 class Producer(object):
     """
-    Implements the client side of RPC over RabbitMQ.
+    Implements the client side of RPC over RabbitMQ.  Thread-safe.
 
     """
     connection_params = None
@@ -55,19 +106,36 @@ class Producer(object):
             'password': 'guest',
         }
     }
-    _rpc_reply = None
+    stats = None
     _reply_timeout = None
-
-    def __init__(self, rabbit_config = None):
+    _send_lock = None
+    # correlation id -> _PendingCall, for the calls waiting for a reply (and their hedges)
+    _calls = None
+    _reply_consumer = None
+    # Publisher confirm tracking, when on
+    _confirms = None
+    # Exchanges declared on the current connection
+    _declared_exchanges = None
+
+    def __init__(self, rabbit_config = None, counters = None):
         """
         Constructor
 
         :param rabbit_config: The RabbitMQ config. See
             https://github.com/nwhalen/rabbitrpc/wiki/Data-Structure-Defintions for details.
         :type rabbit_config: dict
+        :param counters: Where to count hedged calls ('hedged_calls', and 'hedge_wins' when the hedge replied first)
+            and cancelled ones ('cancelled_calls').  Defaults to a counter set of its own.
+        :type counters: stats.Counters
 
         """
         self.log = logging.getLogger('rabbitmq.producer')
+        self.stats = counters or stats.Counters()
+        # The connection isn't thread-safe, so threads take turns using it
+        self._send_lock = threading.Lock()
+        self._calls = {}
+        self._declared_exchanges = set()
+
         if rabbit_config:
             self.config.update(rabbit_config)
 
@@ -94,7 +162,8 @@ class Producer(object):
             self.connection.close()
     #---
 
-    def send(self, body_data, expect_reply = True):
+    def send(self, body_data, expect_reply = True, routing_key = None, priority = None, exchange = None,
+             headers = None, hedge_after = None, durability = None):
         """
         Sends an RPC call to the provided queue.
 
@@ -105,65 +174,274 @@ class Producer(object):
         :param expect_reply: Uses a blocking connection and waits for replies if `True`.  Simply sends and forgets
             if `False`.
         :type expect_reply: bool
+        :param routing_key: Sends to this queue instead of the configured one
+        :type routing_key: str
+        :param priority: Message priority, for queues declared with x-max-priority
+        :type priority: int
+        :param exchange: Publishes to this exchange instead of the configured one
+        :type exchange: str
+        :param headers: Message headers
+        :type headers: dict
+        :param hedge_after: Seconds after which a reply-less call is sent again (hedged), the first reply to either
+            being taken.  Only for calls that are safe to run twice.
+        :type hedge_after: float
+        :param durability: The call's durability profile, see ``DURABILITY_PROFILES``.  ``None`` sends a transient
+            message, like 'fast', but leaves the reply persistent.
+        :type durability: str
 
         :return: Un-pickled RPC response data, if expect_reply is `True`.
         """
+        if durability is not None and durability not in DURABILITY_PROFILES:
+            raise ProducerError('Unknown durability profile: %r' % durability)
+
+        with self._send_lock:
+            call = self._send(body_data, expect_reply, routing_key, priority, exchange, headers, hedge_after,
+                              durability)
+
+        if call is None:
+            return
+
+        try:
+            self._replyWaitLoop(call)
+        except ReplyTimeoutError:
+            with self._send_lock:
+                self._cancel(call.correlation_id, call.hedge_id)
+            raise
+        else:
+            if call.hedge_id is not None:
+                with self._send_lock:
+                    self._cancel(*set([call.correlation_id, call.hedge_id]) - set([call.reply_id]))
+        finally:
+            # A late reply to a forgotten call (e.g. the loser of a hedged one) is ignored
+            with self._send_lock:
+                self._calls.pop(call.correlation_id, None)
+                self._calls.pop(call.hedge_id, None)
+
+        return call.reply
+    #---
+
+    def _send(self, body_data, expect_reply, routing_key = None, priority = None, exchange = None, headers = None,
+              hedge_after = None, durability = None):
+        """
+        Publishes a call for `send`.  Must be called with the send lock held.
+
+        :return: The call, to wait for its reply, or ``None`` if no reply is expected
+        :rtype: _PendingCall
+        """
         publish_params = {}
+        property_params = {'priority': priority} if priority is not None else {}
+        property_params['headers'] = self._stamped(headers)
+
+        # The caller waits for the reply until its timeout, or less if it is itself running a call with a deadline
+        deadline = admission.current_deadline()
+        if expect_reply:
+            timeout_at = time.time() + self.config['reply_timeout']
+            deadline = timeout_at if deadline is None else min(deadline, timeout_at)
+
+        if deadline is not None:
+            property_params['headers'][admission.DEADLINE_HEADER] = long(deadline * 1000)
 
+        if durability is not None:
+            property_params['delivery_mode'] = DURABILITY_PROFILES[durability]
+
+        call = None
         if expect_reply:
             self._startReplyConsumer()
             self.correlation_id = str(uuid.uuid4())
-            params = {'properties': pika.BasicProperties(reply_to=self.reply_queue,
-                                                         correlation_id=self.correlation_id)}
-            publish_params.update(params)
+            property_params.update(reply_to=self.reply_queue, correlation_id=self.correlation_id)
+            call = _PendingCall(self.correlation_id, deadline)
+            self._calls[call.correlation_id] = call
 
-        self.channel.basic_publish(exchange=self.config['exchange'], routing_key=self.config['queue_name'],
-                                   body=body_data, **publish_params)
+        publish_params['properties'] = pika.BasicProperties(**property_params)
 
-        if expect_reply:
-            self._replyWaitLoop()
+        exchange = exchange if exchange is not None else self.config['exchange']
+        routing_key = routing_key or self.config['queue_name']
+        self._declareExchange(exchange)
+        # The call is registered before publishing, as waiting for a confirm can read its reply too
+        try:
+            delivery_tag = self._publish(exchange=exchange, routing_key=routing_key, body=body_data, **publish_params)
 
-            reply = self._rpc_reply
-            self._rpc_reply = None
-            return reply
+            # Only this call's confirm is waited for; other messages' failures are for `flush` to report
+            if durability == DURABILITY_SAFE and self._confirms is not None:
+                self._awaitConfirm(self._confirms.waitFor, delivery_tag, self.config['reply_timeout'])
+        except Exception:
+            if call is not None:
+                self._calls.pop(call.correlation_id, None)
+            raise
 
-        return
+        if call is not None and hedge_after is not None:
+            call.hedge_at = time.time() + hedge_after
+            call.hedge_message = (exchange, routing_key, body_data, property_params)
+
+        return call
     #---
 
-    def _startReplyConsumer(self):
+    def flush(self, timeout = None):
         """
-        Starts the RPC reply consumer.
+        Waits until the broker has confirmed every message sent so far.  Does nothing unless 'publisher_confirms' is
+        on in the config.
 
+        :param timeout: Seconds to wait at most, ``None`` for no limit
+        :type timeout: float
+
+        :raises: PublishConfirmError
         """
-        self.channel.basic_consume(self._consumerCallback, queue=self.reply_queue, no_ack=True)
+        if self._confirms is not None:
+            with self._send_lock:
+                self._awaitConfirm(self._confirms.wait, timeout)
     #---
 
-    def _replyWaitLoop(self):
+    def _awaitConfirm(self, wait, *args):
         """
-        Loops until a response is received or the wait timeout elapses.
+        Waits for publisher confirms, reporting a failure as a ProducerError.
+
+        :param wait: The confirm tracker's method to wait with
+        :type wait: callable
+        :param args: Its arguments
+
+        :raises: PublishConfirmError
+        """
+        try:
+            wait(*args)
+        except confirms.ConfirmError as error:
+            raise PublishConfirmError('Publishing was not confirmed: %s' % error)
+    #---
 
+    def _publish(self, **publish_args):
         """
-        timeout_id = self.connection.add_timeout(self.config['reply_timeout'], self._timeoutElapsed)
+        Publishes a message, through the confirm tracker when publisher confirms are on.
+
+        :param publish_args: Arguments for the channel's ``basic_publish``
+        :type publish_args: dict
 
-        while self._rpc_reply is None:
-            self.connection.process_data_events()
+        :return: The message's delivery tag when publisher confirms are on, for waiting on its confirm
+        :rtype: int
+        """
+        if self._confirms is not None:
+            return self._confirms.publish(**publish_args)
 
-        self.connection.remove_timeout(timeout_id)
+        self.channel.basic_publish(**publish_args)
     #---
 
-    def _timeoutElapsed(self):
+    def _declareExchange(self, exchange):
         """
-        Merely a method to raise an exception if the timeout elapses.  It's here because it seems to be impossible
-        to get a reference to a method inside _replyWaitLoop in the tests.
+        Declares the consistent-hash exchange for key-routed calls the first time one is sent.  The servers declare it
+        too, but a call sent before any has started would otherwise have the broker close the channel.  It isn't
+        declared up front, as that needs the broker's consistent-hash plugin.  Must be called with the send lock held.
+
+        :param exchange: The exchange a call is published to
+        :type exchange: str
+
+        """
+        if exchange in self._declared_exchanges or exchange != routing.hash_exchange(self.config['queue_name']):
+            return
+
+        self.channel.exchange_declare(exchange=exchange, exchange_type=routing.HASH_EXCHANGE_TYPE, durable=True)
+        self._declared_exchanges.add(exchange)
+    #---
+
+    def _stamped(self, headers):
+        """
+        Adds the time of publishing to a message's headers, for the server's load shedding (see `admission`).
+
+        :param headers: Message headers
+        :type headers: dict
+
+        :rtype: dict
+        """
+        return dict(headers or {}, **{admission.SENT_AT_HEADER: long(time.time() * 1000)})
+    #---
+
+    def _cancel(self, *call_ids):
+        """
+        Tells the servers the caller has given up on calls, if cancellation is on.
+
+        :param call_ids: The calls' correlation ids.  ``None`` entries are skipped.
+        :type call_ids: str
+
+        """
+        # Set 'cancellation' in the config to cancel calls given up on (timed out, or the slower copy of a hedged call)
+        if not self.config.get('cancellation'):
+            return
+
+        for call_id in call_ids:
+            if call_id is not None:
+                self._publish(exchange=routing.cancel_exchange(self.config['queue_name']), routing_key='', body=call_id)
+                self.stats.increment('cancelled_calls')
+    #---
+
+    def _startReplyConsumer(self):
+        """
+        Starts the RPC reply consumer, unless it is running already.  Must be called with the send lock held.
+
+        """
+        if self._reply_consumer is None:
+            self._reply_consumer = self.channel.basic_consume(self._consumerCallback, queue=self.reply_queue,
+                                                              no_ack=True)
+    #---
+
+    def _replyWaitLoop(self, call):
+        """
+        Loops until the call's reply is received or its wait timeout elapses.  The connection is serviced in short
+        turns, so other threads can publish meanwhile; while another thread services it, this one waits for that
+        thread to hand it its reply.
+
+        :param call: The call waiting for its reply
+        :type call: _PendingCall
 
         :raises: ReplyTimeoutError
         """
-        raise ReplyTimeoutError('Reply timeout of %is elapsed with no response' % self.config['reply_timeout'])
+        poll_interval = self.config.get('poll_interval', DEFAULT_POLL_INTERVAL)
+
+        while not call.replied.is_set():
+            remaining = call.deadline - time.time()
+            if remaining <= 0:
+                raise ReplyTimeoutError('No response by the call\'s deadline (reply timeout %ss)' %
+                                        self.config['reply_timeout'])
+
+            if not self._send_lock.acquire(False):
+                call.replied.wait(min(poll_interval, remaining))
+                continue
+
+            try:
+                self.connection.process_data_events(time_limit=min(poll_interval, remaining))
+
+                if call.hedge_at is not None and time.time() >= call.hedge_at and not call.replied.is_set():
+                    self._sendHedge(call)
+
+                if self._confirms is not None:
+                    self._confirms.resendNacked()
+            finally:
+                self._send_lock.release()
+    #---
+
+    def _sendHedge(self, call):
+        """
+        Sends a call again, under a correlation id of its own.  The reply to the original is still accepted;
+        whichever comes second is ignored.  Must be called with the send lock held.
+
+        :param call: The call to hedge
+        :type call: _PendingCall
+
+        """
+        # The call may be hedged already
+        if call.hedge_message is None:
+            return
+
+        exchange, routing_key, body_data, property_params = call.hedge_message
+        call.hedge_message = call.hedge_at = None
+        call.hedge_id = str(uuid.uuid4())
+        self._calls[call.hedge_id] = call
+
+        properties = pika.BasicProperties(**dict(property_params, correlation_id=call.hedge_id,
+                                                 headers=self._stamped(property_params['headers'])))
+        self._publish(exchange=exchange, routing_key=routing_key, body=body_data, properties=properties)
+        self.stats.increment('hedged_calls')
     #---
 
     def _consumerCallback(self, ch, method, props, body):
         """
-        Accepts the response to a an RPC call.
+        Accepts the response to a an RPC call, and hands it to the thread waiting for it.
 
         :param ch: Channel
         :type ch: object
@@ -173,8 +451,18 @@ class Producer(object):
         :type props: object
 
         """
-        if props.correlation_id == self.correlation_id:
-            self._rpc_reply = body
+        call = self._calls.get(props.correlation_id)
+
+        # Replies to calls given up on, or to the slower copy of a hedged call, are dropped
+        if call is None or call.replied.is_set():
+            return
+
+        call.reply = body
+        call.reply_id = props.correlation_id
+        if props.correlation_id == call.hedge_id:
+            self.stats.increment('hedge_wins')
+
+        call.replied.set()
     #---
 
     def _connect(self):
@@ -194,10 +482,23 @@ class Producer(object):
             raise ConnectionError('Failed to connect to RabbitMQ server: %s' %error)
 
         self.channel = self.connection.channel()
+        self._declared_exchanges = set()
+
+        # Set 'publisher_confirms' in the config to True, or to a dict of confirms.ConfirmTracker arguments, to have
+        # the broker confirm every message (see `confirms`)
+        if self.config.get('publisher_confirms'):
+            options = self.config['publisher_confirms']
+            self._confirms = confirms.ConfirmTracker(self.connection, self.channel, counters=self.stats,
+                                                     **(options if isinstance(options, dict) else {}))
+            self._confirms.start()
 
         # Creates a unique reply queue for just this connection (thus the exclusive)
         result = self.channel.queue_declare(exclusive=True, **queue_params)
         self.reply_queue = result.method.queue
+
+        if self.config.get('cancellation'):
+            self.channel.exchange_declare(exchange=routing.cancel_exchange(self.config['queue_name']),
+                                          exchange_type=routing.CANCEL_EXCHANGE_TYPE, durable=True)
     #---
 
     def _configureConnection(self):
@@ -0,0 +1,129 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         retry.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Retry policy for messages whose callback failed.
+#
+#   Without one the consumer requeues a failed message once, straight back to itself, and drops it if it fails again.
+#   With one (the consumer's 'retry' setting) a failed message is acknowledged and published to a delay queue, which
+#   holds it for an exponentially growing delay and then dead-letters it back to the queue it came from.  The attempts
+#   so far travel in the ATTEMPTS_HEADER header.  Once they run out, or straight away for messages that can't be
+#   decoded, the message goes to the dead letter exchange (see `routing`) for someone to look at.
+#
+
+
+# Header with the number of times a message has failed
+ATTEMPTS_HEADER = 'x-attempts'
+# Header with the last failure of a dead-lettered message
+ERROR_HEADER = 'x-last-error'
+
+
+class RetryPolicy(object):
+    """
+    How many times, and after what delays, failed messages are tried again.
+
+    """
+    max_attempts = None
+    base_delay = None
+    multiplier = None
+    max_delay = None
+
+    def __init__(self, max_attempts = 5, base_delay = 1.0, multiplier = 2.0, max_delay = 300.0):
+        """
+        Constructor
+
+        :param max_attempts: Failures after which a message is dead-lettered
+        :type max_attempts: int
+        :param base_delay: Seconds before the first retry
+        :type base_delay: float
+        :param multiplier: Growth of the delay with each further failure
+        :type multiplier: float
+        :param max_delay: Longest delay, in seconds
+        :type max_delay: float
+
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+    #---
+
+    def exhausted(self, attempts):
+        """
+        Whether a message that failed this many times is out of attempts.
+
+        :param attempts: Failures so far, the latest one included
+        :type attempts: int
+
+        :rtype: bool
+        """
+        return attempts >= self.max_attempts
+    #---
+
+    def delay(self, attempts):
+        """
+        Provides the delay before a message that failed this many times is tried again.
+
+        :param attempts: Failures so far, the latest one included
+        :type attempts: int
+
+        :return: Seconds
+        :rtype: float
+        """
+        return min(self.max_delay, self.base_delay * self.multiplier ** (attempts - 1))
+    #---
+
+    def queue_arguments(self, queue, delay):
+        """
+        Provides the ``queue_declare`` arguments of a delay queue.
+
+        :param queue: The queue the messages go back to
+        :type queue: str
+        :param delay: Seconds the messages are held for
+        :type delay: float
+
+        :rtype: dict
+        """
+        return {
+            'x-message-ttl': int(delay * 1000),
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': queue,
+        }
+    #---
+#---
+
+
+def attempts(props):
+    """
+    Provides the number of times a message has failed before.
+
+    :param props: The message's properties
+    :type props: pika.spec.BasicProperties
+
+    :rtype: int
+    """
+    headers = getattr(props, 'headers', None)
+
+    if not isinstance(headers, dict):
+        return 0
+
+    return headers.get(ATTEMPTS_HEADER, 0)
+#---
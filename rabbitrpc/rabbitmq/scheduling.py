@@ -0,0 +1,425 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         scheduling.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Schedulers deciding which delivered message the consumer's worker pool runs next.
+#
+#   DeficitRoundRobin shares the pool between several queues by weight: each round, a queue with work waiting may
+#   start up to `weight` messages (fractions carry over to the next round), and a queue without work waiting gives its
+#   turn up, so its share goes to the others instead of being held idle.
+#
+#   WeightedFairQueue shares it between flows that come and go, such as the tenants calling a server (named by the
+#   client in TENANT_HEADER): a flow flooding the server with calls only lengthens its own wait, not everyone else's.
+#   Flows may also be capped at a number of items running at once.
+#
+#   EarliestDeadlineFirst runs the calls whose callers need their reply soonest first (see admission.DEADLINE_HEADER),
+#   and gives up the calls too close to their deadline to make it, rather than spend a worker on a reply nobody waits
+#   for.
+#
+#   All of them work over the window of messages the consumer holds (its prefetch), so that window needs to be larger
+#   than the worker pool for the scheduler to have a choice.
+#
+
+import collections
+import heapq
+import time
+
+
+# Header with the identity of the tenant a call is made for
+TENANT_HEADER = 'x-tenant'
+# Tenant of the calls without one
+UNKNOWN_TENANT = 'unknown'
+
+
+class DeficitRoundRobin(object):
+    """
+    Deficit round robin over named queues of items, each item costing 1.  Not thread-safe.
+
+    """
+
+    def __init__(self):
+        """
+        Constructor
+
+        """
+        self._queues = {}
+        self._weights = {}
+        self._deficits = {}
+        # Names of the queues with items, in turn order
+        self._active = collections.deque()
+    #---
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+    #---
+
+    def add(self, name, weight = 1):
+        """
+        Adds a queue.
+
+        :param name: Queue name
+        :type name: str
+        :param weight: Items the queue may take per round, relative to the others
+        :type weight: float
+
+        """
+        if weight <= 0:
+            raise ValueError('The weight of queue %s must be positive, not %r' % (name, weight))
+
+        self._queues[name] = collections.deque()
+        self._weights[name] = weight
+        self._deficits[name] = 0
+    #---
+
+    def backlog(self, name):
+        """
+        Provides the number of items waiting in a queue.
+
+        :param name: Queue name
+        :type name: str
+
+        :rtype: int
+        """
+        return len(self._queues[name])
+    #---
+
+    def push(self, name, item):
+        """
+        Adds an item to a queue.
+
+        :param name: Queue name
+        :type name: str
+        :param item: The item
+
+        """
+        queue = self._queues[name]
+
+        if not queue:
+            self._active.append(name)
+            self._deficits[name] = self._weights[name]
+
+        queue.append(item)
+    #---
+
+    def pop(self):
+        """
+        Takes the next item.
+
+        :return: (queue name, item), or ``None`` when every queue is empty
+        :rtype: tuple
+        """
+        while self._active:
+            name = self._active[0]
+
+            if self._deficits[name] < 1:
+                # Its turn is over: it waits for the next round, with a fresh quantum
+                self._active.rotate(-1)
+                self._deficits[name] += self._weights[name]
+                continue
+
+            queue = self._queues[name]
+            self._deficits[name] -= 1
+            item = queue.popleft()
+
+            # An emptied queue leaves the rounds, and keeps no credit for when it is back
+            if not queue:
+                self._active.popleft()
+                self._deficits[name] = 0
+
+            return name, item
+
+        return None
+    #---
+
+    def done(self, name):
+        """
+        Records that an item taken from a queue has finished.  Nothing to do for round robin.
+
+        """
+    #---
+#---
+
+
+class WeightedFairQueue(object):
+    """
+    Self-clocked weighted fair queuing over flows of items, each item costing 1.  Not thread-safe.
+
+    Each item is tagged with the virtual time its flow would finish it by, were every busy flow served at its
+    weight, and the item with the earliest tag goes next.  Flows are created on their first item and forgotten once
+    they hold nothing and have nothing running.
+
+    """
+
+    def __init__(self, weights = None, default_weight = 1, max_running = None, default_max_running = None):
+        """
+        Constructor
+
+        :param weights: flow name -> weight, for the flows not weighted `default_weight`
+        :type weights: dict
+        :param default_weight: Weight of the other flows
+        :type default_weight: float
+        :param max_running: flow name -> most items it may have running at once, for the flows not capped at
+            `default_max_running`
+        :type max_running: dict
+        :param default_max_running: Cap of the other flows, ``None`` for no cap.  A capped flow's items stay here
+            until they can run, so when the items come from a bounded window (a prefetch) a capped flow can fill it.
+        :type default_max_running: int
+
+        """
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.max_running = max_running or {}
+        self.default_max_running = default_max_running
+
+        self._virtual_time = 0.0
+        # flow name -> deque of (finish tag, item), the finish tag of its last item, and its items running
+        self._flows = {}
+        self._last_finish = {}
+        self._running = collections.defaultdict(int)
+        # (finish tag, sequence, flow name) of the first item of each flow with items
+        self._heads = []
+        self._sequence = 0
+    #---
+
+    def __len__(self):
+        return sum(len(flow) for flow in self._flows.values())
+    #---
+
+    def backlog(self, name):
+        """
+        Provides the number of items waiting in a flow.
+
+        :param name: Flow name
+        :type name: str
+
+        :rtype: int
+        """
+        return len(self._flows.get(name, ()))
+    #---
+
+    def push(self, name, item):
+        """
+        Adds an item to a flow.
+
+        :param name: Flow name
+        :type name: str
+        :param item: The item
+
+        """
+        flow = self._flows.setdefault(name, collections.deque())
+        weight = self.weights.get(name, self.default_weight)
+        finish = max(self._virtual_time, self._last_finish.get(name, 0.0)) + 1.0 / weight
+        self._last_finish[name] = finish
+        flow.append((finish, item))
+
+        if len(flow) == 1:
+            self._pushHead(name)
+    #---
+
+    def pop(self):
+        """
+        Takes the item with the earliest finish tag, from the flows under their cap.
+
+        :return: (flow name, item), or ``None`` when no flow under its cap has items
+        :rtype: tuple
+        """
+        capped = []
+        scheduled = None
+
+        while self._heads:
+            head = heapq.heappop(self._heads)
+            name = head[2]
+
+            cap = self.max_running.get(name, self.default_max_running)
+            if cap is not None and self._running.get(name, 0) >= cap:
+                capped.append(head)
+                continue
+
+            flow = self._flows[name]
+            finish, item = flow.popleft()
+            self._virtual_time = finish
+            self._running[name] += 1
+
+            if flow:
+                self._pushHead(name)
+            else:
+                del self._flows[name]
+
+            scheduled = (name, item)
+            break
+
+        for head in capped:
+            heapq.heappush(self._heads, head)
+
+        return scheduled
+    #---
+
+    def done(self, name):
+        """
+        Records that an item taken from a flow has finished, making room under its cap.
+
+        :param name: Flow name
+        :type name: str
+
+        """
+        self._running[name] -= 1
+
+        if self._running[name] <= 0:
+            del self._running[name]
+
+            # Nothing waiting and no credit left: the flow can go
+            if name not in self._flows and self._last_finish.get(name, 0.0) <= self._virtual_time:
+                self._last_finish.pop(name, None)
+    #---
+
+    def _pushHead(self, name):
+        """
+        Queues a flow's first item for its turn.
+
+        """
+        self._sequence += 1
+        heapq.heappush(self._heads, (self._flows[name][0][0], self._sequence, name))
+    #---
+#---
+
+
+class EarliestDeadlineFirst(object):
+    """
+    Earliest deadline first over items.  Not thread-safe.
+
+    Items without a deadline are given one `default_timeout` after they were added, so they are neither run ahead of
+    every call with a deadline nor held back behind them for good, but they are never given up.
+
+    """
+
+    def __init__(self, min_remaining = 0.0, default_timeout = 5.0, clock = time.time):
+        """
+        Constructor
+
+        :param min_remaining: Seconds an item needs left before its deadline to be worth starting, e.g. about the time
+            a call takes.  Items with less are given up by `expired`.
+        :type min_remaining: float
+        :param default_timeout: Seconds after which items without a deadline are due
+        :type default_timeout: float
+        :param clock: Provides the current time, in seconds since the epoch
+        :type clock: func
+
+        """
+        self.min_remaining = min_remaining
+        self.default_timeout = default_timeout
+        self._clock = clock
+
+        # (deadline the item is ordered by, sequence, name, item, whether the deadline is its own)
+        self._items = []
+        self._backlogs = collections.defaultdict(int)
+        self._sequence = 0
+    #---
+
+    def __len__(self):
+        return len(self._items)
+    #---
+
+    def backlog(self, name):
+        """
+        Provides the number of items waiting under a name.
+
+        :param name: Name the items were added under
+        :type name: str
+
+        :rtype: int
+        """
+        return self._backlogs.get(name, 0)
+    #---
+
+    def push(self, name, item, deadline = None):
+        """
+        Adds an item.
+
+        :param name: Name the item is added under, for `backlog`
+        :type name: str
+        :param item: The item
+        :param deadline: Time by which the item needs to be finished, in seconds since the epoch, ``None`` if it has
+            none
+        :type deadline: float
+
+        """
+        own = deadline is not None
+        if not own:
+            deadline = self._clock() + self.default_timeout
+
+        self._sequence += 1
+        self._backlogs[name] += 1
+        heapq.heappush(self._items, (deadline, self._sequence, name, item, own))
+    #---
+
+    def pop(self):
+        """
+        Takes the item with the earliest deadline.
+
+        :return: (name, item), or ``None`` when there are no items
+        :rtype: tuple
+        """
+        if not self._items:
+            return None
+
+        _, _, name, item, _ = heapq.heappop(self._items)
+        self._taken(name)
+
+        return name, item
+    #---
+
+    def expired(self):
+        """
+        Takes the items with their own deadline that are too close to it (or past it) to be worth starting.
+
+        :return: (name, item) of each, earliest deadline first
+        :rtype: list
+        """
+        expired = []
+        # Items with a deadline from `default_timeout` don't expire, and may hide expired ones behind them for a while
+        last_start = self._clock() + self.min_remaining
+
+        while self._items and self._items[0][0] < last_start and self._items[0][4]:
+            _, _, name, item, _ = heapq.heappop(self._items)
+            self._taken(name)
+            expired.append((name, item))
+
+        return expired
+    #---
+
+    def done(self, name):
+        """
+        Records that an item has finished.  Nothing to do for deadline order.
+
+        """
+    #---
+
+    def _taken(self, name):
+        """
+        Counts an item out of its name's backlog.
+
+        """
+        self._backlogs[name] -= 1
+
+        if self._backlogs[name] <= 0:
+            del self._backlogs[name]
+    #---
+#---
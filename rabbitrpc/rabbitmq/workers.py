@@ -0,0 +1,180 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         workers.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Thread pool used by the consumer to run message callbacks off the connection thread.
+#
+#   Tasks submitted with a key run one at a time, in the order they were submitted, while tasks with different keys
+#   (and tasks without one) run in parallel.  The later tasks for a busy key are parked until the one running finishes.
+#
+#   The pool can be resized while it runs.  Shrinking queues a stop for each surplus thread behind the tasks already
+#   queued, so no task is dropped.
+#
+
+import collections
+import itertools
+import logging
+import Queue
+import threading
+
+
+class WorkerPool(object):
+    """
+    A set of threads that feed submitted tasks to a handler.
+
+    """
+    size = None
+    handler = None
+
+    def __init__(self, size, handler, name = 'rabbitrpc-worker'):
+        """
+        Constructor.  Starts the worker threads.
+
+        :param size: Number of worker threads
+        :type size: int
+        :param handler: Called with each submitted task, from a worker thread.  It should not raise.
+        :type handler: func
+        :param name: Prefix for the thread names
+        :type name: str
+
+        """
+        self.log = logging.getLogger('rabbitmq.workers')
+        self.size = 0
+        self.handler = handler
+        self.name = name
+
+        self._tasks = Queue.Queue()
+        self._threads = []
+        # key -> parked tasks, for each key with a task queued or running
+        self._keys = {}
+        self._keys_lock = threading.Lock()
+
+        self.resize(size)
+    #---
+
+    def resize(self, size):
+        """
+        Changes the number of worker threads.  New threads start at once; surplus threads stop once they reach the
+        end of the tasks already queued.
+
+        :param size: Number of worker threads
+        :type size: int
+
+        """
+        # Stopped threads are forgotten and their names reused, so a pool resized often doesn't grow either
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+
+        while self.size < size:
+            names = set(thread.name for thread in self._threads)
+            name = next(name for name in ('%s-%i' % (self.name, number) for number in itertools.count())
+                        if name not in names)
+            thread = threading.Thread(target=self._workerLoop, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+            self.size += 1
+
+        while self.size > size:
+            self._tasks.put(None)
+            self.size -= 1
+    #---
+
+    def submit(self, task, key = None):
+        """
+        Queues a task for the next free worker.
+
+        :param task: Passed to the handler as-is
+        :param key: Tasks with the same key run one at a time, in submission order
+        :type key: str
+
+        """
+        if key is not None:
+            with self._keys_lock:
+                if key in self._keys:
+                    self._keys[key].append(task)
+                    return
+
+                self._keys[key] = collections.deque()
+
+        self._tasks.put((key, task))
+    #---
+
+    def backlog(self):
+        """
+        Provides the number of submitted tasks no worker has started yet, parked ones included.
+
+        :rtype: int
+
+        """
+        with self._keys_lock:
+            parked = sum(len(tasks) for tasks in self._keys.values())
+
+        return self._tasks.qsize() + parked
+    #---
+
+    def stop(self):
+        """
+        Stops the workers once they have finished the tasks already queued.
+
+        """
+        self.resize(0)
+        self._threads = []
+    #---
+
+    def _workerLoop(self):
+        """
+        Runs tasks until told to stop.
+
+        """
+        while True:
+            item = self._tasks.get()
+
+            if item is None:
+                return
+
+            key, task = item
+
+            try:
+                self.handler(task)
+            except Exception:
+                self.log.exception('Unhandled exception in worker thread')
+            finally:
+                if key is not None:
+                    self._releaseKey(key)
+    #---
+
+    def _releaseKey(self, key):
+        """
+        Queues the next parked task for a key whose task just finished, or forgets the key if there is none.
+
+        """
+        with self._keys_lock:
+            parked = self._keys[key]
+
+            if not parked:
+                del self._keys[key]
+                return
+
+            task = parked.popleft()
+
+        self._tasks.put((key, task))
+    #---
+#---
@@ -0,0 +1,244 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         routing.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Decides which queue a call is sent to.  Client and server both read the 'routing' setting of the RabbitMQ config:
+#
+#   * 'shared' (the default): every call goes to the config's queue_name.
+#   * 'module': calls go to a queue per module, '<queue_name>.<module>'.  Servers consume the queues of the modules
+#     they host, so modules can be scaled and isolated independently.  Internal calls still use queue_name.
+#
+#   Calls to endpoints registered with a `lane` go to that lane's queue, '<queue_name>.lane.<lane>', in either mode.
+#
+#   Calls to endpoints registered with `route_by` are published to the consistent-hash exchange '<queue_name>.hash'
+#   (RabbitMQ's rabbitmq_consistent_hash_exchange plugin), with the value of the named argument as the routing key.
+#   Each server binds its instance queue to it, so calls with the same key land on the same server process, and only
+#   the keys of a joining or leaving process move.
+#
+#   Cancellations (see `cancellation`) are published to the fanout exchange '<queue_name>.cancel', which every server
+#   consumer binds a queue of its own to.
+#
+#   Consumers with a retry policy (see rabbitmq.retry) send failed messages to delay queues, '<queue>.retry.<ms>', that
+#   hand them back to their queue once the delay is up, and messages out of attempts to the exchange
+#   '<queue_name>.dlx', whose queue is '<queue_name>.dead'.
+#
+
+import hashlib
+
+
+class RoutingError(Exception): pass
+
+
+SHARED = 'shared'
+MODULE = 'module'
+
+# Same default as the producer and consumer configs
+DEFAULT_QUEUE_NAME = 'rabbitrpc'
+
+HASH_EXCHANGE_TYPE = 'x-consistent-hash'
+CANCEL_EXCHANGE_TYPE = 'fanout'
+DEAD_LETTER_EXCHANGE_TYPE = 'fanout'
+# A server's share of the hash ring.  The 'hash_weight' config setting overrides it.
+DEFAULT_HASH_WEIGHT = 10
+# AMQP routing keys are short strings
+_MAX_ROUTING_KEY = 255
+
+# Header carrying the ordering key of calls to endpoints registered with `order_by`.  Servers running calls concurrently
+# run the calls with the same key one at a time, in delivery order (see rabbitmq.workers).
+ORDER_KEY_HEADER = 'x-order-key'
+
+
+def routing_mode(rabbit_config):
+    """
+    Provides the routing mode set in a RabbitMQ config.
+
+    :param rabbit_config: The RabbitMQ config
+    :type rabbit_config: dict
+
+    :rtype: str
+
+    """
+    mode = rabbit_config.get('routing', SHARED)
+
+    if mode not in (SHARED, MODULE):
+        raise RoutingError('Unknown routing mode %r, expected %r or %r' % (mode, SHARED, MODULE))
+
+    return mode
+#---
+
+def queue_name(rabbit_config):
+    """
+    Provides the main queue's name from a RabbitMQ config.
+
+    :param rabbit_config: The RabbitMQ config
+    :type rabbit_config: dict
+
+    :rtype: str
+
+    """
+    return rabbit_config.get('queue_name', DEFAULT_QUEUE_NAME)
+#---
+
+def module_queue(queue, module):
+    """
+    Provides the name of a module's queue.
+
+    :param queue: The main queue's name
+    :type queue: str
+    :param module: Short module name
+    :type module: str
+
+    :rtype: str
+
+    """
+    return '%s.%s' % (queue, module)
+#---
+
+def lane_queue(queue, lane):
+    """
+    Provides the name of a lane's queue.
+
+    :param queue: The main queue's name
+    :type queue: str
+    :param lane: Lane name
+    :type lane: str
+
+    :rtype: str
+
+    """
+    return '%s.lane.%s' % (queue, lane)
+#---
+
+def hash_exchange(queue):
+    """
+    Provides the name of the consistent-hash exchange for key-routed calls.
+
+    :param queue: The main queue's name
+    :type queue: str
+
+    :rtype: str
+
+    """
+    return '%s.hash' % queue
+#---
+
+def cancel_exchange(queue):
+    """
+    Provides the name of the exchange call cancellations are published to.
+
+    :param queue: The main queue's name
+    :type queue: str
+
+    :rtype: str
+
+    """
+    return '%s.cancel' % queue
+#---
+
+def retry_queue(queue, delay):
+    """
+    Provides the name of the queue holding messages from a queue until they are retried.
+
+    :param queue: The queue the messages came from, and go back to
+    :type queue: str
+    :param delay: Seconds the messages are held for
+    :type delay: float
+
+    :rtype: str
+
+    """
+    return '%s.retry.%i' % (queue, int(delay * 1000))
+#---
+
+def dead_letter_exchange(queue):
+    """
+    Provides the name of the exchange messages that ran out of attempts are published to.
+
+    :param queue: The main queue's name
+    :type queue: str
+
+    :rtype: str
+
+    """
+    return '%s.dlx' % queue
+#---
+
+def dead_letter_queue(queue):
+    """
+    Provides the name of the queue holding messages that ran out of attempts.
+
+    :param queue: The main queue's name
+    :type queue: str
+
+    :rtype: str
+
+    """
+    return '%s.dead' % queue
+#---
+
+def hash_routing_key(value):
+    """
+    Turns a call's key into a routing key for the consistent-hash exchange.  Keys too long for a routing key are
+    replaced by their digest.
+
+    :param value: The value of the call's key argument
+
+    :rtype: str
+
+    """
+    if isinstance(value, unicode):
+        key = value.encode('utf-8')
+    else:
+        key = str(value)
+
+    if len(key) > _MAX_ROUTING_KEY:
+        key = hashlib.sha1(key).hexdigest()
+
+    return key
+#---
+
+def call_argument(args_definition, varargs, kwargs, name):
+    """
+    Finds the value a call passes for a named argument, falling back to the argument's default.
+
+    :param args_definition: The endpoint's 'args' definition (see register.RPCFunction)
+    :type args_definition: dict
+    :param varargs: The call's positional arguments
+    :type varargs: tuple
+    :param kwargs: The call's keyword arguments
+    :type kwargs: dict
+    :param name: The argument's name
+    :type name: str
+
+    :return: The argument's value, or ``None`` if the call does not pass it and it has no default
+
+    """
+    if kwargs and name in kwargs:
+        return kwargs[name]
+
+    defined = (args_definition or {}).get('defined') or {}
+    positional = defined.get('var') or []
+
+    if name in positional and positional.index(name) < len(varargs or ()):
+        return varargs[positional.index(name)]
+
+    return (defined.get('kw') or {}).get(name)
+#---
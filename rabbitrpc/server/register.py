@@ -25,37 +25,165 @@
 
 import collections
 from . import rpcserver
+from rabbitrpc.rabbitmq import producer
 import inspect
 
 
-def RPCFunction(function):
+class RegistrationError(Exception): pass
+
+
+# Endpoint options whose value names one of the function's arguments
+_ARGUMENT_OPTIONS = ('route_by', 'order_by')
+# Endpoint options that would hand one constructor call's remote object to several clients (or create it twice)
+_SHARED_RESULT_OPTIONS = ('cache_ttl', 'coalesce', 'delta', 'idempotent')
+
+
+def RPCFunction(function = None, **options):
     """
-    Decorator to register a function as an RPC function.
+    Decorator to register a function as an RPC function.  It may be applied bare (``@RPCFunction``) or with endpoint
+    options (``@RPCFunction(cache_ttl=30)``).  See ``rpcserver.ENDPOINT_OPTIONS`` for the available options.
 
     :param function:  Incoming function to register
+    :param options: Endpoint options for this function
 
     :rtype: func
 
+    """
+    if function is None:
+        return lambda func: RPCFunction(func, **options)
+
+    _check_options(function.__name__, options)
+    args = _describe_args(function)
+    _check_argument_options(function.__name__, args, options)
+
+    # We're not interested in the full path
+    stripped_module = function.__module__.split('.')[-1]
+    function_definition = {
+        stripped_module: {
+            function.__name__: dict(args=args, doc=_describe_doc(function), options=options)
+        }
+    }
+
+    rpcserver.RPCServer.register_definition(function_definition, {stripped_module: function.__module__})
+
+    return function
+#---
+
+def RPCClass(cls = None, **options):
+    """
+    Decorator to register a class for remote objects.  Calling the class on a client creates an instance in the server
+    process that handles the call, and returns a proxy whose (public) method calls run on that instance.  Like
+    `RPCFunction` it may be applied bare or with endpoint options, e.g. ``@RPCClass(object_ttl=300)``.  Options that
+    share a call's result between callers, or run it twice, are refused, as each call must create an object of its own.
+
+    :param cls:  Incoming class to register
+    :param options: Endpoint options for the class' constructor
+
+    :rtype: type
+
+    :raises: RegistrationError
+    """
+    if cls is None:
+        return lambda klass: RPCClass(klass, **options)
+
+    _check_options(cls.__name__, options)
+
+    shared_options = [option for option in _SHARED_RESULT_OPTIONS if options.get(option)]
+    if shared_options:
+        raise RegistrationError('Endpoint option(s) %s can\'t be used for class %s, whose instances are per client' %
+                                (', '.join(shared_options), cls.__name__))
+
+    # object.__init__ and other slot wrappers can't be inspected, and take no arguments anyway
+    constructor_args = None
+    if inspect.ismethod(cls.__init__):
+        constructor_args = _describe_args(cls.__init__, bound=True)
+
+    methods = {}
+    for name, method in inspect.getmembers(cls, inspect.ismethod):
+        if not name.startswith('_'):
+            methods[name] = dict(args=_describe_args(method, bound=True), doc=_describe_doc(method))
+
+    stripped_module = cls.__module__.split('.')[-1]
+    class_definition = {
+        stripped_module: {
+            cls.__name__: dict(args=constructor_args, doc=_describe_doc(cls), options=options, methods=methods)
+        }
+    }
+
+    rpcserver.RPCServer.register_definition(class_definition, {stripped_module: cls.__module__})
+
+    return cls
+#---
+
+def _check_options(name, options):
+    """
+    Refuses endpoint options the server does not know about.
+
+    :param name: Name of the function or class being registered
+    :type name: str
+    :param options: Its endpoint options
+    :type options: dict
+
+    """
+    unknown_options = set(options) - set(rpcserver.ENDPOINT_OPTIONS)
+    if unknown_options:
+        raise RegistrationError('Unknown endpoint option(s) for %s: %s' % (name, ', '.join(sorted(unknown_options))))
+
+    if options.get('durability') is not None and options['durability'] not in producer.DURABILITY_PROFILES:
+        raise RegistrationError('Unknown durability profile for %s: %r' % (name, options['durability']))
+#---
+
+def _check_argument_options(name, args, options):
+    """
+    Refuses endpoint options that name an argument the function does not have.
+
+    :param name: Name of the function being registered
+    :type name: str
+    :param args: Its argument definition
+    :type args: dict
+    :param options: Its endpoint options
+    :type options: dict
+
+    """
+    defined = ((args or {}).get('defined') or {})
+    arg_names = set(defined.get('var') or []) | set(defined.get('kw') or {})
+
+    for option in _ARGUMENT_OPTIONS:
+        if options.get(option) and options[option] not in arg_names:
+            raise RegistrationError('%s=%r for %s does not name one of its arguments' % (option, options[option], name))
+#---
+
+def _describe_args(function, bound = False):
+    """
+    Reads a function's args and arranges them into a format that's easy to use on the other side.
+
+    :param function: The function (or method)
+    :type function: func
+    :param bound: Leave out the first argument (`self`) of a method
+    :type bound: bool
+
+    :return: The argument definition, or ``None`` if the function takes no arguments
+    :rtype: dict
+
     """
     kwargs = None
     varargs = None
-    docs = None
 
-    # Reads the function's args and arranges them into a format that's easy to use on the other side
     argspec = inspect.getargspec(function)
+    arg_names = argspec.args[1:] if bound else argspec.args
 
     if argspec.defaults:
-        num_args = len(argspec.args)
+        num_args = len(arg_names)
         kwargs_start = num_args - len(argspec.defaults)
 
         # Only keyword args
         if kwargs_start == num_args:
-            kwargs = dict(zip(argspec.args,argspec.defaults))
+            kwargs = dict(zip(arg_names,argspec.defaults))
         else:
-            varargs = argspec.args[:kwargs_start]
-            kwargs = dict(zip(argspec.args[kwargs_start:],argspec.defaults))
-    elif argspec.args:
-        varargs = argspec.args
+            varargs = arg_names[:kwargs_start]
+            kwargs = dict(zip(arg_names[kwargs_start:],argspec.defaults))
+    elif arg_names:
+        varargs = arg_names
 
     if not varargs and not kwargs:
         defined_args = None
@@ -64,22 +192,18 @@ def RPCFunction(function):
 
     # :(
     if defined_args is None and argspec.keywords is None and argspec.varargs is None:
-        args = None
-    else:
-        args = {'defined': defined_args, 'kwargs_var': argspec.keywords, 'varargs_var': argspec.varargs}
+        return None
 
-    if function.__doc__:
-        docs = inspect.cleandoc(function.__doc__)
+    return {'defined': defined_args, 'kwargs_var': argspec.keywords, 'varargs_var': argspec.varargs}
+#---
 
-    # We're not interested in the full path
-    stripped_module = function.__module__.split('.')[-1]
-    function_definition = {
-        stripped_module: {
-            function.__name__: dict(args=args, doc=docs)
-        }
-    }
+def _describe_doc(obj):
+    """
+    Provides an object's cleaned-up docstring, or ``None``.
 
-    rpcserver.RPCServer.register_definition(function_definition, {stripped_module: function.__module__})
+    """
+    if obj.__doc__:
+        return inspect.cleandoc(obj.__doc__)
 
-    return function
-#---
\ No newline at end of file
+    return None
+#---
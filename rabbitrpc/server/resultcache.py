@@ -0,0 +1,155 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         resultcache.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Size-bounded LRU cache for encoded RPC results.
+#
+
+import collections
+import threading
+import time
+
+
+class ResultCache(object):
+    """
+    In-process LRU cache of encoded (string) values.  The cache is bounded by the total length of the stored values
+    rather than by entry count, and entries may expire after a TTL.
+
+    """
+    max_bytes = None
+    ttl = None
+    size = 0
+    hits = 0
+    misses = 0
+
+    def __init__(self, max_bytes, ttl = None):
+        """
+        Constructor
+
+        :param max_bytes: Upper bound on the summed length of all cached values
+        :type max_bytes: int
+        :param ttl: Default time-to-live for entries, in seconds.  ``None`` means entries only leave via eviction.
+        :type ttl: float
+
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+    #---
+
+    def __len__(self):
+        return len(self._entries)
+    #---
+
+    def get(self, key):
+        """
+        Fetches a value and marks it as most recently used.
+
+        :param key: Cache key
+
+        :return: The cached value, or ``None`` if it is missing or expired
+        :rtype: str
+
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                self.size -= len(value)
+                self.misses += 1
+                return None
+
+            self._entries[key] = entry
+            self.hits += 1
+
+            return value
+    #---
+
+    def set(self, key, value, ttl = None):
+        """
+        Stores a value, evicting least recently used entries until the cache fits its byte budget again.
+
+        :param key: Cache key
+        :param value: The encoded value to store
+        :type value: str
+        :param ttl: Overrides the cache's default TTL for this entry
+        :type ttl: float
+
+        :return: ``False`` if the value is too large to ever fit in the cache, otherwise ``True``
+        :rtype: bool
+
+        """
+        value_size = len(value)
+        if value_size > self.max_bytes:
+            return False
+
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl else None
+
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= len(old_entry[1])
+
+            self._entries[key] = (expires, value)
+            self.size += value_size
+
+            while self.size > self.max_bytes:
+                _, (_, evicted_value) = self._entries.popitem(last=False)
+                self.size -= len(evicted_value)
+
+        return True
+    #---
+
+    def delete(self, key):
+        """
+        Removes a value from the cache, if it is present.
+
+        :param key: Cache key
+
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+    #---
+
+    def clear(self):
+        """
+        Empties the cache.
+
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+    #---
+#---
@@ -25,9 +25,21 @@
 
 import cPickle
 import logging
+from rabbitrpc import admission
+from rabbitrpc import blobs
+from rabbitrpc import cancellation
+from rabbitrpc import delta
+from rabbitrpc import objects
+from rabbitrpc import routing
+from rabbitrpc import singleflight
+from rabbitrpc import stats
 from rabbitrpc.rabbitmq import consumer
+from rabbitrpc.server import resultcache
 import sys
+import threading
+import time
 import traceback
+import uuid
 
 
 class RPCServerError(Exception): pass
@@ -36,6 +48,62 @@ class CallFormatError(RPCServerError): pass
 class ModuleError(RPCServerError): pass
 
 
+# Options accepted by register.RPCFunction, with their defaults
+ENDPOINT_OPTIONS = {
+    # Seconds to keep memoized results for. Result caching is off for the endpoint unless this is set.
+    'cache_ttl': None,
+    # Byte budget for the endpoint's memoized (encoded) results
+    'cache_max_bytes': 16 * 1024 * 1024,
+    # Identical concurrent calls may share one execution and result, both within a client and across clients on the
+    # server (when it runs calls concurrently). Only set this for calls without side effects.
+    'coalesce': False,
+    # Large arguments are sent by content digest once the server holds them, instead of with every call
+    'blob_args': False,
+    # Replies to clients that already hold an earlier result are "unchanged" or a patch against it (see `delta`)
+    'delta': False,
+    # Seconds a remote object (see register.RPCClass) may go unused before its server drops it. ``None`` keeps it until
+    # the client releases it.
+    'object_ttl': 600,
+    # Name of the lane (bulkhead) serving the endpoint: a queue, channel and worker pool of its own. Lanes are sized in
+    # the RabbitMQ config's 'lanes' setting, e.g. {'reports': {'workers': 2, 'prefetch_count': 4}}.
+    'lane': None,
+    # Default message priority for the endpoint's calls (see the consumer's max_priority setting). Callers may override
+    # it with RPCClient.call_options.
+    'priority': None,
+    # Name of the argument whose value routes the call: calls with the same value go to the same server process (see
+    # `routing`), which keeps that process' caches warm for the key. Needs RabbitMQ's consistent-hash exchange plugin.
+    'route_by': None,
+    # Name of the argument whose value orders the call: when the server runs calls concurrently (several workers or a
+    # lane), calls with the same value still run one at a time, in the order they were delivered, whatever endpoint
+    # they are for. Ordering holds within a server process, so pair it with route_by on the same argument when
+    # several processes consume the queue.
+    'order_by': None,
+    # The endpoint may safely run twice for one call, so clients with hedging on (see RPCClient) may send a slow call
+    # again and take whichever reply comes first.
+    'idempotent': False,
+    # Seconds a call may wait (in the broker and for a worker) before the server refuses it with
+    # admission.OverloadError. Without it the call's lane's 'max_queue_wait' setting applies, then the RabbitMQ
+    # config's. ``None`` at every level runs calls however late.
+    'max_queue_wait': None,
+    # Durability profile of the endpoint's calls (see producer.DURABILITY_PROFILES): 'fast' calls and their replies
+    # are transient messages the broker never writes to disk, 'safe' ones are persistent and confirmed when the client
+    # has publisher confirms on. Callers may override it with RPCClient.call_options.
+    'durability': None,
+}
+
+
+def cancellation_token():
+    """
+    Provides the cancellation token of the call the current thread is running (see `cancellation`).  Long-running
+    endpoints can check it to stop working for a caller that has given up.
+
+    :rtype: cancellation.CancellationToken
+
+    """
+    return cancellation.current_token()
+#---
+
+
 class RPCServer(object):
     """
     Implements the server side of RPC over RabbitMQ.
@@ -48,11 +116,22 @@ class RPCServer(object):
         'current_hash' : {
             'args': None,
             },
+        'release_object' : {
+            'args': {'defined': {'var': ['object_id'], 'kw': None}, 'kwargs_var': None, 'varargs_var': None},
+            },
     }
     rabbit_consumer = None
     definitions = {}
     definitions_hash = None
     _module_map = {}
+    result_cache = None
+    blob_store = None
+    delta_store = None
+    objects = None
+    instance_queue = None
+    stats = None
+    _result_caches = None
+    _flights = None
     log = None
     rabbit_config = None
 
@@ -80,17 +159,42 @@ class RPCServer(object):
     #---
 
 
-    def __init__(self, rabbit_config):
+    def __init__(self, rabbit_config, result_cache = None, blob_store_bytes = 256 * 1024 * 1024,
+                 delta_store_bytes = 64 * 1024 * 1024):
         """
         Constructor
 
         :param rabbit_config: The configuration for the RabbitMQ server.  For details see this example:
             https://github.com/nwhalen/rabbitrpc/wiki/Data-Structure-Defintions#rabbitmq-configuration
+            With 'routing' set to 'module' (see `routing`), the server consumes the queues of the modules registered in
+            its process.  'lanes' sizes the lanes of the endpoints registered in its process.  'hash_weight' sets the
+            process' share of key-routed calls.  'max_queue_wait', in the config or a lane's settings, sheds calls
+            that waited too long (see `admission`).  'weighted_queues' has the server also serve other queues, sharing
+            its workers with the main queue by weight, e.g. {'critical': {'weight': 4}, 'bulk': {'weight': 1,
+            'prefetch_count': 2}} (see Consumer.addWeightedQueue and the consumer's 'queue_weight' setting).
         :type rabbit_config: dict
+        :param result_cache: A cache used by every memoized endpoint instead of their own in-process caches, e.g. a
+            ``sharedcache.SharedResultCache`` shared by all the server processes on a host.  The endpoints'
+            'cache_max_bytes' options don't apply to it; a shared cache only holds results up to its slot size.
+        :type result_cache: object
+        :param blob_store_bytes: Byte budget of the store for arguments sent by content digest (see `blobs`)
+        :type blob_store_bytes: int
+        :param delta_store_bytes: Byte budget for the recent results of delta endpoints, which patches are made against
+        :type delta_store_bytes: int
 
         """
         self.log = logging.getLogger(__name__)
         self.rabbit_config = rabbit_config
+        self.result_cache = result_cache
+        self.blob_store = resultcache.ResultCache(blob_store_bytes)
+        self.delta_store = resultcache.ResultCache(delta_store_bytes)
+        self.objects = objects.ObjectRegistry()
+        # Remote objects live in this process, so calls on them are routed to a queue only this process consumes
+        self.instance_queue = '%s.%s' % (routing.queue_name(rabbit_config), uuid.uuid4().hex)
+        self.stats = stats.Counters()
+        self._result_caches = {}
+        self._result_caches_lock = threading.Lock()
+        self._flights = singleflight.SingleFlight()
     #---
 
 
@@ -99,10 +203,35 @@ class RPCServer(object):
         Runs the RabbitMQ consumer
 
         """
-        # TODO: Fix this after the consumer constructor is refactored
-        self.rabbit_consumer = consumer.Consumer(self._rabbit_callback, self.rabbit_config['queue_name'],
-                                                 self.rabbit_config['exchange'],
-                                                 self.rabbit_config['connection_settings'])
+        self.rabbit_consumer = consumer.Consumer(self._rabbit_callback, self.rabbit_config)
+
+        # The main queue still carries internal calls, and module calls from clients using shared routing
+        if routing.routing_mode(self.rabbit_config) == routing.MODULE:
+            for module in sorted(self.definitions):
+                self.rabbit_consumer.addQueue(routing.module_queue(routing.queue_name(self.rabbit_config), module),
+                                              durable=True)
+
+        lane_settings = self.rabbit_config.get('lanes') or {}
+        for lane in sorted(self._endpoint_options_set('lane')):
+            # The load shedding limit is the server's business, the rest sizes the lane
+            settings = dict((name, value) for name, value in lane_settings.get(lane, {}).items()
+                            if name != 'max_queue_wait')
+            self.rabbit_consumer.addLane(lane, routing.lane_queue(routing.queue_name(self.rabbit_config), lane),
+                                         **settings)
+
+        weighted_queues = self.rabbit_config.get('weighted_queues') or {}
+        for queue_name in sorted(weighted_queues):
+            self.rabbit_consumer.addWeightedQueue(queue_name, **weighted_queues[queue_name])
+
+        # Remote objects and key-routed calls reach this process through its instance queue
+        instance_queue_args = {}
+        if self._endpoint_options_set('route_by'):
+            weight = self.rabbit_config.get('hash_weight', routing.DEFAULT_HASH_WEIGHT)
+            instance_queue_args['bindings'] = [(routing.hash_exchange(routing.queue_name(self.rabbit_config)),
+                                                routing.HASH_EXCHANGE_TYPE, str(weight))]
+
+        if self._hosts_objects() or instance_queue_args:
+            self.rabbit_consumer.addQueue(self.instance_queue, exclusive=True, auto_delete=True, **instance_queue_args)
 
         self.rabbit_consumer.run()
     #---
@@ -145,35 +274,229 @@ class RPCServer(object):
     #---
 
 
-    def _run_call(self, call_request):
+    def release_object(self, object_id):
+        """
+        Drops a remote object held by this server.
+
+        :param object_id: The object's id
+        :type object_id: str
+
+        :return: Whether the object was held
+        :rtype: bool
+
+        """
+        return self.objects.release(object_id)
+    #---
+
+
+    def _endpoint_options_set(self, option):
+        """
+        Provides the values the registered endpoints set for an endpoint option.
+
+        :param option: The option's name, e.g. 'lane'
+        :type option: str
+
+        :rtype: set
+
+        """
+        return set(definition['options'][option] for calls in self.definitions.values()
+                   for definition in calls.values() if (definition.get('options') or {}).get(option))
+    #---
+
+
+    def _hosts_objects(self):
+        """
+        Whether any registered call is a class, whose instances this server would hold.
+
+        :rtype: bool
+
+        """
+        return any('methods' in definition for calls in self.definitions.values() for definition in calls.values())
+    #---
+
+
+    def _run_call(self, call_request, attached_blobs = None):
         """
         Runs the specified call with or without args, depending on 'args' data.
 
         :param call_request: The call request data
         :type call_request: dict
+        :param attached_blobs: digest -> blob, for the blobs sent with the call
+        :type attached_blobs: dict
 
         :return: Whatever the call returns
 
         """
         call_module = call_request['module']
         call_name = call_request['call_name']
+        definition = None
 
         if call_request['internal'] and not call_module:
             dynamic_method =  self.__getattribute__(call_name)
+        elif call_request.get('object_id'):
+            dynamic_method = getattr(self.objects.get(call_request['object_id'])[0], call_name)
         else:
             full_module = self._module_map[call_request['module']]
             dynamic_method = sys.modules[full_module].__dict__[call_name]
+            definition = self.definitions[call_module][call_name]
 
         self.log.info('Serving RPC request (%s.%s)' %(call_module, call_name))
 
         if not call_request['args']:
-            return dynamic_method()
+            result = dynamic_method()
+        else:
+            args = {'varargs': [], 'kwargs': {}}
+            # Remove keys with 'None' values from incoming args and update the defaults
+            args.update({key: value for key,value in call_request['args'].items() if value})
+            self._resolve_blobs(args, attached_blobs, call_request.get('blobs_complete', False))
+
+            result = dynamic_method(*args['varargs'], **args['kwargs'])
+
+        # Constructed objects stay here, the caller gets a handle to them
+        if definition is not None and 'methods' in definition:
+            object_id = self.objects.add(result, call_module, call_name, self._call_options(call_request)['object_ttl'])
+            result = objects.ObjectHandle(object_id, self.instance_queue, call_module, call_name)
+
+        return result
+    #---
+
+    def _store_blobs(self, call_request):
+        """
+        Moves the blobs sent with a call into the blob store.  They are removed from the request so they are not
+        echoed back in the reply.
+
+        :param call_request: The call request data
+        :type call_request: dict
+
+        :return: digest -> blob, for the blobs sent with the call.  The store may not keep them all (e.g. those over
+            its byte budget), so the call is served from these.
+        :rtype: dict
+
+        """
+        attached_blobs = call_request.pop('blobs', None) or {}
+
+        for digest, data in attached_blobs.items():
+            if blobs.content_digest(data) != digest:
+                raise blobs.BlobError('Blob content does not match its digest %s' % digest)
+
+            if not self.blob_store.set(digest, data):
+                self.stats.increment('blobs_not_stored')
+
+        return attached_blobs
+    #---
 
-        args = {'varargs': [], 'kwargs': {}}
-        # Remove keys with 'None' values from incoming args and update the defaults
-        args.update({key: value for key,value in call_request['args'].items() if value})
+    def _resolve_blobs(self, args, attached_blobs = None, complete = False):
+        """
+        Replaces blob references in a call's arguments with the arguments themselves, in place.  References are
+        resolved from the blobs sent with the call, and only the others from the blob store.
+
+        :param args: The call's arguments, with 'varargs' and 'kwargs' filled in
+        :type args: dict
+        :param attached_blobs: digest -> blob, for the blobs sent with the call
+        :type attached_blobs: dict
+        :param complete: Whether the client sent every blob it has for the call
+        :type complete: bool
+
+        :raises: blobs.BlobMissingError if any referenced blob is neither sent nor in the blob store, or
+            blobs.BlobUnavailableError if the client sent all it has and that is still the case
+
+        """
+        attached_blobs = attached_blobs or {}
+        missing = set()
+
+        def resolve(value):
+            if not isinstance(value, blobs.BlobRef):
+                return value
+
+            data = attached_blobs.get(value.digest)
+            if data is None:
+                data = self.blob_store.get(value.digest)
+            if data is None:
+                missing.add(value.digest)
+                return value
+
+            return cPickle.loads(data)
+        #---
+
+        args['varargs'] = [resolve(value) for value in args['varargs']]
+        args['kwargs'] = dict((key, resolve(value)) for key, value in args['kwargs'].items())
+
+        if missing and complete:
+            raise blobs.BlobUnavailableError(sorted(missing))
+        elif missing:
+            self.stats.increment('blob_misses')
+            raise blobs.BlobMissingError(sorted(missing))
+    #---
+
+    def _call_options(self, call_request):
+        """
+        Provides the endpoint options for a call, with defaults filled in.
 
-        return dynamic_method(*args['varargs'], **args['kwargs'])
+        :param call_request: The call request data
+        :type call_request: dict
+
+        :rtype: dict
+
+        """
+        options = dict(ENDPOINT_OPTIONS)
+
+        # Methods of remote objects are stateful, so they never get the constructor's (or a namesake's) options
+        if not call_request['internal'] and not call_request.get('object_id'):
+            definition = self.definitions.get(call_request['module'], {}).get(call_request['call_name'], {})
+            options.update(definition.get('options') or {})
+
+        return options
+    #---
+
+    def _cache_key(self, call_request):
+        """
+        Builds the memoization key for a call: its module, name and normalized arguments, plus the result version the
+        caller holds for delta endpoints.
+
+        :param call_request: The call request data
+        :type call_request: dict
+
+        :return: The cache key, or ``None`` if the arguments can't be serialized
+        :rtype: str
+
+        """
+        args = call_request['args'] or {}
+        varargs = tuple(args.get('varargs') or ())
+        kwargs = tuple(sorted((args.get('kwargs') or {}).items()))
+
+        try:
+            return cPickle.dumps((call_request['module'], call_request['call_name'], varargs, kwargs,
+                                  call_request.get('delta_base')), 2)
+        except Exception:
+            return None
+    #---
+
+    def _result_cache(self, call_request):
+        """
+        Provides the result cache for the called endpoint, creating it on first use.
+
+        :param call_request: The call request data
+        :type call_request: dict
+
+        :return: The endpoint's result cache, or ``None`` if it does not memoize results
+
+        """
+        options = self._call_options(call_request)
+
+        if not options['cache_ttl']:
+            return None
+
+        if self.result_cache is not None:
+            return self.result_cache
+
+        endpoint = (call_request['module'], call_request['call_name'])
+        if endpoint not in self._result_caches:
+            with self._result_caches_lock:
+                if endpoint not in self._result_caches:
+                    self._result_caches[endpoint] = resultcache.ResultCache(options['cache_max_bytes'],
+                                                                            options['cache_ttl'])
+
+        return self._result_caches[endpoint]
     #---
 
     def _validate_request_structure(self, call_request):
@@ -217,6 +540,13 @@ class RPCServer(object):
             if call_request['call_name'] not in self.internal_definitions:
                 raise CallError('%s is not defined' % call_request['call_name'])
 
+        # Methods of remote objects
+        elif call_request.get('object_id'):
+            instance, short_module, class_name = self.objects.get(call_request['object_id'])
+
+            if call_request['call_name'] not in self.definitions[short_module][class_name]['methods']:
+                raise CallError('%s is not a method of %s.%s' % (call_request['call_name'], short_module, class_name))
+
         # Normal RPC methods
         else:
             short_module = call_request['module']
@@ -237,6 +567,32 @@ class RPCServer(object):
     #---
 
 
+    def _admit(self, call_request):
+        """
+        Sheds a call that waited longer than its endpoint, lane or server allows.
+
+        :param call_request: The call request data
+        :type call_request: dict
+
+        :raises: admission.OverloadError
+        """
+        options = self._call_options(call_request)
+        max_wait = options['max_queue_wait']
+
+        if max_wait is None and options['lane']:
+            max_wait = ((self.rabbit_config.get('lanes') or {}).get(options['lane']) or {}).get('max_queue_wait')
+
+        if max_wait is None:
+            max_wait = self.rabbit_config.get('max_queue_wait')
+
+        try:
+            admission.admit(admission.queue_wait(), max_wait)
+        except admission.OverloadError:
+            self.stats.increment('shed_calls')
+            raise
+    #---
+
+
     def _encode_result(self, result, call_request, exception_info = None):
         """
         Encodes a call result into a data structure with information about the call and any errors, then pickles
@@ -267,6 +623,76 @@ class RPCServer(object):
     #---
 
 
+    def _delta_encode(self, result, base_version):
+        """
+        Turns a result into a DeltaReply against the result version the caller holds.
+
+        :param result: The call's result
+        :param base_version: Version of the result the caller holds, or ``None``
+        :type base_version: str
+
+        :rtype: delta.DeltaReply
+
+        """
+        encoded_value = cPickle.dumps(result, 2)
+        version = delta.version_of(encoded_value)
+        self.delta_store.set(version, encoded_value)
+
+        if base_version == version:
+            self.stats.increment('delta_unchanged')
+            return delta.DeltaReply(version, delta.DeltaReply.UNCHANGED)
+
+        encoded_base = self.delta_store.get(base_version) if base_version else None
+        if encoded_base is None:
+            return delta.DeltaReply(version, delta.DeltaReply.FULL, result)
+
+        self.stats.increment('delta_patches')
+        return delta.DeltaReply(version, delta.DeltaReply.PATCH, delta.make_patch(cPickle.loads(encoded_base), result))
+    #---
+
+    def _serve_call(self, call_request, attached_blobs = None):
+        """
+        Runs a validated call, or serves it from its endpoint's result cache, and encodes the outcome.
+
+        :param call_request: The call request data
+        :type call_request: dict
+        :param attached_blobs: digest -> blob, for the blobs sent with the call
+        :type attached_blobs: dict
+
+        :return: The encoded call result
+        :rtype: str
+
+        """
+        exception_info = None
+        cache_key = None
+
+        try:
+            # Memoized endpoints reply with the already-encoded result on a hit
+            cache = self._result_cache(call_request)
+            if cache is not None:
+                cache_key = self._cache_key(call_request)
+                cached_result = cache.get(cache_key) if cache_key is not None else None
+                if cached_result is not None:
+                    self.stats.increment('cache_hits')
+                    return cached_result
+
+            result = self._run_call(call_request, attached_blobs)
+
+            if 'delta_base' in call_request and self._call_options(call_request)['delta']:
+                result = self._delta_encode(result, call_request['delta_base'])
+        except Exception as result:
+            exception_info = sys.exc_info()
+            pass
+
+        encoded_result = self._encode_result(result, call_request, exception_info)
+
+        if cache_key is not None and exception_info is None:
+            cache.set(cache_key, encoded_result, self._call_options(call_request)['cache_ttl'])
+
+        return encoded_result
+    #---
+
+
     def _rabbit_callback(self, body):
         """
         Takes the information from the RabbitMQ message body and determines what should be done with it, then does
@@ -278,22 +704,70 @@ class RPCServer(object):
         :return: Whatever the method that was proxied returns, pickled
 
         """
-        exception_info = None
-
         # De-serialize the call request
         try:
             call_request = cPickle.loads(body)
         except Exception:
             raise consumer.InvalidMessageError(body)
 
+        # Before validation, which marks the called object as used
+        self.objects.expire()
+
         try:
             self._validate_request_structure(call_request)
             self._validate_call(call_request)
-            result = self._run_call(call_request)
-        except Exception as result:
-            exception_info = sys.exc_info()
-            pass
+            self._admit(call_request)
+            attached_blobs = self._store_blobs(call_request)
+        except Exception as error:
+            return self._encode_result(error, call_request, sys.exc_info())
+
+        self.stats.increment('calls')
+
+        # Identical requests for coalescible endpoints that arrive while a matching one is running wait for it and
+        # reply with its result.  If the running call's caller gave up on it (cancelled it, or let its deadline pass)
+        # its outcome may be an error that is only its caller's, so callers still waiting run the call again.
+        if self._call_options(call_request)['coalesce']:
+            coalesce_key = self._cache_key(call_request)
+            if coalesce_key is not None:
+                (encoded_result, given_up), shared = self._flights.do(coalesce_key, self._serve_flight, call_request,
+                                                                      attached_blobs)
+                if not shared:
+                    return encoded_result
+
+                if given_up and not self._given_up():
+                    self.stats.increment('coalesce_reruns')
+                    return self._serve_call(call_request, attached_blobs)
+
+                self.stats.increment('coalesced_calls')
+                return encoded_result
+
+        return self._serve_call(call_request, attached_blobs)
+    #---
+
+    def _serve_flight(self, call_request, attached_blobs = None):
+        """
+        Serves a call that identical requests may be waiting on, noting whether its caller gave up on it meanwhile.
 
-        return self._encode_result(result, call_request, exception_info)
+        :param call_request: The call request data
+        :type call_request: dict
+        :param attached_blobs: digest -> blob, for the blobs sent with the call
+        :type attached_blobs: dict
+
+        :return: tuple of the encoded call result[0] and whether its caller gave up on it[1]
+        :rtype: tuple
+        """
+        encoded_result = self._serve_call(call_request, attached_blobs)
+        return encoded_result, self._given_up()
+    #---
+
+    def _given_up(self):
+        """
+        Whether the caller of the call the current thread is running has given up on it: cancelled it, or let its
+        deadline pass.
+
+        :rtype: bool
+        """
+        deadline = admission.current_deadline()
+        return cancellation.current_token().cancelled or (deadline is not None and time.time() >= deadline)
     #---
 #---
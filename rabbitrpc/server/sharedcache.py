@@ -0,0 +1,298 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         sharedcache.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Result cache shared by every server process on a host, backed by an mmap'ed file.
+#
+#   The file is a set-associative table of fixed size slots.  A key hashes to one set, and each set is guarded by its
+#   own byte-range lock on the file (plus a thread lock inside each process), so processes only contend when they touch
+#   the same set.  When a set is full the least recently used slot in it is overwritten.
+#
+#   Slots don't grow: the slot size (less a 40 byte header) is the largest value the cache holds, and every value takes
+#   a whole slot.  The byte budget is therefore really a slot count, max_bytes / slot_size, and the endpoints'
+#   'cache_max_bytes' options don't apply.  Size slots for the results being cached; `too_large` counts the values
+#   turned away for not fitting.
+#
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+class SharedCacheError(Exception): pass
+
+
+_MAGIC = 'RRPCSHM1'
+# magic, set count, ways per set, slot size
+_HEADER = struct.Struct('<8sIII')
+# key digest, expiry time (0 = never), last use time, value length
+_SLOT_HEADER = struct.Struct('<20sddI')
+_EMPTY_DIGEST = '\0' * 20
+# Thread locks are striped over the sets rather than allocated one per set
+_THREAD_LOCK_STRIPES = 64
+
+
+class SharedResultCache(object):
+    """
+    Cache of encoded (string) values shared between processes through a memory mapped file.  It has the same
+    ``get``/``set`` interface as ``resultcache.ResultCache``, so ``RPCServer`` can use either one.
+
+    """
+    path = None
+    ttl = None
+    num_sets = None
+    ways = None
+    slot_size = None
+    hits = 0
+    misses = 0
+    too_large = 0
+
+    def __init__(self, path, max_bytes, slot_size = 64 * 1024, ways = 8, ttl = None):
+        """
+        Constructor.  Opens (creating it if needed) the cache file.  When the file already exists its layout wins over
+        the sizes given here, so every process agrees on the geometry.
+
+        :param path: Path of the backing file.  Use a tmpfs path (e.g. under /dev/shm) to keep it off disk.
+        :type path: str
+        :param max_bytes: Total size of the slot table, which holds max_bytes / slot_size values whatever their size
+        :type max_bytes: int
+        :param slot_size: Size of each slot, including its header.  Values larger than a slot are never cached, and
+            smaller ones still take a whole slot, so size it for the largest result worth caching.
+        :type slot_size: int
+        :param ways: Slots per set
+        :type ways: int
+        :param ttl: Default time-to-live for entries, in seconds.  ``None`` means entries only leave via eviction.
+        :type ttl: float
+
+        """
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.too_large = 0
+        # The set locks are striped, so the counts need one of their own
+        self._counts_lock = threading.Lock()
+
+        num_sets = max(1, max_bytes // (slot_size * ways))
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            if os.fstat(self._fd).st_size < _HEADER.size:
+                self._initialize(num_sets, ways, slot_size)
+
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            magic, self.num_sets, self.ways, self.slot_size = _HEADER.unpack(os.read(self._fd, _HEADER.size))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+        if magic != _MAGIC:
+            raise SharedCacheError('%s is not a shared result cache file' % path)
+
+        self._mmap = mmap.mmap(self._fd, _HEADER.size + self.num_sets * self.ways * self.slot_size)
+        self._thread_locks = [threading.Lock() for _ in range(min(self.num_sets, _THREAD_LOCK_STRIPES))]
+    #---
+
+    @property
+    def max_value_size(self):
+        """
+        Size of the largest value the cache will hold.
+
+        :rtype: int
+
+        """
+        return self.slot_size - _SLOT_HEADER.size
+    #---
+
+    def close(self):
+        """
+        Unmaps and closes the backing file.  The file itself is left in place for the other processes.
+
+        """
+        self._mmap.close()
+        os.close(self._fd)
+    #---
+
+    def get(self, key):
+        """
+        Fetches a value and marks it as most recently used.
+
+        :param key: Cache key
+        :type key: str
+
+        :return: The cached value, or ``None`` if it is missing or expired
+        :rtype: str
+
+        """
+        digest = hashlib.sha1(key).digest()
+        set_index = self._set_index(digest)
+        now = time.time()
+        value = None
+
+        self._lock_set(set_index)
+        try:
+            for offset in self._slot_offsets(set_index):
+                slot_digest, expires, last_used, length = _SLOT_HEADER.unpack_from(self._mmap, offset)
+
+                if slot_digest != digest:
+                    continue
+
+                if expires and expires <= now:
+                    break
+
+                _SLOT_HEADER.pack_into(self._mmap, offset, slot_digest, expires, now, length)
+                value_start = offset + _SLOT_HEADER.size
+                value = self._mmap[value_start:value_start + length]
+                break
+        finally:
+            self._unlock_set(set_index)
+
+        with self._counts_lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+    #---
+
+    def set(self, key, value, ttl = None):
+        """
+        Stores a value, overwriting the least recently used (or an expired) slot in the key's set.
+
+        :param key: Cache key
+        :type key: str
+        :param value: The encoded value to store
+        :type value: str
+        :param ttl: Overrides the cache's default TTL for this entry
+        :type ttl: float
+
+        :return: ``False`` if the value does not fit in a slot, otherwise ``True``
+        :rtype: bool
+
+        """
+        if len(value) > self.max_value_size:
+            with self._counts_lock:
+                self.too_large += 1
+            return False
+
+        if ttl is None:
+            ttl = self.ttl
+
+        digest = hashlib.sha1(key).digest()
+        set_index = self._set_index(digest)
+        now = time.time()
+        expires = now + ttl if ttl else 0.0
+
+        self._lock_set(set_index)
+        try:
+            target = None
+            target_last_used = None
+
+            for offset in self._slot_offsets(set_index):
+                slot_digest, slot_expires, last_used, length = _SLOT_HEADER.unpack_from(self._mmap, offset)
+
+                if slot_digest == digest:
+                    target = offset
+                    break
+
+                # Free and expired slots count as the oldest possible
+                if slot_digest == _EMPTY_DIGEST or (slot_expires and slot_expires <= now):
+                    last_used = -1.0
+
+                if target is None or last_used < target_last_used:
+                    target = offset
+                    target_last_used = last_used
+
+            value_start = target + _SLOT_HEADER.size
+            self._mmap[value_start:value_start + len(value)] = value
+            _SLOT_HEADER.pack_into(self._mmap, target, digest, expires, now, len(value))
+        finally:
+            self._unlock_set(set_index)
+
+        return True
+    #---
+
+    def delete(self, key):
+        """
+        Removes a value from the cache, if it is present.
+
+        :param key: Cache key
+        :type key: str
+
+        """
+        digest = hashlib.sha1(key).digest()
+        set_index = self._set_index(digest)
+
+        self._lock_set(set_index)
+        try:
+            for offset in self._slot_offsets(set_index):
+                if _SLOT_HEADER.unpack_from(self._mmap, offset)[0] == digest:
+                    _SLOT_HEADER.pack_into(self._mmap, offset, _EMPTY_DIGEST, 0.0, 0.0, 0)
+        finally:
+            self._unlock_set(set_index)
+    #---
+
+    def _initialize(self, num_sets, ways, slot_size):
+        """
+        Lays out an empty cache file.  Must be called with the file's header lock held.
+
+        """
+        os.ftruncate(self._fd, _HEADER.size + num_sets * ways * slot_size)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, _HEADER.pack(_MAGIC, num_sets, ways, slot_size))
+    #---
+
+    def _set_index(self, digest):
+        return struct.unpack_from('<I', digest)[0] % self.num_sets
+    #---
+
+    def _slot_offsets(self, set_index):
+        first_slot = _HEADER.size + set_index * self.ways * self.slot_size
+        return xrange(first_slot, first_slot + self.ways * self.slot_size, self.slot_size)
+    #---
+
+    def _lock_set(self, set_index):
+        """
+        Takes the set's thread lock, then its file lock.  Byte-range locks are held per process, so the thread lock is
+        what keeps threads of the same process apart.  Byte 0 of the lock space is the header lock.
+
+        """
+        thread_lock = self._thread_locks[set_index % len(self._thread_locks)]
+        thread_lock.acquire()
+
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, set_index + 1)
+        except Exception:
+            thread_lock.release()
+            raise
+    #---
+
+    def _unlock_set(self, set_index):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, set_index + 1)
+        self._thread_locks[set_index % len(self._thread_locks)].release()
+    #---
+#---
@@ -0,0 +1,105 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         singleflight.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Duplicate call suppression: concurrent calls with the same key share a single execution.
+#
+
+import sys
+import threading
+
+
+class _Flight(object):
+    """
+    A call in progress and the outcome its waiters are waiting for.
+
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+    #---
+#---
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call per key at a time.  Callers that arrive with a key that is already in flight wait for that
+    call to finish and receive its result, or have its exception raised, instead of running their own.
+
+    """
+
+    def __init__(self):
+        """
+        Constructor
+
+        """
+        self._flights = {}
+        self._lock = threading.Lock()
+    #---
+
+    def __len__(self):
+        with self._lock:
+            return len(self._flights)
+    #---
+
+    def do(self, key, function, *varargs, **kwargs):
+        """
+        Runs `function` for `key`, unless a call for `key` is already in flight, in which case its outcome is shared.
+
+        :param key: Identifies calls that are interchangeable
+        :param function: The call to run
+        :param varargs: varargs for the call
+        :param kwargs: kwargs for the call
+
+        :return: tuple of the call's result[0] and whether it was shared with an earlier caller[1]
+
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+            else:
+                flight.waiters += 1
+                leader = False
+
+        if leader:
+            try:
+                flight.result = function(*varargs, **kwargs)
+            except Exception:
+                flight.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.exc_info:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+
+        return flight.result, not leader
+    #---
+#---
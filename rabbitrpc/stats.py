@@ -0,0 +1,145 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         stats.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Thread-safe counters used by the client and server to report what they are doing, and windows of recent latencies.
+#
+
+import collections
+import math
+import threading
+
+
+class Counters(object):
+    """
+    A set of named, thread-safe counters.  Counters that were never incremented read as 0.
+
+    """
+
+    def __init__(self):
+        """
+        Constructor
+
+        """
+        self._counts = collections.defaultdict(int)
+        self._lock = threading.Lock()
+    #---
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._counts.get(name, 0)
+    #---
+
+    def increment(self, name, amount = 1):
+        """
+        Adds to a counter.
+
+        :param name: Counter name
+        :type name: str
+        :param amount: How much to add
+        :type amount: int
+
+        """
+        with self._lock:
+            self._counts[name] += amount
+    #---
+
+    def set(self, name, value):
+        """
+        Sets a counter, for values that are sampled rather than counted (e.g. a queue's depth).
+
+        :param name: Counter name
+        :type name: str
+        :param value: The current value
+        :type value: int
+
+        """
+        with self._lock:
+            self._counts[name] = value
+    #---
+
+    def snapshot(self):
+        """
+        Provides a copy of every counter's current value.
+
+        :rtype: dict
+
+        """
+        with self._lock:
+            return dict(self._counts)
+    #---
+#---
+
+class LatencyWindow(object):
+    """
+    The most recent latencies of something, for percentiles.  Thread-safe.
+
+    """
+
+    def __init__(self, size = 100):
+        """
+        Constructor
+
+        :param size: How many of the latest samples to keep
+        :type size: int
+
+        """
+        self._samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+    #---
+
+    def __len__(self):
+        with self._lock:
+            return len(self._samples)
+    #---
+
+    def add(self, seconds):
+        """
+        Records a latency.
+
+        :param seconds: The latency
+        :type seconds: float
+
+        """
+        with self._lock:
+            self._samples.append(seconds)
+    #---
+
+    def percentile(self, percent):
+        """
+        Provides a percentile of the recorded latencies (nearest rank).
+
+        :param percent: The percentile, e.g. 95
+        :type percent: float
+
+        :return: The latency, or ``None`` with no samples
+        :rtype: float
+
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+
+        if not samples:
+            return None
+
+        return samples[max(0, int(math.ceil(percent / 100.0 * len(samples))) - 1)]
+    #---
+#---
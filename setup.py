@@ -23,7 +23,7 @@ setup(name='rabbitrpc',
       long_description=readme_content,
       packages=['rabbitrpc', 'rabbitrpc.client', 'rabbitrpc.examples', 'rabbitrpc.rabbitmq', 'rabbitrpc.server',
                 'rabbitrpc.examples.server', 'rabbitrpc.examples.client'],
-      requires=['pika (>=0.9.8)'],
+      requires=['pika (>=0.10.0)'],
       provides=['rabbitrpc', 'rabbitrpc.client', 'rabbitrpc.rabbitmq', 'rabbitrpc.server'],
       keywords='rabbitmq rpc amqp',
       license='Apache License 2.0',
@@ -26,8 +26,10 @@
 import imp
 import mock
 import pytest
+from rabbitrpc import objects
 from rabbitrpc.client import rpcclient
 import sys
+import threading
 
 
 class Test___init__(object):
@@ -444,6 +446,886 @@ class Test__proxy_handler(object):
 
 #---
 
+class Test__proxy_handler_coalescing(object):
+    """
+    Tests the coalescing of identical calls by RPCClient's `_proxy_handler` method
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({})
+        self.client.definitions = {
+            'rpcendpoints': {
+                'shared_call': {'args': None, 'doc': None, 'options': {'coalesce': True}},
+                'plain_call': {'args': None, 'doc': None, 'options': {}},
+            }
+        }
+        self.client._result_handler = mock.MagicMock(side_effect=lambda result: result)
+        self.client.rabbit_producer.send.return_value = rpcclient.cPickle.dumps('reply')
+        self.client._flights = mock.MagicMock()
+        self.client._flights.do.return_value = (rpcclient.cPickle.dumps('shared reply'), True)
+    #---
+
+    def test_CoalescibleCallsGoThroughSingleFlight(self):
+        """
+        Tests that calls to endpoints marked `coalesce` are sent through the single flight group, keyed by the
+        encoded call.
+
+        """
+        result = self.client._proxy_handler('shared_call', 'rpcendpoints', 1)
+
+        key = self.client._flights.do.call_args[0][0]
+        assert rpcclient.cPickle.loads(key)['call_name'] == 'shared_call'
+        self.client._flights.do.assert_called_once_with(key, self.client.rabbit_producer.send, key)
+        assert result == 'shared reply'
+    #---
+
+    def test_CountsCoalescedCalls(self):
+        """
+        Tests that calls which shared another call's reply are counted.
+
+        """
+        self.client._proxy_handler('shared_call', 'rpcendpoints')
+        self.client._proxy_handler('plain_call', 'rpcendpoints')
+
+        assert self.client.stats['calls'] == 2
+        assert self.client.stats['coalesced_calls'] == 1
+    #---
+
+    def test_OtherCallsAreSentDirectly(self):
+        """
+        Tests that calls to endpoints which are not marked `coalesce` are sent on their own.
+
+        """
+        result = self.client._proxy_handler('plain_call', 'rpcendpoints')
+
+        assert self.client._flights.do.called is False
+        assert result == 'reply'
+    #---
+#---
+
+class Test__proxy_handler_blobs(object):
+    """
+    Tests the content-addressed argument handling of RPCClient's `_proxy_handler` method
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({}, blob_threshold=100)
+        self.client.definitions = {
+            'rpcendpoints': {
+                'train': {'args': None, 'doc': None, 'options': {'blob_args': True}},
+            }
+        }
+        self.client._result_handler = mock.MagicMock(side_effect=lambda result: result['result'])
+
+        self.sent = []
+        self.replies = []
+
+        def send(body):
+            self.sent.append(rpcclient.cPickle.loads(body))
+            return self.replies.pop(0)
+        #---
+        self.client.rabbit_producer.send.side_effect = send
+
+        self.big_arg = 'x' * 1000
+        self.digest = rpcclient.blobs.content_digest(rpcclient.cPickle.dumps(self.big_arg, 2))
+    #---
+
+    def reply(self, result, error = None):
+        self.replies.append(rpcclient.cPickle.dumps({'call': {}, 'result': result, 'error': error}))
+    #---
+
+    def test_LargeArgumentsAreReplacedByReferences(self):
+        """
+        Tests that large arguments are sent as references with their blob attached, small ones as they are.
+
+        """
+        self.reply('ok')
+        self.client._proxy_handler('train', 'rpcendpoints', self.big_arg, 'small', config=self.big_arg)
+
+        call = self.sent[0]
+        assert call['args']['varargs'] == (rpcclient.blobs.BlobRef(self.digest), 'small')
+        assert call['args']['kwargs'] == {'config': rpcclient.blobs.BlobRef(self.digest)}
+        assert call['blobs'] == {self.digest: rpcclient.cPickle.dumps(self.big_arg, 2)}
+    #---
+
+    def test_ConfirmedBlobsAreNotResent(self):
+        """
+        Tests that once a call carrying a blob succeeded, later calls only send its reference.
+
+        """
+        self.reply('ok')
+        self.reply('ok')
+        self.client._proxy_handler('train', 'rpcendpoints', self.big_arg)
+        self.client._proxy_handler('train', 'rpcendpoints', self.big_arg)
+
+        assert self.sent[1]['blobs'] == {}
+        assert self.sent[1]['args']['varargs'] == (rpcclient.blobs.BlobRef(self.digest),)
+        assert self.client.stats['blob_bytes_saved'] > 0
+    #---
+
+    def test_MissingBlobsAreResentTransparently(self):
+        """
+        Tests that when the server no longer holds a blob the call is repeated with the blob attached.
+
+        """
+        self.client._server_blobs.add(self.digest)
+        self.reply(rpcclient.blobs.BlobMissingError([self.digest]), {'traceback': ''})
+        self.reply('ok')
+
+        result = self.client._proxy_handler('train', 'rpcendpoints', self.big_arg)
+
+        assert result == 'ok'
+        assert self.sent[0]['blobs'] == {}
+        assert self.digest in self.sent[1]['blobs']
+        assert ('blobs_complete' in self.sent[0], self.sent[1]['blobs_complete']) == (False, True)
+        assert self.client.stats['blob_misses'] == 1
+        assert self.digest in self.client._server_blobs
+    #---
+
+    def test_OtherEndpointsSendArgumentsInline(self):
+        """
+        Tests that endpoints without the blob_args option get their arguments as they are.
+
+        """
+        self.client.definitions['rpcendpoints']['train']['options'] = {}
+        self.reply('ok')
+        self.client._proxy_handler('train', 'rpcendpoints', self.big_arg)
+
+        assert self.sent[0]['args']['varargs'] == (self.big_arg,)
+        assert 'blobs' not in self.sent[0]
+    #---
+#---
+
+class Test__proxy_handler_delta(object):
+    """
+    Tests the delta encoded results handling of RPCClient's `_proxy_handler` method
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({})
+        self.client.definitions = {
+            'rpcendpoints': {
+                'status': {'args': None, 'doc': None, 'options': {'delta': True}},
+            }
+        }
+        self.client._result_handler = mock.MagicMock(side_effect=lambda result: result['result'])
+
+        self.sent = []
+        self.replies = []
+
+        def send(body):
+            self.sent.append(rpcclient.cPickle.loads(body))
+            return rpcclient.cPickle.dumps({'call': {}, 'result': self.replies.pop(0), 'error': None})
+        #---
+        self.client.rabbit_producer.send.side_effect = send
+        self.DeltaReply = rpcclient.delta.DeltaReply
+    #---
+
+    def test_FirstCallHasNoBase(self):
+        """
+        Tests that a call without a held result asks for delta encoding with no base.
+
+        """
+        self.replies.append(self.DeltaReply('v1', self.DeltaReply.FULL, {'a': 1}))
+
+        assert self.client._proxy_handler('status', 'rpcendpoints') == {'a': 1}
+        assert self.sent[0]['delta_base'] is None
+    #---
+
+    def test_LaterCallsSendHeldVersion(self):
+        """
+        Tests that later calls send the version of the held result and rebuild the result from the reply.
+
+        """
+        self.replies.append(self.DeltaReply('v1', self.DeltaReply.FULL, {'a': 1, 'b': 2}))
+        self.replies.append(self.DeltaReply('v2', self.DeltaReply.PATCH,
+                                            rpcclient.delta.make_patch({'a': 1, 'b': 2}, {'a': 3, 'b': 2})))
+        self.replies.append(self.DeltaReply('v2', self.DeltaReply.UNCHANGED))
+
+        self.client._proxy_handler('status', 'rpcendpoints')
+        patched = self.client._proxy_handler('status', 'rpcendpoints')
+        unchanged = self.client._proxy_handler('status', 'rpcendpoints')
+
+        assert [call['delta_base'] for call in self.sent] == [None, 'v1', 'v2']
+        assert patched == {'a': 3, 'b': 2}
+        assert unchanged == {'a': 3, 'b': 2}
+    #---
+
+    def test_CallersCannotCorruptHeldResult(self):
+        """
+        Tests that modifying a returned result does not affect the result held for the next call.
+
+        """
+        self.replies.append(self.DeltaReply('v1', self.DeltaReply.FULL, {'a': 1}))
+        self.replies.append(self.DeltaReply('v1', self.DeltaReply.UNCHANGED))
+
+        self.client._proxy_handler('status', 'rpcendpoints')['a'] = 'changed'
+
+        assert self.client._proxy_handler('status', 'rpcendpoints') == {'a': 1}
+    #---
+
+    def test_DifferentArgumentsAreTrackedSeparately(self):
+        """
+        Tests that results are held per set of arguments.
+
+        """
+        self.replies.append(self.DeltaReply('v1', self.DeltaReply.FULL, 1))
+        self.replies.append(self.DeltaReply('v2', self.DeltaReply.FULL, 2))
+
+        self.client._proxy_handler('status', 'rpcendpoints', 'east')
+        self.client._proxy_handler('status', 'rpcendpoints', 'west')
+
+        assert [call['delta_base'] for call in self.sent] == [None, None]
+    #---
+
+    def test_ReplyAgainstReplacedBaseIsResentInFull(self):
+        """
+        Tests that a patch against a result another call has replaced meanwhile is not applied to the newer one, and
+        that the call is sent again without a base.
+
+        """
+        self.replies.append(self.DeltaReply('v1', self.DeltaReply.FULL, {'a': 1}))
+        self.client._proxy_handler('status', 'rpcendpoints')
+
+        def concurrent_call(body):
+            # A concurrent call for the same key stores v2 while this call, sent with base v1, waits
+            self.client._delta_results[self.client._delta_results.keys()[0]] = ('v2', {'a': 2})
+            self.client.rabbit_producer.send.side_effect = send
+            return send(body)
+        send = self.client.rabbit_producer.send.side_effect
+        self.client.rabbit_producer.send.side_effect = concurrent_call
+        self.replies.append(self.DeltaReply('v3', self.DeltaReply.PATCH, rpcclient.delta.make_patch({'a': 1},
+                                                                                                   {'a': 3, 'b': 0})))
+        self.replies.append(self.DeltaReply('v3', self.DeltaReply.FULL, {'a': 3, 'b': 0}))
+
+        assert self.client._proxy_handler('status', 'rpcendpoints') == {'a': 3, 'b': 0}
+        assert [call['delta_base'] for call in self.sent] == [None, 'v1', None]
+        assert self.client.stats['delta_resends'] == 1
+    #---
+
+    def test_ReplyAgainstDroppedBaseIsResentInFull(self):
+        """
+        Tests that a reply building on a result the client dropped meanwhile is asked for in full.
+
+        """
+        self.replies.append(self.DeltaReply('v1', self.DeltaReply.FULL, {'a': 1}))
+        self.client._proxy_handler('status', 'rpcendpoints')
+
+        send = self.client.rabbit_producer.send.side_effect
+        self.client.rabbit_producer.send.side_effect = lambda body: (self.client._delta_results.clear(), send(body))[1]
+        self.replies.append(self.DeltaReply('v1', self.DeltaReply.UNCHANGED))
+        self.replies.append(self.DeltaReply('v1', self.DeltaReply.FULL, {'a': 1}))
+
+        assert self.client._proxy_handler('status', 'rpcendpoints') == {'a': 1}
+        assert [call['delta_base'] for call in self.sent] == [None, 'v1', None]
+    #---
+#---
+
+class Test_remote_objects(object):
+    """
+    Tests the proxy classes RPCClient builds for remote object classes
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({})
+        self.client.definitions = {
+            'rpcobjects': {
+                'Session': {'args': {'defined': {'var': ['user'], 'kw': None}, 'kwargs_var': None,
+                                     'varargs_var': None},
+                            'doc': 'A session', 'options': {}, 'methods': {
+                                'fetch': {'args': {'defined': {'var': ['key'], 'kw': None}, 'kwargs_var': None,
+                                                   'varargs_var': None}, 'doc': 'Fetches a key'},
+                            }},
+            }
+        }
+        self.client._build_rpc_modules()
+
+        self.handle = objects.ObjectHandle('abc', 'rabbitrpc.server1', 'rpcobjects', 'Session')
+        self.replies = [self.handle]
+        self.sent = []
+
+        def send(body, routing_key = None):
+            self.sent.append((rpcclient.cPickle.loads(body), routing_key))
+            return rpcclient.cPickle.dumps({'call': {}, 'result': self.replies.pop(0), 'error': None})
+        #---
+        self.client.rabbit_producer.send.side_effect = send
+    #---
+
+    def teardown_method(self, method):
+        self.client._remove_rpc_modules()
+    #---
+
+    def test_ConstructorCallsTheServerQueue(self):
+        """
+        Tests that instantiating the proxy class calls the class on the server queue and keeps the handle.
+
+        """
+        session = sys.modules['rpcobjects'].Session('bob')
+
+        call, routing_key = self.sent[0]
+        assert (call['call_name'], call['args']['varargs'], routing_key) == ('Session', ('bob',), None)
+        assert session._rpc_handle.id == 'abc'
+    #---
+
+    def test_MethodCallsArePinnedToTheObjectsServer(self):
+        """
+        Tests that method calls carry the object id and go to the queue of the server holding the object.
+
+        """
+        session = sys.modules['rpcobjects'].Session('bob')
+        self.replies.append('value')
+
+        assert session.fetch('color') == 'value'
+        call, routing_key = self.sent[1]
+        assert (call['call_name'], call['object_id'], routing_key) == ('fetch', 'abc', 'rabbitrpc.server1')
+    #---
+
+    def test_ReleaseIsSentToTheObjectsServer(self):
+        """
+        Tests that releasing the proxy (here by leaving a with block) sends release_object to the object's server.
+
+        """
+        self.replies.append(True)
+
+        with sys.modules['rpcobjects'].Session('bob'):
+            pass
+
+        call, routing_key = self.sent[1]
+        assert (call['call_name'], call['internal'], routing_key) == ('release_object', True, 'rabbitrpc.server1')
+        assert call['args']['varargs'] == ('abc',)
+    #---
+
+    def test_DocsAreKept(self):
+        """
+        Tests that the proxy class and its methods carry the server side docs.
+
+        """
+        session_class = sys.modules['rpcobjects'].Session
+
+        assert 'A session' in session_class.__doc__
+        assert 'Fetches a key' in session_class.fetch.__doc__
+    #---
+#---
+
+class Test_module_routing(object):
+    """
+    Tests RPCClient's per-module routing
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({'queue_name': 'rpc', 'routing': 'module',
+                                                  'modules': ['billing', 'search']})
+        self.client._result_handler = mock.MagicMock(side_effect=lambda result: result['result'])
+
+        self.sent = []
+
+        def send(body, routing_key = None):
+            call = rpcclient.cPickle.loads(body)
+            self.sent.append((call, routing_key))
+            if call['internal']:
+                module = routing_key.split('.')[-1]
+                result = {'definitions': {module: {'call': {'args': None, 'doc': None}}}, 'hash': 1}
+            else:
+                result = 'done'
+            return rpcclient.cPickle.dumps({'call': call, 'result': result, 'error': None})
+        #---
+        self.client.rabbit_producer.send.side_effect = send
+    #---
+
+    def test_CallsGoToTheModulesQueue(self):
+        """
+        Tests that calls are routed to their module's queue.
+
+        """
+        self.client._proxy_handler('charge', 'billing')
+
+        assert self.sent[0][1] == 'rpc.billing'
+    #---
+
+    def test_DefinitionsAreFetchedPerModule(self):
+        """
+        Tests that each listed module's definitions are fetched from its own queue.
+
+        """
+        self.client._fetch_definitions()
+
+        assert [routing_key for call, routing_key in self.sent] == ['rpc.billing', 'rpc.search']
+        assert sorted(self.client.definitions) == ['billing', 'search']
+    #---
+#---
+
+class Test_lane_routing(object):
+    """
+    Tests RPCClient's routing of calls to endpoints in lanes
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({'queue_name': 'rpc'})
+        self.client.definitions = {
+            'reports': {
+                'build': {'args': None, 'doc': None, 'options': {'lane': 'slow'}},
+                'peek': {'args': None, 'doc': None, 'options': {}},
+            }
+        }
+        self.client._result_handler = mock.MagicMock()
+        self.client.rabbit_producer.send.return_value = rpcclient.cPickle.dumps({'result': None, 'error': None})
+    #---
+
+    def test_LaneCallsGoToTheLaneQueue(self):
+        """
+        Tests that calls to an endpoint in a lane are sent to the lane's queue.
+
+        """
+        self.client._proxy_handler('build', 'reports')
+
+        assert self.client.rabbit_producer.send.call_args[1] == {'routing_key': 'rpc.lane.slow'}
+    #---
+
+    def test_OtherCallsGoToTheMainQueue(self):
+        """
+        Tests that calls to endpoints without a lane use the main queue.
+
+        """
+        self.client._proxy_handler('peek', 'reports')
+
+        assert self.client.rabbit_producer.send.call_args[1] == {}
+    #---
+#---
+
+class Test_key_routing(object):
+    """
+    Tests RPCClient's routing of calls to key-routed endpoints
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({'queue_name': 'rpc'})
+        self.client.definitions = {
+            'accounts': {
+                'balance': {'args': {'defined': {'var': ['account'], 'kw': None}, 'kwargs_var': None,
+                                     'varargs_var': None}, 'doc': None, 'options': {'route_by': 'account'}},
+            }
+        }
+        self.client._result_handler = mock.MagicMock()
+        self.client.rabbit_producer.send.return_value = rpcclient.cPickle.dumps({'result': None, 'error': None})
+    #---
+
+    def test_CallsArePublishedToTheHashExchange(self):
+        """
+        Tests that calls are published to the consistent-hash exchange, keyed by the route_by argument.
+
+        """
+        self.client._proxy_handler('balance', 'accounts', 'acct-7')
+
+        assert self.client.rabbit_producer.send.call_args[1] == {'exchange': 'rpc.hash', 'routing_key': 'acct-7'}
+    #---
+
+    def test_KeywordArgumentsAreUsed(self):
+        """
+        Tests that the key is also found when passed by keyword.
+
+        """
+        self.client._proxy_handler('balance', 'accounts', account='acct-8')
+
+        assert self.client.rabbit_producer.send.call_args[1]['routing_key'] == 'acct-8'
+    #---
+#---
+
+class Test_ordering(object):
+    """
+    Tests RPCClient's ordering keys for endpoints registered with order_by
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({})
+        self.client.definitions = {
+            'accounts': {
+                'deposit': {'args': {'defined': {'var': ['account', 'amount'], 'kw': None}, 'kwargs_var': None,
+                                     'varargs_var': None}, 'doc': None, 'options': {'order_by': 'account'}},
+            }
+        }
+        self.client._result_handler = mock.MagicMock()
+        self.client.rabbit_producer.send.return_value = rpcclient.cPickle.dumps({'result': None, 'error': None})
+    #---
+
+    def test_CallsCarryTheirOrderKey(self):
+        """
+        Tests that calls carry the order_by argument's value in the ordering key header.
+
+        """
+        self.client._proxy_handler('deposit', 'accounts', 'acct-3', 10)
+
+        assert self.client.rabbit_producer.send.call_args[1] == {'headers': {'x-order-key': 'acct-3'}}
+    #---
+
+    def test_TenantKeepsTheOrderKey(self):
+        """
+        Tests that a client's tenant is sent alongside the ordering key, not instead of it.
+
+        """
+        self.client.tenant = 'acme'
+        self.client._proxy_handler('deposit', 'accounts', 'acct-3', 10)
+
+        assert self.client.rabbit_producer.send.call_args[1]['headers'] == {'x-order-key': 'acct-3', 'x-tenant': 'acme'}
+    #---
+#---
+
+class Test_concurrency_limit(object):
+    """
+    Tests RPCClient's adaptive concurrency limits
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({}, concurrency_limit={'initial_limit': 1, 'min_limit': 1})
+        self.client.definitions = {
+            'reports': {
+                'build': {'args': {'defined': {'var': None, 'kw': None}, 'kwargs_var': None, 'varargs_var': None},
+                          'doc': None, 'options': {}},
+            }
+        }
+        self.client._result_handler = mock.MagicMock()
+        self.client.rabbit_producer.send.return_value = rpcclient.cPickle.dumps({'result': None, 'error': None})
+    #---
+
+    def test_UnknownScopeIsRefused(self):
+        """
+        Tests that an unknown `per` setting is refused.
+
+        """
+        with pytest.raises(self.localclient.RPCClientError):
+            self.localclient.RPCClient({}, concurrency_limit={'per': 'host'})
+    #---
+
+    def test_CallsOverTheLimitFailFast(self):
+        """
+        Tests that a call over its endpoint's limit is refused without being sent.
+
+        """
+        self.client._limiter('reports.build').acquire()
+
+        with pytest.raises(self.localclient.limiter.ConcurrencyLimitError):
+            self.client._proxy_handler('build', 'reports')
+
+        assert self.client.rabbit_producer.send.called is False
+        assert self.client.stats['limited_calls'] == 1
+    #---
+
+    def test_CallsReleaseTheirSlot(self):
+        """
+        Tests that finished calls, and timed out ones, give their slot back.
+
+        """
+        self.client._proxy_handler('build', 'reports')
+        self.client.rabbit_producer.send.side_effect = rpcclient.producer.ReplyTimeoutError()
+
+        with pytest.raises(rpcclient.producer.ReplyTimeoutError):
+            self.client._proxy_handler('build', 'reports')
+
+        assert self.client._limiters['reports.build'].in_flight == 0
+        assert self.client.stats['limit.reports.build'] == 1
+    #---
+
+    def test_LimitPerQueue(self):
+        """
+        Tests that with `per` set to 'queue' the limit is kept per destination queue.
+
+        """
+        self.client.concurrency_limit['per'] = 'queue'
+        self.client._proxy_handler('build', 'reports')
+
+        assert self.client._limiters.keys() == ['rabbitrpc']
+    #---
+#---
+
+class Test_hedging(object):
+    """
+    Tests RPCClient's hedging of calls to idempotent endpoints
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({}, hedging={'min_samples': 3, 'percentile': 50})
+        self.client.definitions = {
+            'users': {
+                'lookup': {'args': {'defined': {'var': None, 'kw': None}, 'kwargs_var': None, 'varargs_var': None},
+                           'doc': None, 'options': {'idempotent': True}},
+                'create': {'args': {'defined': {'var': None, 'kw': None}, 'kwargs_var': None, 'varargs_var': None},
+                           'doc': None, 'options': {}},
+            }
+        }
+        self.client._result_handler = mock.MagicMock()
+        self.client.rabbit_producer.send.return_value = rpcclient.cPickle.dumps({'result': None, 'error': None})
+    #---
+
+    def test_ProducerSharesTheClientStats(self):
+        """
+        Tests that the producer counts hedges in the client's stats.
+
+        """
+        assert self.localclient.producer.Producer.call_args[1] == {'counters': self.client.stats}
+    #---
+
+    def test_HedgesOnceThereAreEnoughSamples(self):
+        """
+        Tests that calls are hedged after the percentile of the endpoint's recent latencies, once known.
+
+        """
+        for _ in range(3):
+            self.client._proxy_handler('lookup', 'users')
+            assert 'hedge_after' not in self.client.rabbit_producer.send.call_args[1]
+
+        window = self.client._latency_window('users', 'lookup')
+        self.client._proxy_handler('lookup', 'users')
+
+        assert self.client.rabbit_producer.send.call_args[1]['hedge_after'] >= 0
+        assert len(window) == 4
+        assert self.client.stats['idempotent_calls'] == 4
+    #---
+
+    def test_OtherEndpointsAreNotHedged(self):
+        """
+        Tests that endpoints not registered as idempotent are never hedged or timed.
+
+        """
+        for _ in range(5):
+            self.client._proxy_handler('create', 'users')
+
+        assert 'hedge_after' not in self.client.rabbit_producer.send.call_args[1]
+        assert self.client._latencies == {}
+    #---
+#---
+
+class Test_call_options(object):
+    """
+    Tests RPCClient's `call_options` method and call priorities
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({})
+        self.client.definitions = {
+            'rpcendpoints': {
+                'backfill': {'args': None, 'doc': None, 'options': {'priority': 1, 'durability': 'safe'}},
+                'lookup': {'args': None, 'doc': None, 'options': {}},
+            }
+        }
+        self.client._result_handler = mock.MagicMock()
+        self.client.rabbit_producer.send.return_value = rpcclient.cPickle.dumps({'result': None, 'error': None})
+    #---
+
+    def sent_priority(self):
+        return self.client.rabbit_producer.send.call_args[1].get('priority')
+    #---
+
+    def test_EndpointDefaultIsUsed(self):
+        """
+        Tests that calls use their endpoint's default priority.
+
+        """
+        self.client._proxy_handler('backfill', 'rpcendpoints')
+
+        assert self.sent_priority() == 1
+    #---
+
+    def test_CallSiteOverridesEndpointDefault(self):
+        """
+        Tests that a priority set with call_options overrides the endpoint's default, only within the block.
+
+        """
+        with self.client.call_options(priority=9):
+            self.client._proxy_handler('backfill', 'rpcendpoints')
+            assert self.sent_priority() == 9
+
+        self.client._proxy_handler('lookup', 'rpcendpoints')
+        assert self.sent_priority() is None
+    #---
+
+    def test_DurabilityFollowsEndpointUnlessOverridden(self):
+        """
+        Tests that calls use their endpoint's durability profile, which call_options may override.
+
+        """
+        self.client._proxy_handler('backfill', 'rpcendpoints')
+        assert self.client.rabbit_producer.send.call_args[1]['durability'] == 'safe'
+
+        with self.client.call_options(durability='fast'):
+            self.client._proxy_handler('backfill', 'rpcendpoints')
+            assert self.client.rabbit_producer.send.call_args[1]['durability'] == 'fast'
+
+        self.client._proxy_handler('lookup', 'rpcendpoints')
+        assert 'durability' not in self.client.rabbit_producer.send.call_args[1]
+    #---
+
+    def test_OptionsAreThreadLocal(self):
+        """
+        Tests that call options set in one thread do not apply to calls from another.
+
+        """
+        priorities = []
+
+        def call():
+            self.client._proxy_handler('lookup', 'rpcendpoints')
+            priorities.append(self.sent_priority())
+        #---
+
+        with self.client.call_options(priority=9):
+            thread = threading.Thread(target=call)
+            thread.start()
+            thread.join()
+
+        assert priorities == [None]
+    #---
+
+    def test_UnknownOptionsAreRefused(self):
+        """
+        Tests that unknown call options raise RPCClientError.
+
+        """
+        with pytest.raises(rpcclient.RPCClientError):
+            with self.client.call_options(colour='red'):
+                pass
+    #---
+#---
+
+class Test_tenant(object):
+    """
+    Tests RPCClient's tenant identity on calls
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localclient = reload(rpcclient)
+
+        self.localclient.logging = mock.MagicMock()
+        self.localclient.producer.Producer = mock.MagicMock()
+
+        self.client = self.localclient.RPCClient({}, tenant='billing')
+        self.client.definitions = {'rpcendpoints': {'lookup': {'args': None, 'doc': None, 'options': {}}}}
+        self.client._result_handler = mock.MagicMock()
+        self.client.rabbit_producer.send.return_value = rpcclient.cPickle.dumps({'result': None, 'error': None})
+    #---
+
+    def test_CallsCarryTheTenant(self):
+        """
+        Tests that calls are sent with the client's tenant in their headers.
+
+        """
+        self.client._proxy_handler('lookup', 'rpcendpoints')
+
+        assert self.client.rabbit_producer.send.call_args[1]['headers'] == {'x-tenant': 'billing'}
+    #---
+
+    def test_NoTenantNoHeader(self):
+        """
+        Tests that clients without a tenant send no tenant header.
+
+        """
+        self.client.tenant = None
+        self.client._proxy_handler('lookup', 'rpcendpoints')
+
+        assert 'headers' not in self.client.rabbit_producer.send.call_args[1]
+    #---
+#---
+
 class Test__result_handler(object):
     """
     Tests RPCClient's `_result_handler` method
@@ -0,0 +1,134 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_acks.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests for the acks module.
+#
+
+import mock
+from rabbitrpc.rabbitmq import acks
+
+
+class Test_AckBatcher(object):
+    """
+    Tests the AckBatcher class.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.now = 0.0
+        self.channel = mock.MagicMock()
+        self.batcher = acks.AckBatcher(self.channel, max_batch=3, max_delay=0.05, clock=lambda: self.now)
+
+        for delivery_tag in (1, 2, 3, 4):
+            self.batcher.delivered(delivery_tag)
+    #---
+
+    def test_AcksInOneFrameAtTheBatchSize(self):
+        """
+        Tests that a full batch goes out as a single multiple ack of its last tag.
+
+        """
+        for delivery_tag in (1, 2):
+            self.batcher.ack(delivery_tag)
+        assert self.channel._impl.basic_ack.called is False
+
+        self.batcher.ack(3)
+
+        self.channel._impl.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+        assert len(self.batcher) == 0
+        assert (self.batcher.stats['ack_batches'], self.batcher.stats['batched_acks']) == (1, 3)
+    #---
+
+    def test_NeverAcksPastAnUnfinishedMessage(self):
+        """
+        Tests that the multiple ack stops short of a message still being worked on, and that the messages finished
+        behind it are acked one by one rather than held back.
+
+        """
+        for delivery_tag in (1, 3, 4):
+            self.batcher.ack(delivery_tag)
+
+        assert self.channel._impl.basic_ack.call_args_list == [mock.call(delivery_tag=1, multiple=True),
+                                                               mock.call(delivery_tag=3), mock.call(delivery_tag=4)]
+        assert (len(self.batcher), self.batcher.stats['unbatched_acks']) == (0, 2)
+
+        self.batcher.ack(2)
+        self.batcher.flush()
+
+        self.channel._impl.basic_ack.assert_called_with(delivery_tag=2, multiple=True)
+    #---
+
+    def test_BatchIsCappedAtHalfThePrefetch(self):
+        """
+        Tests that a small prefetch flushes before max_batch is reached.
+
+        """
+        batcher = acks.AckBatcher(self.channel, max_batch=50, prefetch=4)
+        for delivery_tag in (1, 2):
+            batcher.delivered(delivery_tag)
+            batcher.ack(delivery_tag)
+
+        self.channel._impl.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+        assert acks.AckBatcher(self.channel, max_batch=50, prefetch=1).batch_size == 1
+    #---
+
+    def test_RejectsAtOnceAndSkipsThem(self):
+        """
+        Tests that rejects go out straight away, and batches ack past them with an acked tag.
+
+        """
+        self.batcher.ack(1)
+        self.batcher.reject(2, False)
+        self.batcher.flush()
+
+        self.channel.basic_reject.assert_called_once_with(delivery_tag=2, requeue=False)
+        self.channel._impl.basic_ack.assert_called_once_with(delivery_tag=1, multiple=True)
+        assert list(self.batcher._deliveries) == [3, 4]
+    #---
+
+    def test_DueAfterMaxDelay(self):
+        """
+        Tests that a flush is due once the oldest waiting ack has waited max_delay.
+
+        """
+        assert self.batcher.due() is False
+        self.batcher.ack(1)
+        assert self.batcher.due() is False
+
+        self.now += 0.05
+        assert self.batcher.due() is True
+    #---
+
+    def test_UnknownDeliveriesAreAckedAtOnce(self):
+        """
+        Tests that messages that were not recorded as delivered are acked on their own, straight away.
+
+        """
+        self.batcher.ack(9)
+
+        self.channel.basic_ack.assert_called_once_with(delivery_tag=9)
+        assert len(self.batcher) == 0
+    #---
+#---
@@ -0,0 +1,158 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_adaptive.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests for the adaptive module.
+#
+
+from rabbitrpc.rabbitmq import adaptive
+
+
+class Test_AdaptiveController(object):
+    """
+    Tests the AdaptiveController class.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.now = 0.0
+        self.controller = adaptive.AdaptiveController(0.1, min_workers=2, max_workers=10, interval=1.0, workers=4,
+                                                      prefetch_ratio=1.5, clock=lambda: self.now)
+    #---
+
+    def run_window(self, calls, wait, service):
+        """
+        Records `calls` calls over one interval and makes a decision.
+
+        """
+        for _ in range(calls):
+            self.controller.delivered()
+            self.controller.completed(wait, service)
+
+        self.now += 1.0
+        return self.controller.adjust()
+    #---
+
+    def test_StartsAtTheGivenSize(self):
+        """
+        Tests that the controller starts at the given size, with the prefetch ratio applied.
+
+        """
+        assert (self.controller.workers, self.controller.prefetch) == (4, 6)
+        assert self.controller.stats['adaptive.workers'] == 4
+    #---
+
+    def test_DueAfterInterval(self):
+        """
+        Tests that a decision is due once the interval has passed.
+
+        """
+        assert self.controller.due() is False
+        self.now += 1.0
+        assert self.controller.due() is True
+    #---
+
+    def test_GrowsToLittlesLawEstimate(self):
+        """
+        Tests that a saturated pool grows straight to the size the arrival rate needs.
+
+        """
+        # 4 workers fully busy at 50ms, but 160 calls/s arrive: 160 x 0.05 / 0.85 -> 10
+        for _ in range(160):
+            self.controller.delivered()
+        for _ in range(80):
+            self.controller.completed(0.2, 0.05)
+        self.now += 1.0
+
+        assert self.controller.adjust() == (10, 15)
+        assert self.controller.stats['adaptive.increase'] == 1
+    #---
+
+    def test_GrowsByOneOverTarget(self):
+        """
+        Tests that latency over target grows the pool by at least one worker.
+
+        """
+        assert self.run_window(10, 0.2, 0.01) == (5, 8)
+    #---
+
+    def test_ShrinksWhenIdle(self):
+        """
+        Tests that a mostly idle pool well within target shrinks by one.
+
+        """
+        assert self.run_window(10, 0.0, 0.01) == (3, 5)
+        assert self.controller.stats['adaptive.decrease'] == 1
+    #---
+
+    def test_BacksOffOnContention(self):
+        """
+        Tests that service times well above the best seen shrink the pool multiplicatively.
+
+        """
+        self.run_window(40, 0.0, 0.01)
+        self.controller._set_workers(8)
+
+        assert self.run_window(40, 0.0, 0.05) == (5, 8)
+        assert self.controller.stats['adaptive.backoff'] == 1
+    #---
+
+    def test_StaysWithinBounds(self):
+        """
+        Tests that decisions never leave the configured bounds.
+
+        """
+        for _ in range(5):
+            self.run_window(1000, 1.0, 0.05)
+        assert self.controller.workers == 10
+
+        for _ in range(20):
+            self.now += 1.0
+            self.controller.adjust()
+        assert self.controller.workers == 2
+    #---
+
+    def test_KeepsSizeWhileCallsAreStuck(self):
+        """
+        Tests that a window with no completions but calls in flight changes nothing.
+
+        """
+        self.controller.delivered()
+        self.now += 1.0
+
+        assert self.controller.adjust() == (4, 6)
+    #---
+
+    def test_DroppedCallsAreNoLongerInFlight(self):
+        """
+        Tests that calls dropped without running don't keep the pool from shrinking when idle.
+
+        """
+        self.controller.delivered()
+        self.controller.dropped()
+        self.now += 1.0
+
+        assert self.controller.adjust()[0] == 3
+    #---
+#---
@@ -0,0 +1,44 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_channels.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests for the channels module.
+#
+
+import mock
+from rabbitrpc.rabbitmq import channels
+
+
+class Test_underlying(object):
+    """
+    Tests the underlying function.
+
+    """
+    def test_ProvidesTheChannelUnderTheBlockingOne(self):
+        """
+        Tests that underlying returns the pika channel a BlockingChannel wraps.
+
+        """
+        channel = mock.MagicMock()
+
+        assert channels.underlying(channel) is channel._impl
+    #---
+#---
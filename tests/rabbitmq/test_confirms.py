@@ -0,0 +1,220 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_confirms.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests for the confirms module.
+#
+
+import mock
+import pytest
+from pika import frame, spec
+from rabbitrpc.rabbitmq import confirms
+
+
+class Test_ConfirmTracker(object):
+    """
+    Tests the ConfirmTracker class.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.connection = mock.MagicMock()
+        self.channel = mock.MagicMock()
+        self.tracker = confirms.ConfirmTracker(self.connection, self.channel, max_unconfirmed=3, max_retries=1)
+    #---
+
+    def confirm(self, method_class, delivery_tag, multiple = False):
+        self.tracker._onConfirm(frame.Method(1, method_class(delivery_tag=delivery_tag, multiple=multiple)))
+    #---
+
+    def publish(self, count):
+        for number in range(count):
+            self.tracker.publish(exchange='', routing_key='q', body='m%i' % number)
+    #---
+
+    def test_StartPutsTheChannelInConfirmMode(self):
+        """
+        Tests that start turns confirms on without waiting for the broker's reply.
+
+        """
+        self.tracker.start()
+
+        self.channel._impl.confirm_delivery.assert_called_once_with(self.tracker._onConfirm, nowait=True)
+    #---
+
+    def test_PublishesWithoutWaiting(self):
+        """
+        Tests that messages are published straight away while under the unconfirmed limit.
+
+        """
+        self.publish(3)
+
+        assert self.channel.basic_publish.call_count == 3
+        assert len(self.tracker) == 3
+        assert self.connection.process_data_events.called is False
+    #---
+
+    def test_WaitsAtTheUnconfirmedLimit(self):
+        """
+        Tests that publishing services the connection until a confirm frees room under the limit.
+
+        """
+        self.publish(3)
+        self.connection.process_data_events.side_effect = lambda time_limit: self.confirm(spec.Basic.Ack, 1)
+        self.publish(1)
+
+        assert self.connection.process_data_events.call_count == 1
+        assert len(self.tracker) == 3
+    #---
+
+    def test_WaitingBlocksForThePollInterval(self):
+        """
+        Tests that waiting services the connection for a bounded time rather than polling it without blocking, and
+        for no longer than the timeout left.
+
+        """
+        self.publish(1)
+        self.connection.process_data_events.side_effect = lambda time_limit: self.confirm(spec.Basic.Ack, 1)
+        self.tracker.wait()
+        self.connection.process_data_events.assert_called_once_with(time_limit=0.01)
+
+        self.publish(1)
+        self.connection.process_data_events.side_effect = lambda time_limit: self.confirm(spec.Basic.Ack, 2)
+        self.tracker.waitFor(2, timeout=0.001)
+        assert 0 <= self.connection.process_data_events.call_args[1]['time_limit'] <= 0.001
+    #---
+
+    def test_MultipleAckSettlesEarlierTags(self):
+        """
+        Tests that an ack with `multiple` set settles every message up to its tag.
+
+        """
+        self.publish(3)
+        self.confirm(spec.Basic.Ack, 2, multiple=True)
+
+        assert list(self.tracker._unconfirmed) == [3]
+        assert self.tracker.stats['confirms.acked'] == 2
+    #---
+
+    def test_NackedMessageIsPublishedAgain(self):
+        """
+        Tests that a nacked message is published again the next time the tracker is used, under a new tag.
+
+        """
+        self.publish(1)
+        self.confirm(spec.Basic.Nack, 1)
+        self.tracker.resendNacked()
+
+        assert self.channel.basic_publish.call_args_list[1] == mock.call(exchange='', routing_key='q', body='m0')
+        assert list(self.tracker._unconfirmed) == [2]
+        assert self.tracker.stats['confirms.retried'] == 1
+    #---
+
+    def test_GivesUpAfterMaxRetries(self):
+        """
+        Tests that a message nacked past its retries is given up on, and wait reports it.
+
+        """
+        self.publish(1)
+        self.confirm(spec.Basic.Nack, 1)
+        self.tracker.resendNacked()
+        self.confirm(spec.Basic.Nack, 2)
+
+        with pytest.raises(confirms.PublishFailedError):
+            self.tracker.wait()
+        assert self.tracker.stats['confirms.failed'] == 1
+        assert self.tracker.failed == 0
+    #---
+
+    def test_WaitReturnsOnceConfirmed(self):
+        """
+        Tests that wait services the connection until everything is confirmed.
+
+        """
+        self.publish(2)
+        self.connection.process_data_events.side_effect = lambda time_limit: self.confirm(spec.Basic.Ack, 2, multiple=True)
+        self.tracker.wait()
+
+        assert len(self.tracker) == 0
+    #---
+
+    def test_WaitForWaitsForItsMessageOnly(self):
+        """
+        Tests that waitFor returns once its message is confirmed, with others still unconfirmed.
+
+        """
+        self.publish(1)
+        tag = self.tracker.publish(exchange='', routing_key='q', body='mine')
+        self.connection.process_data_events.side_effect = lambda time_limit: self.confirm(spec.Basic.Ack, tag)
+        self.tracker.waitFor(tag)
+
+        assert (tag, len(self.tracker), self.connection.process_data_events.call_count) == (2, 1, 1)
+    #---
+
+    def test_WaitForFollowsRetries(self):
+        """
+        Tests that waitFor waits through its message's retries, and reports it given up on to it alone.
+
+        """
+        self.publish(1)
+        tag = self.tracker.publish(exchange='', routing_key='q', body='mine')
+        confirms_due = [(spec.Basic.Nack, 2), (spec.Basic.Nack, 3)]
+        self.connection.process_data_events.side_effect = lambda time_limit: self.confirm(*confirms_due.pop(0))
+
+        with pytest.raises(confirms.PublishFailedError):
+            self.tracker.waitFor(tag)
+
+        # Already reported, so wait only sees the first message confirmed
+        self.confirm(spec.Basic.Ack, 1)
+        self.tracker.wait()
+    #---
+
+    def test_WaitForIgnoresOthersFailures(self):
+        """
+        Tests that waitFor does not report other messages given up on, leaving them to wait.
+
+        """
+        self.publish(1)
+        self.confirm(spec.Basic.Nack, 1)
+        self.tracker.resendNacked()
+        self.confirm(spec.Basic.Nack, 2)
+        tag = self.tracker.publish(exchange='', routing_key='q', body='mine')
+        self.confirm(spec.Basic.Ack, tag)
+
+        self.tracker.waitFor(tag)
+        with pytest.raises(confirms.PublishFailedError):
+            self.tracker.wait()
+    #---
+
+    def test_WaitTimesOut(self):
+        """
+        Tests that wait gives up once its timeout passes with messages still unconfirmed.
+
+        """
+        self.publish(1)
+
+        with pytest.raises(confirms.ConfirmTimeoutError):
+            self.tracker.wait(timeout=0)
+    #---
+#---
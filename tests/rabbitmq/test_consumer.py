@@ -73,6 +73,18 @@ class Test___init__(object):
         assert rpc.config == config
     #---
 
+    def test_ConfigIsPerInstance(self):
+        """
+        Tests that each consumer's config is its own, leaving the class defaults and other consumers alone.
+
+        """
+        other = self.localrpc.Consumer(self.callback, {'queue_name': 'other', 'workers': 4})
+
+        assert (other.config['queue_name'], self.rpc.config['queue_name']) == ('other', 'rabbitrpc')
+        assert 'workers' not in self.rpc.config
+        assert self.localrpc.Consumer.config['queue_name'] == 'rabbitrpc'
+    #---
+
     def test_SetsUpLogger(self):
         """
         Tests that __init__ setts up a logging instance.
@@ -332,6 +344,18 @@ class Test__consumerCallback(object):
         self.BasicProperties.assert_called_once_with(delivery_mode=2, correlation_id=self.correlation_id)
     #---
 
+    def test_RepliesToTransientCallsAreTransient(self):
+        """
+        Tests that the reply to a transient ('fast' durability) call is transient too.
+
+        """
+        self.BasicProperties.reset_mock()
+        self.props.delivery_mode = 1
+        self.rpc._consumerCallback('', self.method, self.props, self.body)
+
+        self.BasicProperties.assert_called_once_with(delivery_mode=1, correlation_id=self.correlation_id)
+    #---
+
     def test_CallsBasicPublish(self):
         """
         Tests that _consumerCallback calls basic_publish with the appropriate arguments.
@@ -430,6 +454,50 @@ class Test__connect(object):
         self.channel.basic_consume.assert_called_once_with(self.rpc._consumerCallback,
                                                            queue=self.rpc.config['queue_name'])
     #---
+
+    def test_BindsAddedQueues(self):
+        """
+        Tests that _connect declares the exchanges an added queue is bound to, and binds it.
+
+        """
+        self.rpc.addQueue('rabbitrpc.instance', bindings=[('rabbitrpc.hash', 'x-consistent-hash', '10')])
+        self.rpc._connect()
+
+        self.channel.exchange_declare.assert_called_once_with(exchange='rabbitrpc.hash',
+                                                              exchange_type='x-consistent-hash', durable=True)
+        self.channel.queue_bind.assert_called_once_with(queue='rabbitrpc.instance', exchange='rabbitrpc.hash',
+                                                        routing_key='10')
+    #---
+
+    def test_DeclaresPriorityQueueIfConfigured(self):
+        """
+        Tests that _connect declares the queues with x-max-priority when max_priority is configured.
+
+        """
+        self.channel.reset_mock()
+        self.rpc.config['max_priority'] = 9
+        self.rpc.addQueue('rabbitrpc.instance', exclusive=True)
+        self.rpc._connect()
+        del self.rpc.config['max_priority']
+
+        assert self.channel.queue_declare.call_args_list == [
+            mock.call(queue=self.rpc.config['queue_name'], durable=True, arguments={'x-max-priority': 9}),
+            mock.call(queue='rabbitrpc.instance', exclusive=True, arguments={'x-max-priority': 9}),
+        ]
+    #---
+
+    def test_ConsumesAddedQueues(self):
+        """
+        Tests that _connect declares and consumes the queues added with addQueue.
+
+        """
+        self.channel.reset_mock()
+        self.rpc.addQueue('rabbitrpc.instance', exclusive=True)
+        self.rpc._connect()
+
+        self.channel.queue_declare.assert_called_with(queue='rabbitrpc.instance', exclusive=True)
+        self.channel.basic_consume.assert_called_with(self.rpc._consumerCallback, queue='rabbitrpc.instance')
+    #---
 #---
 
 
@@ -510,4 +578,1030 @@ class Test__createCredentials(object):
         """
         assert self.rpc.config['connection_settings']['credentials'] == self.creds
     #---
-#---
\ No newline at end of file
+#---
+class Test_threaded(object):
+    """
+    Tests the consumer's threaded mode, used when there is more than one worker.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.pika.BasicProperties = mock.MagicMock(return_value='Props')
+
+        self.callback = mock.MagicMock(return_value='response')
+        self.rpc = self.localrpc.Consumer(self.callback, {'workers': 4})
+        self.rpc.channel = mock.MagicMock()
+        self.rpc.connection = mock.MagicMock()
+
+        self.method = mock.MagicMock()
+        type(self.method).delivery_tag = mock.PropertyMock(return_value='taggems')
+        self.props = mock.MagicMock()
+        type(self.props).reply_to = mock.PropertyMock(return_value='bob.bob')
+    #---
+
+    def teardown_method(self, method):
+        if self.rpc._pool:
+            self.rpc._pool.stop()
+    #---
+
+    def test_RunStartsWorkerPoolAndLoop(self):
+        """
+        Tests that run starts a pool of the configured size and services the connection itself.
+
+        """
+        self.rpc._connect = mock.MagicMock()
+        self.rpc._processLoop = mock.MagicMock()
+        self.rpc.run()
+
+        assert self.rpc._pool.size == 4
+        self.rpc._processLoop.assert_called_once_with()
+        assert self.rpc.channel.start_consuming.called is False
+    #---
+
+    def test_PrefetchDefaultsToWorkerCount(self):
+        """
+        Tests that the prefetch count follows the worker count unless it is configured.
+
+        """
+        self.localrpc.pika.BlockingConnection = mock.MagicMock()
+        self.rpc.connection_params = {}
+        self.rpc._connect()
+
+        channel = self.localrpc.pika.BlockingConnection.return_value.channel.return_value
+        channel.basic_qos.assert_called_once_with(prefetch_count=4)
+    #---
+
+    def test_CallbackHandsMessageToPool(self):
+        """
+        Tests that _consumerCallback submits messages to the pool instead of running the callback.
+
+        """
+        self.rpc._pool = mock.MagicMock()
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+
+        self.rpc._pool.submit.assert_called_once_with((self.method, self.props, 'body'))
+        assert self.callback.called is False
+    #---
+
+    def test_CallbackPassesOrderKeyToPool(self):
+        """
+        Tests that _consumerCallback submits messages carrying an ordering key with that key.
+
+        """
+        self.rpc._pool = mock.MagicMock()
+        type(self.props).headers = mock.PropertyMock(return_value={'x-order-key': 'acct-1'})
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+
+        self.rpc._pool.submit.assert_called_once_with((self.method, self.props, 'body'), 'acct-1')
+    #---
+
+    def test_WorkersHandBackOutcome(self):
+        """
+        Tests that _runTask runs the callback and queues the outcome for the connection thread.
+
+        """
+        self.rpc._runTask((self.method, self.props, 'body'))
+
+        self.callback.assert_called_once_with('body')
+        assert self.rpc.channel.basic_ack.called is False
+        assert self.rpc._completed.get_nowait() == (self.method, self.props, 'response', None)
+    #---
+
+    def test_FinishCompletedRepliesAndAcknowledges(self):
+        """
+        Tests that _finishCompleted replies to and acknowledges every completed message.
+
+        """
+        self.rpc._runTask((self.method, self.props, 'body'))
+        self.rpc._runTask((self.method, self.props, 'body'))
+        self.rpc._finishCompleted()
+
+        assert self.rpc.channel.basic_publish.call_count == 2
+        assert self.rpc.channel.basic_ack.call_count == 2
+    #---
+
+    def test_FinishCompletedRejectsFailures(self):
+        """
+        Tests that _finishCompleted requeues messages whose callback failed for the first time.
+
+        """
+        self.callback.side_effect = ValueError()
+        type(self.method).redelivered = mock.PropertyMock(return_value=False)
+        self.rpc.log = mock.MagicMock()
+
+        self.rpc._runTask((self.method, self.props, 'body'))
+        self.rpc._finishCompleted()
+
+        self.rpc.channel.basic_reject.assert_called_once_with(delivery_tag='taggems', requeue=True)
+    #---
+
+    def test_StopStopsPool(self):
+        """
+        Tests that stop shuts down the worker pool and ends the loop.
+
+        """
+        pool = self.rpc._pool = mock.MagicMock()
+        self.rpc._running = True
+        self.rpc.stop()
+
+        pool.stop.assert_called_once_with()
+        assert self.rpc._running is False
+    #---
+#---
+
+class Test_adaptive(object):
+    """
+    Tests the consumer's adaptive pool sizing.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.pika.BasicProperties = mock.MagicMock(return_value='Props')
+
+        self.callback = mock.MagicMock(return_value='response')
+        self.rpc = self.localrpc.Consumer(self.callback, {'latency_target': 0.1, 'workers': 2, 'max_workers': 8})
+        self.rpc.channel = mock.MagicMock()
+        self.rpc.connection = mock.MagicMock()
+
+        self.method = mock.MagicMock()
+        type(self.method).delivery_tag = mock.PropertyMock(return_value='taggems')
+        self.props = mock.MagicMock()
+    #---
+
+    def teardown_method(self, method):
+        if self.rpc._pool:
+            self.rpc._pool.stop()
+        for name in ('latency_target', 'workers', 'max_workers'):
+            del self.rpc.config[name]
+    #---
+
+    def test_RunStartsAdaptivePool(self):
+        """
+        Tests that run starts the pool at the configured size with a controller sharing the consumer's stats.
+
+        """
+        self.rpc._connect = mock.MagicMock()
+        self.rpc._processLoop = mock.MagicMock()
+        self.rpc.run()
+
+        assert self.rpc._pool.size == 2
+        assert (self.rpc._adaptive.min_workers, self.rpc._adaptive.max_workers) == (1, 8)
+        assert self.rpc.stats['adaptive.workers'] == 2
+        self.rpc._processLoop.assert_called_once_with()
+    #---
+
+    def test_TasksAreMeasured(self):
+        """
+        Tests that calls handed to the pool are timed from delivery.
+
+        """
+        self.rpc._adaptive = mock.MagicMock()
+        self.rpc._pool = mock.MagicMock()
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+        self.rpc._runTask((self.method, self.props, 'body'))
+
+        self.rpc._adaptive.delivered.assert_called_once_with()
+        wait, service = self.rpc._adaptive.completed.call_args[0]
+        assert wait >= 0 and service >= 0
+        assert self.rpc._delivered == {}
+    #---
+
+    def test_AdaptResizesPoolAndPrefetch(self):
+        """
+        Tests that _adapt applies the controller's decision to the pool and the channel's prefetch.
+
+        """
+        self.rpc._adaptive = mock.MagicMock()
+        self.rpc._adaptive.adjust.return_value = (5, 5)
+        self.rpc._pool = mock.MagicMock(size=2)
+        self.rpc._prefetch = 2
+        self.rpc._adapt()
+
+        self.rpc._pool.resize.assert_called_once_with(5)
+        self.rpc.channel.basic_qos.assert_called_once_with(prefetch_count=5)
+    #---
+#---
+
+class Test_cancellation(object):
+    """
+    Tests the consumer's handling of cancelled calls.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.pika.BasicProperties = mock.MagicMock(return_value='Props')
+
+        self.callback = mock.MagicMock(return_value='response')
+        self.rpc = self.localrpc.Consumer(self.callback, {'cancellation': True})
+        self.rpc.channel = mock.MagicMock()
+
+        self.method = mock.MagicMock()
+        type(self.method).delivery_tag = mock.PropertyMock(return_value='taggems')
+        self.props = mock.MagicMock()
+        self.props.correlation_id = 'call-1'
+    #---
+
+    def teardown_method(self, method):
+        del self.rpc.config['cancellation']
+    #---
+
+    def test_ConnectListensForCancellations(self):
+        """
+        Tests that _connect binds a queue of its own to the fanout cancel exchange.
+
+        """
+        self.localrpc.pika.BlockingConnection = mock.MagicMock()
+        channel = self.localrpc.pika.BlockingConnection.return_value.channel.return_value
+        channel.queue_declare.return_value.method.queue = 'amq.gen-1'
+        self.rpc.connection_params = {}
+        self.rpc._connect()
+
+        channel.exchange_declare.assert_called_once_with(exchange='rabbitrpc.cancel', exchange_type='fanout',
+                                                         durable=True)
+        channel.queue_declare.assert_called_with(exclusive=True)
+        channel.queue_bind.assert_called_once_with(queue='amq.gen-1', exchange='rabbitrpc.cancel')
+        channel.basic_consume.assert_called_with(self.rpc._cancelCallback, queue='amq.gen-1', no_ack=True)
+    #---
+
+    def test_CancelledCallIsSkipped(self):
+        """
+        Tests that a call cancelled before it starts is acknowledged without running or replying.
+
+        """
+        self.rpc._cancelCallback('', '', '', 'call-1')
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+
+        assert self.callback.called is False
+        assert self.rpc.channel.basic_publish.called is False
+        self.rpc.channel.basic_ack.assert_called_once_with(delivery_tag='taggems')
+        assert (self.rpc.stats['cancellations'], self.rpc.stats['cancelled_calls']) == (1, 1)
+    #---
+
+    def test_RunningCallSeesItsQueueWait(self):
+        """
+        Tests that the callback runs with its call's queue wait, measured from the publishing time header.
+
+        """
+        waits = []
+        self.callback.side_effect = lambda body: waits.append(self.localrpc.admission.queue_wait())
+        self.props.headers = {'x-sent-at': long((self.localrpc.time.time() - 1) * 1000)}
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+
+        assert 0.9 < waits[0] < 2
+    #---
+
+    def test_RunningCallSeesItsToken(self):
+        """
+        Tests that the callback runs with its call's cancellation token current.
+
+        """
+        tokens = []
+        self.callback.side_effect = lambda body: tokens.append(self.localrpc.cancellation.current_token())
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+
+        assert tokens[0].call_id == 'call-1'
+        self.rpc._cancelCallback('', '', '', 'call-1')
+        assert tokens[0].cancelled is True
+    #---
+#---
+
+class Test_retry(object):
+    """
+    Tests delayed retries and dead-lettering of failed messages.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.pika.BasicProperties = mock.MagicMock(return_value='Props')
+        self.localrpc.logging = mock.MagicMock()
+
+        self.callback = mock.MagicMock(side_effect=ValueError('boom'))
+        self.rpc = self.localrpc.Consumer(self.callback, {'retry': {'max_attempts': 3, 'base_delay': 1.0}})
+        self.rpc.channel = mock.MagicMock()
+
+        self.method = mock.MagicMock()
+        type(self.method).delivery_tag = mock.PropertyMock(return_value='taggems')
+        self.props = mock.MagicMock(headers={'x-attempts': 1}, reply_to='replies', correlation_id='call-1',
+                                    priority=None)
+    #---
+
+    def teardown_method(self, method):
+        del self.rpc.config['retry']
+    #---
+
+    def test_FailedMessageGoesToDelayQueue(self):
+        """
+        Tests that a failed message is acknowledged and published to the delay queue for its next attempt.
+
+        """
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+
+        self.rpc.channel.queue_declare.assert_called_once_with(
+            queue='rabbitrpc.retry.2000', durable=True,
+            arguments={'x-message-ttl': 2000, 'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': 'rabbitrpc'})
+        self.rpc.channel.basic_publish.assert_called_once_with(exchange='', routing_key='rabbitrpc.retry.2000',
+                                                               properties='Props', body='body')
+        self.localrpc.pika.BasicProperties.assert_called_once_with(headers={'x-attempts': 2}, delivery_mode=2,
+                                                                   reply_to='replies', correlation_id='call-1',
+                                                                   priority=None)
+        self.rpc.channel.basic_ack.assert_called_once_with(delivery_tag='taggems')
+        assert self.rpc.channel.basic_reject.called is False
+        assert self.rpc.stats['retried_messages'] == 1
+    #---
+
+    def test_DelayQueueDeclaredOnce(self):
+        """
+        Tests that each delay queue is declared only the first time it is used.
+
+        """
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+
+        assert self.rpc.channel.queue_declare.call_count == 1
+    #---
+
+    def test_RetriesOnTheQueueTheMessageCameFrom(self):
+        """
+        Tests that messages from an added queue go back to that queue.
+
+        """
+        self.rpc._consumer_queues['ctag'] = 'rabbitrpc.reports'
+        self.method.consumer_tag = 'ctag'
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+
+        assert self.rpc.channel.basic_publish.call_args[1]['routing_key'] == 'rabbitrpc.reports.retry.2000'
+    #---
+
+    def test_ExhaustedMessageIsDeadLettered(self):
+        """
+        Tests that a message out of attempts goes to the dead letter exchange with its last error.
+
+        """
+        self.props.headers = {'x-attempts': 2}
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+
+        self.rpc.channel.basic_publish.assert_called_once_with(exchange='rabbitrpc.dlx', routing_key='',
+                                                               properties='Props', body='body')
+        headers = self.localrpc.pika.BasicProperties.call_args[1]['headers']
+        assert headers == {'x-attempts': 3, 'x-last-error': 'ValueError: boom'}
+        assert self.rpc.stats['dead_lettered_messages'] == 1
+    #---
+
+    def test_PoisonMessageIsDeadLetteredAtOnce(self):
+        """
+        Tests that a message that can't be decoded skips the retries.
+
+        """
+        self.callback.side_effect = self.localrpc.InvalidMessageError
+        self.props.headers = None
+        self.rpc._consumerCallback('', self.method, self.props, 'body')
+
+        assert self.rpc.channel.basic_publish.call_args[1]['exchange'] == 'rabbitrpc.dlx'
+        assert self.rpc.stats['dead_lettered_messages'] == 1
+    #---
+
+    def test_ConnectDeclaresDeadLetters(self):
+        """
+        Tests that _connect declares the dead letter exchange and binds the dead letter queue to it.
+
+        """
+        self.localrpc.pika.BlockingConnection = mock.MagicMock()
+        channel = self.localrpc.pika.BlockingConnection.return_value.channel.return_value
+        channel.basic_consume.return_value = 'ctag'
+        self.rpc.connection_params = {}
+        self.rpc._connect()
+
+        channel.exchange_declare.assert_called_once_with(exchange='rabbitrpc.dlx', exchange_type='fanout',
+                                                         durable=True)
+        channel.queue_declare.assert_called_with(queue='rabbitrpc.dead', durable=True)
+        channel.queue_bind.assert_called_once_with(queue='rabbitrpc.dead', exchange='rabbitrpc.dlx')
+        assert self.rpc._consumer_queues == {'ctag': 'rabbitrpc'}
+    #---
+#---
+
+class Test_publisher_confirms(object):
+    """
+    Tests the consumer's publisher confirms on replies.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.pika.BasicProperties = mock.MagicMock(return_value='Props')
+        self.localrpc.pika.BlockingConnection = mock.MagicMock()
+
+        self.rpc = self.localrpc.Consumer(mock.MagicMock(return_value='response'), {'publisher_confirms': True})
+        self.rpc.connection_params = {}
+        self.rpc._connect()
+        self.channel = self.localrpc.pika.BlockingConnection.return_value.channel.return_value
+    #---
+
+    def teardown_method(self, method):
+        del self.rpc.config['publisher_confirms']
+    #---
+
+    def test_ConnectStartsTracking(self):
+        """
+        Tests that _connect puts the channel in confirm mode.
+
+        """
+        tracker = self.rpc._confirms[self.channel]
+        self.channel._impl.confirm_delivery.assert_called_once_with(tracker._onConfirm, nowait=True)
+    #---
+
+    def test_RepliesAreTracked(self):
+        """
+        Tests that replies are published through the channel's tracker.
+
+        """
+        method = mock.MagicMock(delivery_tag='taggems')
+        self.rpc._consumerCallback(self.channel, method, mock.MagicMock(reply_to='replies'), 'body')
+
+        self.channel.basic_publish.assert_called_once_with(exchange='', routing_key='replies', properties='Props',
+                                                           body='response')
+        assert len(self.rpc._confirms[self.channel]) == 1
+    #---
+#---
+
+class Test_ack_batching(object):
+    """
+    Tests the consumer's batched acks and replies.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.pika.BasicProperties = mock.MagicMock(return_value='Props')
+        self.localrpc.pika.BlockingConnection = mock.MagicMock()
+
+        self.rpc = self.localrpc.Consumer(mock.MagicMock(return_value='response'), {'ack_batch_size': 2,
+                                                                                     'prefetch_count': 4})
+        self.rpc.connection_params = {}
+        self.rpc._connect()
+        self.channel = self.localrpc.pika.BlockingConnection.return_value.channel.return_value
+    #---
+
+    def teardown_method(self, method):
+        del self.rpc.config['ack_batch_size']
+    #---
+
+    def deliver(self, delivery_tag):
+        self.rpc._consumerCallback(self.channel, mock.MagicMock(delivery_tag=delivery_tag),
+                                   mock.MagicMock(reply_to='replies'), 'body')
+    #---
+
+    def test_AcksInBatches(self):
+        """
+        Tests that finished messages are acked a batch at a time.
+
+        """
+        self.deliver(1)
+        assert self.channel.basic_ack.called is False
+
+        self.deliver(2)
+        self.channel._impl.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+    #---
+
+    def test_RepliesAreWrittenWithTheBatch(self):
+        """
+        Tests that replies are queued on the underlying channel, to be written with the batch's ack.
+
+        """
+        self.deliver(1)
+
+        self.channel._impl.basic_publish.assert_called_once_with(exchange='', routing_key='replies',
+                                                                 properties='Props', body='response')
+        assert self.channel.basic_publish.called is False
+    #---
+
+    def test_StopFlushesWaitingAcks(self):
+        """
+        Tests that stopping acks the finished messages still waiting for their batch.
+
+        """
+        self.deliver(1)
+        self.rpc.stop()
+
+        self.channel._impl.basic_ack.assert_called_once_with(delivery_tag=1, multiple=True)
+    #---
+
+    def test_BatchIsCappedByThePrefetch(self):
+        """
+        Tests that a batch never grows past half the channel's prefetch, so the broker keeps delivering.
+
+        """
+        rpc = self.localrpc.Consumer(mock.MagicMock(return_value='response'), {'ack_batch_size': 50, 'workers': 4})
+        rpc.connection_params = {}
+        rpc._connect()
+
+        assert rpc._ack_batchers[self.channel].batch_size == 2
+    #---
+#---
+
+class Test_channels(object):
+    """
+    Tests the consumer's extra channels.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.pika.BasicProperties = mock.MagicMock(return_value='Props')
+        self.localrpc.pika.BlockingConnection = mock.MagicMock()
+        self.channels = [mock.MagicMock(name='main'), mock.MagicMock(name='second'), mock.MagicMock(name='third')]
+        for number, channel in enumerate(self.channels):
+            channel.basic_consume.return_value = 'ctag-%i' % number
+        self.localrpc.pika.BlockingConnection.return_value.channel.side_effect = self.channels
+
+        self.rpc = self.localrpc.Consumer(mock.MagicMock(return_value='response'), {'channels': 3, 'workers': 2,
+                                                                                     'prefetch_count': 5})
+        self.rpc.connection_params = {}
+        self.rpc._connect()
+    #---
+
+    def test_EachChannelConsumesWithItsOwnPrefetch(self):
+        """
+        Tests that every channel gets a consumer on the queue and the prefetch, and only the main one declares it.
+
+        """
+        for channel in self.channels:
+            channel.basic_qos.assert_called_once_with(prefetch_count=5)
+            channel.basic_consume.assert_called_once_with(self.rpc._consumerCallback, queue='rabbitrpc')
+
+        assert self.channels[0].queue_declare.called is True
+        assert self.channels[1].queue_declare.called is False
+    #---
+
+    def test_FinishesOnTheChannelTheMessageCameIn(self):
+        """
+        Tests that a message from an extra channel is replied to and acked on that channel.
+
+        """
+        method = mock.MagicMock(consumer_tag='ctag-2', delivery_tag=1)
+        self.rpc._finishMessage(method, mock.MagicMock(reply_to='replies'), 'response', None)
+
+        self.channels[2].basic_ack.assert_called_once_with(delivery_tag=1)
+        assert self.channels[0].basic_ack.called is False
+    #---
+
+    def test_StopClosesEveryChannel(self):
+        """
+        Tests that stop closes the extra channels along with the main one.
+
+        """
+        self.rpc.stop()
+
+        for channel in self.channels:
+            channel.close.assert_called_once_with()
+    #---
+#---
+
+class Test_weighted_queues(object):
+    """
+    Tests the consumer's weighted queues.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.Consumer._processLoop = mock.MagicMock()
+        self.localrpc.pika.BlockingConnection = mock.MagicMock()
+        self.localrpc.workers = mock.MagicMock()
+        self.pool = self.localrpc.workers.WorkerPool.return_value
+        self.pool.size = 2
+        self.channels = [mock.MagicMock(name='main'), mock.MagicMock(name='critical')]
+        for channel, consumer_tag in zip(self.channels, ('ctag-main', 'ctag-critical')):
+            channel.basic_consume.return_value = consumer_tag
+        self.localrpc.pika.BlockingConnection.return_value.channel.side_effect = self.channels
+
+        self.rpc = self.localrpc.Consumer(mock.MagicMock(), {'workers': 2})
+        self.rpc.connection_params = {}
+        self.rpc.addWeightedQueue('critical', weight=3, prefetch_count=4)
+        self.rpc.run()
+    #---
+
+    def deliver(self, consumer_tag, body):
+        self.rpc._consumerCallback('', mock.MagicMock(consumer_tag=consumer_tag), mock.MagicMock(), body)
+    #---
+
+    def submitted(self):
+        return [call[0][0][2] for call in self.pool.submit.call_args_list]
+    #---
+
+    def test_ConsumesOnItsOwnChannel(self):
+        """
+        Tests that a weighted queue is declared and consumed on a channel of its own, with its own prefetch.
+
+        """
+        channel = self.channels[1]
+        channel.queue_declare.assert_called_once_with(queue='critical', durable=True)
+        channel.basic_qos.assert_called_once_with(prefetch_count=4)
+        channel.basic_consume.assert_called_once_with(self.rpc._consumerCallback, queue='critical')
+    #---
+
+    def test_HoldsBackWhatThePoolHasNoRoomFor(self):
+        """
+        Tests that messages are handed to the pool only while it has idle workers.
+
+        """
+        for body in ('m1', 'm2', 'm3'):
+            self.deliver('ctag-main', body)
+
+        assert self.submitted() == ['m1', 'm2']
+        assert self.rpc.stats['queue.rabbitrpc.backlog'] == 1
+    #---
+
+    def test_FreedWorkersGoByWeight(self):
+        """
+        Tests that workers freed by finished messages are given out by weight among the queues waiting.
+
+        """
+        for body in ('m1', 'm2', 'm3', 'm4', 'm5'):
+            self.deliver('ctag-main', body)
+        for body in ('c1', 'c2', 'c3'):
+            self.deliver('ctag-critical', body)
+
+        for _ in range(4):
+            self.rpc._completed.put((mock.MagicMock(), mock.MagicMock(), 'response', None))
+        self.rpc._finishCompleted()
+
+        assert self.submitted() == ['m1', 'm2', 'm3', 'c1', 'c2', 'c3']
+        assert (self.rpc.stats['queue.critical.messages'], self.rpc.stats['queue.rabbitrpc.messages']) == (3, 3)
+    #---
+
+    def test_KeepsDeliveryOrderWithinAnOrderKey(self):
+        """
+        Tests that a call with an ordering key isn't run ahead of an earlier one with the same key, whatever the
+        weights.
+
+        """
+        for body in ('m1', 'm2', 'm3'):
+            self.deliver('ctag-main', body)
+        for consumer_tag, body in (('ctag-main', 'm4'), ('ctag-critical', 'c1')):
+            props = mock.MagicMock(headers={'x-order-key': 'acct-1'})
+            self.rpc._consumerCallback('', mock.MagicMock(consumer_tag=consumer_tag), props, body)
+
+        for _ in range(3):
+            self.rpc._completed.put((mock.MagicMock(), mock.MagicMock(), 'response', None))
+        self.rpc._finishCompleted()
+
+        assert self.submitted() == ['m1', 'm2', 'm3', 'm4', 'c1']
+        assert self.rpc._held == {}
+    #---
+#---
+
+class Test_tenant_fairness(object):
+    """
+    Tests the consumer's fair sharing of workers between tenants.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.Consumer._processLoop = mock.MagicMock()
+        self.localrpc.pika.BlockingConnection = mock.MagicMock()
+        self.localrpc.workers = mock.MagicMock()
+        self.pool = self.localrpc.workers.WorkerPool.return_value
+        self.pool.size = 1
+
+        self.rpc = self.localrpc.Consumer(mock.MagicMock(), {'tenant_fairness': {'default_max_running': 1}})
+        self.rpc.connection_params = {}
+        self.rpc.run()
+    #---
+
+    def deliver(self, tenant, body, order_key = None):
+        props = mock.MagicMock(headers={'x-tenant': tenant} if tenant else {})
+        if order_key:
+            props.headers['x-order-key'] = order_key
+        self.rpc._consumerCallback('', mock.MagicMock(), props, body)
+        return props
+    #---
+
+    def submitted(self):
+        return [call[0][0][2] for call in self.pool.submit.call_args_list]
+    #---
+
+    def test_NoisyTenantDoesNotGoFirst(self):
+        """
+        Tests that a quiet tenant's call is run before the rest of a noisy tenant's backlog.
+
+        """
+        props = self.deliver('noisy', 'n1')
+        for body in ('n2', 'n3', 'n4'):
+            self.deliver('noisy', body)
+        self.deliver('quiet', 'q1')
+
+        for _ in range(2):
+            self.rpc._completed.put((mock.MagicMock(), props, 'response', None))
+            self.rpc._finishCompleted()
+
+        assert self.submitted() == ['n1', 'n2', 'q1']
+        assert (self.rpc.stats['tenant.noisy.messages'], self.rpc.stats['tenant.noisy.backlog']) == (2, 2)
+    #---
+
+    def test_KeepsDeliveryOrderWithinAnOrderKey(self):
+        """
+        Tests that a quiet tenant's call doesn't go ahead of an earlier call with the same ordering key.
+
+        """
+        props = self.deliver('noisy', 'n1')
+        self.deliver('noisy', 'n2')
+        self.deliver('noisy', 'n3', 'acct-1')
+        self.deliver('quiet', 'q1', 'acct-1')
+
+        for _ in range(3):
+            self.rpc._completed.put((mock.MagicMock(), props, 'response', None))
+            self.rpc._finishCompleted()
+
+        assert self.submitted() == ['n1', 'n2', 'n3', 'q1']
+    #---
+
+    def test_CallsWithoutTenantShareOneFlow(self):
+        """
+        Tests that calls without a tenant header are scheduled together.
+
+        """
+        self.deliver(None, 'a1')
+
+        assert self.rpc.stats['tenant.unknown.messages'] == 1
+    #---
+
+    def test_RefusesWeightedQueuesToo(self):
+        """
+        Tests that tenant fairness and weighted queues can't be combined.
+
+        """
+        rpc = self.localrpc.Consumer(mock.MagicMock(), {'tenant_fairness': True})
+        rpc.addWeightedQueue('bulk')
+
+        with pytest.raises(self.localrpc.ConsumerError):
+            rpc.run()
+    #---
+#---
+
+class Test_deadline_scheduling(object):
+    """
+    Tests the consumer's earliest deadline first scheduling.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.Consumer._processLoop = mock.MagicMock()
+        self.localrpc.pika.BlockingConnection = mock.MagicMock()
+        self.localrpc.workers = mock.MagicMock()
+        self.pool = self.localrpc.workers.WorkerPool.return_value
+        self.pool.size = 1
+        self.now = self.localrpc.time.time()
+
+        self.rpc = self.localrpc.Consumer(mock.MagicMock(), {'deadline_scheduling': {'min_remaining': 1}})
+        self.rpc.connection_params = {}
+        self.rpc.run()
+    #---
+
+    def deliver(self, body, deadline, order_key = None):
+        props = mock.MagicMock(headers={'x-deadline': long((self.now + deadline) * 1000)})
+        if order_key:
+            props.headers['x-order-key'] = order_key
+        method = mock.MagicMock(delivery_tag=body)
+        self.rpc._consumerCallback('', method, props, body)
+        return method, props
+    #---
+
+    def submitted(self):
+        return [call[0][0][2] for call in self.pool.submit.call_args_list]
+    #---
+
+    def test_TightestDeadlineGoesFirst(self):
+        """
+        Tests that buffered calls run in deadline order rather than in the order they arrived.
+
+        """
+        method, props = self.deliver('first', 30)
+        self.deliver('loose', 60)
+        self.deliver('tight', 10)
+
+        self.rpc._completed.put((method, props, 'response', None))
+        self.rpc._finishCompleted()
+
+        assert self.submitted() == ['first', 'tight']
+        assert self.rpc.stats['deadline.rabbitrpc.messages'] == 2
+    #---
+
+    def test_DropsCallsThatCantMakeTheirDeadline(self):
+        """
+        Tests that calls too close to their deadline are acknowledged without being run.
+
+        """
+        method, props = self.deliver('first', 30)
+        self.deliver('late', 0.5)
+
+        self.rpc._completed.put((method, props, 'response', None))
+        self.rpc._finishCompleted()
+
+        assert self.submitted() == ['first']
+        self.rpc.channel.basic_ack.assert_any_call(delivery_tag='late')
+        assert (self.rpc.stats['expired_calls'], self.rpc.stats['deadline.rabbitrpc.expired']) == (1, 1)
+    #---
+
+    def test_DroppedCallsLeaveTheAdaptiveController(self):
+        """
+        Tests that the adaptive controller stops counting dropped calls as in flight.
+
+        """
+        self.rpc._adaptive = mock.MagicMock()
+        method, props = self.deliver('first', 30)
+        self.deliver('late', 0.5)
+
+        self.rpc._completed.put((method, props, 'response', None))
+        self.rpc._finishCompleted()
+
+        assert (self.rpc._adaptive.delivered.call_count, self.rpc._adaptive.dropped.call_count) == (2, 1)
+        assert list(self.rpc._delivered) == [(method.consumer_tag, method.delivery_tag)]
+    #---
+
+    def test_KeepsDeliveryOrderWithinAnOrderKey(self):
+        """
+        Tests that a call with a tighter deadline doesn't go ahead of an earlier one with the same ordering key.
+
+        """
+        method, props = self.deliver('first', 30)
+        self.deliver('loose', 60, 'acct-1')
+        self.deliver('tight', 10, 'acct-1')
+
+        for _ in range(2):
+            self.rpc._completed.put((method, props, 'response', None))
+            self.rpc._finishCompleted()
+
+        assert self.submitted() == ['first', 'loose', 'tight']
+    #---
+
+    def test_DroppedCallLetsTheNextWithItsKeyIn(self):
+        """
+        Tests that dropping an expired call with an ordering key schedules the next call with that key.
+
+        """
+        method, props = self.deliver('first', 30)
+        self.deliver('late', 0.5, 'acct-1')
+        self.deliver('next', 30, 'acct-1')
+
+        self.rpc._completed.put((method, props, 'response', None))
+        self.rpc._finishCompleted()
+
+        assert self.submitted() == ['first', 'next']
+    #---
+
+    def test_RefusesTenantFairnessToo(self):
+        """
+        Tests that deadline scheduling can't be combined with another scheduler.
+
+        """
+        rpc = self.localrpc.Consumer(mock.MagicMock(), {'deadline_scheduling': True, 'tenant_fairness': True})
+
+        with pytest.raises(self.localrpc.ConsumerError):
+            rpc.run()
+    #---
+#---
+
+class Test_lanes(object):
+    """
+    Tests the consumer's lanes.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.localrpc = reload(consumer)
+        self.localrpc.Consumer._configureConnection = mock.MagicMock()
+        self.localrpc.pika.BasicProperties = mock.MagicMock(return_value='Props')
+        self.localrpc.pika.BlockingConnection = mock.MagicMock()
+        self.connection = self.localrpc.pika.BlockingConnection.return_value
+        self.main_channel = mock.MagicMock()
+        self.lane_channel = mock.MagicMock()
+        self.connection.channel.side_effect = [self.main_channel, self.lane_channel]
+
+        self.callback = mock.MagicMock(return_value='response')
+        self.rpc = self.localrpc.Consumer(self.callback, {})
+        self.rpc.connection_params = {}
+        self.rpc.addLane('reports', 'rabbitrpc.lane.reports', workers=2, prefetch_count=3)
+        self.lane = self.rpc._lanes[0]
+        self.rpc._connect()
+
+        self.method = mock.MagicMock()
+        type(self.method).delivery_tag = mock.PropertyMock(return_value='taggems')
+        self.props = mock.MagicMock()
+    #---
+
+    def test_LaneHasItsOwnChannel(self):
+        """
+        Tests that a lane's queue is declared and consumed on its own channel, with its own prefetch.
+
+        """
+        assert self.lane.channel is self.lane_channel
+        self.lane_channel.queue_declare.assert_called_once_with(queue='rabbitrpc.lane.reports', durable=True)
+        self.lane_channel.basic_qos.assert_called_once_with(prefetch_count=3)
+        assert self.lane_channel.basic_consume.call_args[1] == {'queue': 'rabbitrpc.lane.reports'}
+    #---
+
+    def test_LaneMessagesGoToTheLanePool(self):
+        """
+        Tests that messages delivered on a lane are submitted to the lane's pool.
+
+        """
+        self.lane.pool = mock.MagicMock()
+        lane_callback = self.lane_channel.basic_consume.call_args[0][0]
+        lane_callback('', self.method, self.props, 'body')
+
+        assert self.lane.pool.submit.call_args[0][0][:4] == (self.lane, self.method, self.props, 'body')
+        assert self.callback.called is False
+    #---
+
+    def test_LaneMessagesAreFinishedOnTheLaneChannel(self):
+        """
+        Tests that finished lane messages are acknowledged on the lane's channel, and counted.
+
+        """
+        self.rpc._runLaneTask((self.lane, self.method, self.props, 'body', 0))
+        self.rpc._finishCompleted()
+
+        self.lane_channel.basic_ack.assert_called_once_with(delivery_tag='taggems')
+        assert self.main_channel.basic_ack.called is False
+        assert self.rpc.stats['lane.reports.messages'] == 1
+        assert self.rpc.stats['lane.reports.wait_ms'] > 0
+    #---
+
+    def test_DepthIsReadFromTheBroker(self):
+        """
+        Tests that the lane's queue depth is read with a passive declare, along with its pool backlog.
+
+        """
+        self.lane.pool = mock.MagicMock()
+        self.lane.pool.backlog.return_value = 1
+        self.lane_channel.queue_declare.return_value.method.message_count = 7
+        self.rpc._updateLaneDepths()
+
+        self.lane_channel.queue_declare.assert_called_with(queue='rabbitrpc.lane.reports', durable=True, passive=True)
+        assert (self.rpc.stats['lane.reports.depth'], self.rpc.stats['lane.reports.backlog']) == (7, 1)
+    #---
+
+    def test_RunUsesTheConnectionLoop(self):
+        """
+        Tests that a consumer with lanes services the connection itself and starts the lane pools.
+
+        """
+        self.rpc._connect = mock.MagicMock()
+        self.rpc._processLoop = mock.MagicMock()
+        self.rpc.channel = self.main_channel
+        self.rpc.run()
+
+        self.rpc._processLoop.assert_called_once_with()
+        assert self.lane.pool.size == 2
+        self.rpc.stop()
+    #---
+#---
@@ -24,6 +24,8 @@
 #
 
 import copy
+import threading
+import time
 import pytest
 import mock
 from rabbitrpc.rabbitmq import producer
@@ -200,7 +202,10 @@ class Test_send(object):
         self.localproducer.Producer._configureConnection = mock.MagicMock()
         self.localproducer.Producer._startReplyConsumer = mock.MagicMock()
         self.localproducer.Producer._replyWaitLoop = mock.MagicMock()
-        self.localproducer.uuid.uuid4 = mock.MagicMock(return_value=self.uuid)
+        self.localproducer.uuid = mock.MagicMock()
+        self.localproducer.uuid.uuid4.return_value = self.uuid
+        self.localproducer.time = mock.MagicMock()
+        self.localproducer.time.time.return_value = 1000.0
         self.localproducer.pika.BasicProperties = mock.MagicMock(return_value=self.basic_props)
 
         self.rpc = self.localproducer.Producer()
@@ -230,11 +235,13 @@ class Test_send(object):
     def test_SetsPublishPropsIfExpectReplyIsTrue(self):
         """
         Tests that send sets additional properties (reply_to, correlation_id) for basic_publish if expect_reply is
-        `True`.
+        `True`, along with the time of publishing and the deadline.
 
         """
         self.localproducer.pika.BasicProperties.assert_called_once_with(reply_to=self.rpc.config['reply_queue'],
-                                                                   correlation_id=self.uuid)
+                                                                   correlation_id=self.uuid,
+                                                                   headers={'x-sent-at': 1000000,
+                                                                            'x-deadline': 1005000})
     #---
 
     def test_PublishesTheRPCData(self):
@@ -248,6 +255,128 @@ class Test_send(object):
 
     #---
 
+    def test_PublishesToRoutingKeyOverride(self):
+        """
+        Tests that send publishes to the given routing key instead of the configured queue.
+
+        """
+        self.rpc.channel.reset_mock()
+        self.rpc.send(self.rpc_data, routing_key='rabbitrpc.instance')
+
+        self.rpc.channel.basic_publish.assert_called_once_with(exchange=self.rpc.config['exchange'],
+                                                               routing_key='rabbitrpc.instance', body=self.rpc_data,
+                                                               properties=self.basic_props)
+    #---
+
+    def test_PublishesToExchangeOverride(self):
+        """
+        Tests that send publishes to the given exchange instead of the configured one.
+
+        """
+        self.rpc.channel.reset_mock()
+        self.rpc.send(self.rpc_data, routing_key='acct-1', exchange='rabbitrpc.hash')
+
+        assert self.rpc.channel.basic_publish.call_args[1]['exchange'] == 'rabbitrpc.hash'
+        assert self.rpc.channel.basic_publish.call_args[1]['routing_key'] == 'acct-1'
+    #---
+
+    def test_DeclaresTheHashExchangeOnFirstUse(self):
+        """
+        Tests that the consistent-hash exchange is declared before the first call to it, and only then.
+
+        """
+        self.rpc.channel.reset_mock()
+        self.rpc.send(self.rpc_data, routing_key='rabbitrpc.instance')
+        assert self.rpc.channel.exchange_declare.called is False
+
+        for _ in range(2):
+            self.rpc.send(self.rpc_data, routing_key='acct-1', exchange='rabbitrpc.hash')
+
+        self.rpc.channel.exchange_declare.assert_called_once_with(exchange='rabbitrpc.hash',
+                                                                  exchange_type='x-consistent-hash', durable=True)
+    #---
+
+    def test_SetsPriorityIfGiven(self):
+        """
+        Tests that send sets the priority property when a priority is given.
+
+        """
+        self.localproducer.pika.BasicProperties.reset_mock()
+        self.rpc.send(self.rpc_data, priority=7)
+
+        self.localproducer.pika.BasicProperties.assert_called_once_with(reply_to=self.rpc.config['reply_queue'],
+                                                                        correlation_id=self.uuid, priority=7,
+                                                                        headers={'x-sent-at': 1000000,
+                                                                                 'x-deadline': 1005000})
+    #---
+
+    def test_InheritsTheRunningCallsDeadline(self):
+        """
+        Tests that a call made while running another keeps to the other's deadline if it is sooner, waiting for its
+        reply only that long, and that calls without a reply only carry an inherited one.
+
+        """
+        self.localproducer.pika.BasicProperties.reset_mock()
+        with self.localproducer.admission.running(None, 1002.0):
+            self.rpc.send(self.rpc_data)
+            assert self.rpc._replyWaitLoop.call_args[0][0].deadline == 1002.0
+            self.rpc.send(self.rpc_data, expect_reply=False)
+        self.rpc.send(self.rpc_data, expect_reply=False)
+
+        headers = [call[1]['headers'] for call in self.localproducer.pika.BasicProperties.call_args_list]
+        assert [header.get('x-deadline') for header in headers] == [1002000, 1002000, None]
+    #---
+
+    def test_SetsDeliveryModeForDurability(self):
+        """
+        Tests that send publishes 'fast' calls transient and 'safe' ones persistent.
+
+        """
+        for durability, delivery_mode in (('fast', 1), ('safe', 2)):
+            self.localproducer.pika.BasicProperties.reset_mock()
+            self.rpc.send(self.rpc_data, durability=durability)
+
+            assert self.localproducer.pika.BasicProperties.call_args[1]['delivery_mode'] == delivery_mode
+    #---
+
+    def test_SafeCallsWaitForConfirms(self):
+        """
+        Tests that a 'safe' call waits for the broker to confirm it before its reply, when confirms are on.
+
+        """
+        self.rpc._confirms = mock.MagicMock()
+        self.rpc._confirms.publish.return_value = 7
+        self.rpc.send(self.rpc_data, durability='fast')
+        assert self.rpc._confirms.waitFor.called is False
+
+        self.rpc.send(self.rpc_data, durability='safe')
+        self.rpc._confirms.waitFor.assert_called_once_with(7, self.rpc.config['reply_timeout'])
+        assert self.rpc._confirms.wait.called is False
+    #---
+
+    def test_UnconfirmedSafeCallRaisesProducerError(self):
+        """
+        Tests that a 'safe' call the broker did not confirm raises a ProducerError, and is forgotten.
+
+        """
+        self.rpc._confirms = mock.MagicMock()
+        self.rpc._confirms.waitFor.side_effect = self.localproducer.confirms.PublishFailedError('nacked')
+
+        with pytest.raises(self.localproducer.PublishConfirmError):
+            self.rpc.send(self.rpc_data, durability='safe')
+        assert issubclass(self.localproducer.PublishConfirmError, self.localproducer.ProducerError)
+        assert self.rpc._calls == {}
+    #---
+
+    def test_RefusesUnknownDurability(self):
+        """
+        Tests that send refuses durability profiles it does not know.
+
+        """
+        with pytest.raises(self.localproducer.ProducerError):
+            self.rpc.send(self.rpc_data, durability='sturdy')
+    #---
+
     def test_WaitsForAReplyIfExpectReplyIsTrue(self):
         """
         Tests that send
@@ -263,20 +392,20 @@ class Test_send(object):
 
         """
         expected_reply = 'No'
-        self.rpc._rpc_reply = expected_reply
+        self.rpc._replyWaitLoop.side_effect = lambda call: setattr(call, 'reply', expected_reply)
         reply = self.rpc.send(self.rpc_data)
 
         assert expected_reply == reply
     #---
 
-    def test_ClearsRPCReply(self):
+    def test_ForgetsTheCall(self):
         """
+        Tests that send stops waiting for the call's reply once it returns.
+
         """
-        expected_reply = 'No'
-        self.rpc._rpc_reply = expected_reply
-        reply = self.rpc.send(self.rpc_data)
+        self.rpc.send(self.rpc_data)
 
-        assert self.rpc._rpc_reply is None
+        assert self.rpc._calls == {}
     #----
 #---
 
@@ -310,6 +439,16 @@ class Test__startReplyConsumer(object):
         self.rpc.channel.basic_consume.assert_called_once_with(self.rpc._consumerCallback,
                                                                queue=self.rpc.config['reply_queue'],  no_ack=True)
     #---
+
+    def test_StartsOnlyOnce(self):
+        """
+        Tests that _startReplyConsumer leaves a running consumer be.
+
+        """
+        self.rpc._startReplyConsumer()
+
+        assert self.rpc.channel.basic_consume.call_count == 1
+    #---
 #---
 
 class Test__replyWaitLoop(object):
@@ -324,7 +463,6 @@ class Test__replyWaitLoop(object):
         :param method:
 
         """
-        self.timeout_id = '2w4et12'
         self.localproducer = reload(producer)
 
         self.localproducer.logging = mock.MagicMock()
@@ -332,52 +470,370 @@ class Test__replyWaitLoop(object):
 
         self.rpc = self.localproducer.Producer()
         self.rpc.connection = mock.MagicMock()
-        self.rpc.connection.add_timeout.return_value = self.timeout_id
-        self.rpc._rpc_reply = 'Yes' # Kills the loop, or the test will never finish
+        self.call = self.localproducer._PendingCall('call', time.time() + 5)
     #---
 
-    def test_AddsReplyTimeout(self):
+    def test_ProcessesDataEvents(self):
         """
-        Tests that _replyWaitLoop adds a timeout to stop the loop after a set amount of time.
+        Tests that _replyWaitLoop processes events for the consumer, a poll interval at a time, until the reply.
 
         """
-        self.rpc._replyWaitLoop()
-        self.rpc.connection.add_timeout.assert_called_once_with(self.rpc.config['reply_timeout'], self.rpc._timeoutElapsed)
+        self.rpc.connection.process_data_events.side_effect = lambda time_limit: self.call.replied.set()
+
+        self.rpc._replyWaitLoop(self.call)
+
+        self.rpc.connection.process_data_events.assert_called_once_with(time_limit=0.01)
     #---
 
-    def test_ProcessesDataEvents(self):
+    def test_RaisesAtTheDeadline(self):
         """
-        Tests that _replyWaitLoop processes events for the consumer.
+        Tests that _replyWaitLoop gives up once the call's deadline has passed.
 
         """
-        # This kills off the while loop so the test does not hang, I really don't like this.
-        def loop_killer():
-            self.rpc._rpc_reply = 'Yes'
+        self.call.deadline = time.time()
 
-        self.rpc._rpc_reply = None
-        self.rpc.connection.process_data_events = mock.MagicMock(side_effect=loop_killer)
+        with pytest.raises(self.localproducer.ReplyTimeoutError):
+            self.rpc._replyWaitLoop(self.call)
+    #---
 
-        self.rpc._replyWaitLoop()
-        called = self.rpc.connection.process_data_events.called
+    def test_WaitsWhileAnotherThreadServicesTheConnection(self):
+        """
+        Tests that _replyWaitLoop leaves the connection to the thread using it, and takes the reply it is handed.
 
-        assert called == True
+        """
+        self.rpc._send_lock.acquire()
+        hand_over = threading.Timer(0.05, self.call.replied.set)
+        hand_over.start()
+
+        try:
+            self.rpc._replyWaitLoop(self.call)
+        finally:
+            self.rpc._send_lock.release()
+            hand_over.join()
+
+        assert self.rpc.connection.process_data_events.called is False
+    #---
+#---
+
+class Test_hedging(object):
+    """
+    Tests Producer's hedged sends.
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localproducer = reload(producer)
+
+        self.localproducer.logging = mock.MagicMock()
+        self.localproducer.Producer._configureConnection = mock.MagicMock()
+        self.localproducer.Producer._startReplyConsumer = mock.MagicMock()
+        self.localproducer.pika.BasicProperties = mock.MagicMock(side_effect=lambda **props: props)
+
+        self.rpc = self.localproducer.Producer()
+        self.rpc.channel = mock.MagicMock()
+        self.rpc.connection = mock.MagicMock()
+        self.rpc.reply_queue = 'replies'
+    #---
+
+    def published(self):
+        return [call[1]['properties']['correlation_id'] for call in self.rpc.channel.basic_publish.call_args_list]
+    #---
+
+    def reply(self, correlation_id):
+        props = mock.MagicMock()
+        props.correlation_id = correlation_id
+        self.rpc._consumerCallback('', '', props, 'reply to %s' % correlation_id)
+    #---
+
+    def replyToHedge(self, time_limit):
+        # The hedge goes out after the first round of events
+        if len(self.published()) == 2:
+            self.reply(self.published()[1])
+    #---
+
+    def test_SlowCallIsHedged(self):
+        """
+        Tests that a call without a reply when its hedge is due is sent again under a new correlation id, and that
+        the hedge's reply is taken.
+
+        """
+        self.rpc.connection.process_data_events.side_effect = self.replyToHedge
+
+        reply = self.rpc.send('call', hedge_after=0)
+
+        first, second = self.rpc.channel.basic_publish.call_args_list
+        assert first[1]['body'] == second[1]['body'] == 'call'
+        assert first[1]['properties']['correlation_id'] != second[1]['properties']['correlation_id']
+        assert second[1]['properties']['reply_to'] == 'replies'
+        assert reply == 'reply to %s' % second[1]['properties']['correlation_id']
+        assert (self.rpc.stats['hedged_calls'], self.rpc.stats['hedge_wins']) == (1, 1)
+    #---
+
+    def test_FastReplyCancelsHedge(self):
+        """
+        Tests that a reply before the hedge is due sends nothing more.
+
+        """
+        self.rpc.connection.process_data_events.side_effect = lambda time_limit: self.reply(self.rpc.correlation_id)
+
+        self.rpc.send('call', hedge_after=10)
+
+        assert self.rpc.channel.basic_publish.call_count == 1
+        assert self.rpc.stats['hedged_calls'] == 0
+    #---
+
+    def test_LateReplyIsIgnored(self):
+        """
+        Tests that the losing reply of a hedged call does not satisfy the next call.
+
+        """
+        self.rpc.connection.process_data_events.side_effect = self.replyToHedge
+        self.rpc.send('call', hedge_after=0)
+        loser = self.published()[0]
+
+        # The loser's reply turns up while the next call waits
+        replies = [loser, None]
+        self.rpc.connection.process_data_events.side_effect = lambda time_limit: self.reply(replies.pop(0) or
+                                                                                            self.rpc.correlation_id)
+
+        assert self.rpc.send('next call') == 'reply to %s' % self.rpc.correlation_id
     #---
 
-    def test_RemovesTimeoutOnSuccess(self):
+    def test_TimeoutForgetsTheCall(self):
         """
-        Tests that _replyWaitLoop processes events for the consumer.
+        Tests that a call timing out before its hedge is due is forgotten, hedge and all.
 
         """
-        # This kills off the while loop so the test does not hang, I really don't like this.
-        def loop_killer():
-            self.rpc._rpc_reply = 'Yes'
+        self.rpc.config = dict(self.rpc.config, reply_timeout=0)
 
-        self.rpc._rpc_reply = None
-        self.rpc.connection.process_data_events = mock.MagicMock(side_effect=loop_killer)
+        with pytest.raises(self.localproducer.ReplyTimeoutError):
+            self.rpc.send('call', hedge_after=10)
+
+        assert self.rpc._calls == {}
+        assert self.rpc.channel.basic_publish.call_count == 1
+    #---
+
+    def test_StaleHedgeSendsNothing(self):
+        """
+        Tests that a hedge with no call to send again does nothing.
+
+        """
+        self.rpc._sendHedge(self.localproducer._PendingCall('call', time.time() + 5))
+
+        assert (self.rpc.channel.basic_publish.called, self.rpc.stats['hedged_calls']) == (False, 0)
+    #---
+#---
+
+class Test_concurrency(object):
+    """
+    Tests calls made by several threads through one Producer.
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localproducer = reload(producer)
+
+        self.localproducer.logging = mock.MagicMock()
+        self.localproducer.Producer._configureConnection = mock.MagicMock()
+        self.localproducer.Producer._startReplyConsumer = mock.MagicMock()
+        self.localproducer.pika.BasicProperties = mock.MagicMock(side_effect=lambda **props: props)
+
+        self.rpc = self.localproducer.Producer()
+        self.rpc.channel = mock.MagicMock()
+        self.rpc.connection = mock.MagicMock()
+        self.replies = {}
+    #---
+
+    def call(self, body):
+        self.replies[body] = self.rpc.send(body)
+    #---
+
+    def test_CallsAreInFlightTogether(self):
+        """
+        Tests that a thread can publish while another waits for its reply, and that each gets its own reply
+        whichever thread reads it.
+
+        """
+        def events(time_limit):
+            time.sleep(0.001)
+            published = self.rpc.channel.basic_publish.call_args_list
+            # Answers once both calls are out, newest first
+            if len(published) == 2:
+                for call in reversed(published):
+                    props = mock.MagicMock(correlation_id=call[1]['properties']['correlation_id'])
+                    self.rpc._consumerCallback('', '', props, 'reply to %s' % call[1]['body'])
+        self.rpc.connection.process_data_events.side_effect = events
+
+        threads = [threading.Thread(target=self.call, args=(body,)) for body in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        assert self.replies == {'a': 'reply to a', 'b': 'reply to b'}
+        assert self.rpc._calls == {}
+    #---
+#---
+
+class Test_publisher_confirms(object):
+    """
+    Tests Producer's publisher confirms.
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localproducer = reload(producer)
+
+        self.localproducer.logging = mock.MagicMock()
+        self.localproducer.Producer._configureConnection = mock.MagicMock()
+        self.localproducer.pika.BlockingConnection = mock.MagicMock()
+
+        self.rpc = self.localproducer.Producer({'publisher_confirms': {'max_unconfirmed': 10}})
+        self.rpc._connect()
+        self.channel = self.localproducer.pika.BlockingConnection.return_value.channel.return_value
+    #---
+
+    def teardown_method(self, method):
+        del self.rpc.config['publisher_confirms']
+    #---
+
+    def test_ConnectStartsTracking(self):
+        """
+        Tests that _connect puts the channel in confirm mode, with the configured tracker settings.
+
+        """
+        assert self.rpc._confirms.max_unconfirmed == 10
+        self.channel._impl.confirm_delivery.assert_called_once_with(self.rpc._confirms._onConfirm, nowait=True)
+    #---
+
+    def test_SendsThroughTheTracker(self):
+        """
+        Tests that sent messages are tracked until confirmed, and flush waits for them.
+
+        """
+        self.rpc.send('call', expect_reply=False)
+        assert len(self.rpc._confirms) == 1
+
+        ack = mock.MagicMock(method=self.localproducer.confirms.spec.Basic.Ack(delivery_tag=1))
+        self.rpc.connection.process_data_events.side_effect = lambda time_limit: self.rpc._confirms._onConfirm(ack)
+        self.rpc.flush()
+
+        assert len(self.rpc._confirms) == 0
+        assert self.rpc.stats['confirms.acked'] == 1
+    #---
+#---
+
+class Test_cancellation(object):
+    """
+    Tests Producer's cancellation of calls given up on.
+
+    """
+    def setup_method(self, method):
+        """
+        Test Setup
+
+        """
+        self.localproducer = reload(producer)
+
+        self.localproducer.logging = mock.MagicMock()
+        self.localproducer.Producer._configureConnection = mock.MagicMock()
+        self.localproducer.Producer._startReplyConsumer = mock.MagicMock()
+        self.localproducer.pika.BasicProperties = mock.MagicMock(side_effect=lambda **props: props)
+
+        self.rpc = self.localproducer.Producer({'cancellation': True})
+        self.rpc.channel = mock.MagicMock()
+        self.rpc.connection = mock.MagicMock()
+    #---
+
+    def teardown_method(self, method):
+        del self.rpc.config['cancellation']
+    #---
+
+    def reply(self, correlation_id):
+        props = mock.MagicMock()
+        props.correlation_id = correlation_id
+        self.rpc._consumerCallback('', '', props, 'reply')
+    #---
+
+    def test_TimedOutCallIsCancelled(self):
+        """
+        Tests that a call whose reply timed out is published to the cancel exchange.
+
+        """
+        self.rpc.config = dict(self.rpc.config, reply_timeout=0)
+
+        with pytest.raises(self.localproducer.ReplyTimeoutError):
+            self.rpc.send('call')
+
+        self.rpc.channel.basic_publish.assert_called_with(exchange='rabbitrpc.cancel', routing_key='',
+                                                          body=self.rpc.correlation_id)
+        assert self.rpc.stats['cancelled_calls'] == 1
+    #---
+
+    def test_GivesUpAtTheRunningCallsDeadline(self):
+        """
+        Tests that a call made while running another with a short deadline stops waiting, and is cancelled, at that
+        deadline rather than after the whole reply timeout.
+
+        """
+        started = time.time()
+
+        with self.localproducer.admission.running(None, started + 0.02):
+            with pytest.raises(self.localproducer.ReplyTimeoutError):
+                self.rpc.send('call')
+
+        assert time.time() - started < 1
+        assert self.rpc.stats['cancelled_calls'] == 1
+    #---
+
+    def test_HedgeLoserIsCancelled(self):
+        """
+        Tests that the copy of a hedged call that did not reply first is cancelled.
+
+        """
+        def replyToHedge(time_limit):
+            if self.rpc.stats['hedged_calls']:
+                self.reply(self.rpc.channel.basic_publish.call_args[1]['properties']['correlation_id'])
+        self.rpc.connection.process_data_events.side_effect = replyToHedge
+        self.rpc.send('call', hedge_after=0)
+
+        self.rpc.channel.basic_publish.assert_called_with(exchange='rabbitrpc.cancel', routing_key='',
+                                                          body=self.rpc.correlation_id)
+    #---
+
+    def test_ConnectDeclaresCancelExchange(self):
+        """
+        Tests that _connect declares the fanout cancel exchange.
+
+        """
+        self.localproducer.pika.BlockingConnection = mock.MagicMock()
+        self.rpc._connect()
+
+        channel = self.localproducer.pika.BlockingConnection.return_value.channel.return_value
+        channel.exchange_declare.assert_called_once_with(exchange='rabbitrpc.cancel', exchange_type='fanout',
+                                                         durable=True)
+    #---
+
+    def test_NothingIsCancelledWhenOff(self):
+        """
+        Tests that timeouts publish nothing more without the cancellation setting.
+
+        """
+        self.rpc.config = dict(self.rpc.config, cancellation=False, reply_timeout=0)
 
-        self.rpc._replyWaitLoop()
+        with pytest.raises(self.localproducer.ReplyTimeoutError):
+            self.rpc.send('call')
 
-        self.rpc.connection.remove_timeout.assert_called_once_with(self.timeout_id)
+        assert self.rpc.channel.basic_publish.call_count == 1
     #---
 #---
 
@@ -407,28 +863,29 @@ class Test__consumerCallback(object):
         type(self.props).correlation_id = mock.PropertyMock(return_value = self.correlation_id)
 
         self.rpc = self.localproducer.Producer()
-        self.rpc.correlation_id = self.correlation_id
+        self.call = self.localproducer._PendingCall(self.correlation_id, 0)
+        self.rpc._calls[self.correlation_id] = self.call
         self.rpc._consumerCallback('', '', self.props, self.body)
     #---
 
     def test_SetsRPCReplyOnMatchedCorrelationID(self):
         """
-        Tests that _consumerCallback sets _rpc_reply when it matches the correlation id.
+        Tests that _consumerCallback hands the reply to the call with its correlation id.
 
         """
-        assert self.rpc._rpc_reply == self.rpc_data
+        assert (self.call.reply, self.call.replied.is_set()) == (self.rpc_data, True)
     #---
 
     def test_DoesNotSetRPCReplyOnNonMatchedCorrelationID(self):
         """
-        Tests that _consumerCallback does not set _rpc_reply the correlation ids do not match.
+        Tests that _consumerCallback drops replies to calls no one is waiting for.
 
         """
-        self.rpc._rpc_reply = None
-        self.rpc.correlation_id = 'bob'
+        other = self.localproducer._PendingCall('bob', 0)
+        self.rpc._calls = {'bob': other}
 
         self.rpc._consumerCallback('', '', self.props, self.body)
-        assert self.rpc._rpc_reply != self.rpc_data
+        assert (other.reply, other.replied.is_set()) == (None, False)
     #---
 #---
 
@@ -0,0 +1,93 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_retry.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests for the retry module.
+#
+
+import mock
+from rabbitrpc.rabbitmq import retry
+
+
+class Test_RetryPolicy(object):
+    """
+    Tests the RetryPolicy class.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.policy = retry.RetryPolicy(max_attempts=3, base_delay=1.0, multiplier=2.0, max_delay=3.0)
+    #---
+
+    def test_DelaysGrowExponentially(self):
+        """
+        Tests that delays grow by the multiplier from the base, up to the maximum.
+
+        """
+        assert [self.policy.delay(attempts) for attempts in (1, 2, 3)] == [1.0, 2.0, 3.0]
+    #---
+
+    def test_ExhaustedAtMaxAttempts(self):
+        """
+        Tests that a message is out of attempts once it has failed max_attempts times.
+
+        """
+        assert (self.policy.exhausted(2), self.policy.exhausted(3)) == (False, True)
+    #---
+
+    def test_DelayQueueDeadLettersBackToTheQueue(self):
+        """
+        Tests that a delay queue holds messages for the delay, then routes them back to their queue.
+
+        """
+        assert self.policy.queue_arguments('rabbitrpc', 2.0) == {
+            'x-message-ttl': 2000,
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': 'rabbitrpc',
+        }
+    #---
+#---
+
+class Test_attempts(object):
+    """
+    Tests the `attempts` function.
+
+    """
+
+    def test_ReadsTheHeader(self):
+        """
+        Tests that the attempts so far are read from the message headers.
+
+        """
+        assert retry.attempts(mock.MagicMock(headers={'x-attempts': 2})) == 2
+    #---
+
+    def test_NewMessagesHaveNone(self):
+        """
+        Tests that messages without headers have not failed before.
+
+        """
+        assert retry.attempts(mock.MagicMock(headers=None)) == 0
+    #---
+#---
@@ -0,0 +1,256 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_scheduling.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests for the scheduling module.
+#
+
+import pytest
+from rabbitrpc.rabbitmq import scheduling
+
+
+class Test_DeficitRoundRobin(object):
+    """
+    Tests the DeficitRoundRobin class.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.scheduler = scheduling.DeficitRoundRobin()
+        self.scheduler.add('critical', 3)
+        self.scheduler.add('bulk', 1)
+    #---
+
+    def drain(self, count):
+        return [self.scheduler.pop()[0] for _ in range(count)]
+    #---
+
+    def test_SharesByWeight(self):
+        """
+        Tests that backlogged queues are served in proportion to their weights.
+
+        """
+        for number in range(20):
+            self.scheduler.push('critical', number)
+            self.scheduler.push('bulk', number)
+
+        served = self.drain(16)
+
+        assert (served.count('critical'), served.count('bulk')) == (12, 4)
+    #---
+
+    def test_IdleQueueGivesUpItsShare(self):
+        """
+        Tests that a queue alone with work waiting gets all of it served, whatever its weight.
+
+        """
+        for number in range(5):
+            self.scheduler.push('bulk', number)
+
+        assert self.drain(5) == ['bulk'] * 5
+        assert self.scheduler.pop() is None
+    #---
+
+    def test_KeepsOrderWithinAQueue(self):
+        """
+        Tests that each queue's items come out in the order they went in.
+
+        """
+        for number in range(4):
+            self.scheduler.push('critical', number)
+
+        assert [self.scheduler.pop()[1] for _ in range(4)] == [0, 1, 2, 3]
+    #---
+
+    def test_FractionalWeightsCarryOver(self):
+        """
+        Tests that a weight below 1 still gets its share, over several rounds.
+
+        """
+        self.scheduler.add('trickle', 0.5)
+        for number in range(20):
+            self.scheduler.push('bulk', number)
+            self.scheduler.push('trickle', number)
+
+        served = self.drain(12)
+
+        assert (served.count('bulk'), served.count('trickle')) == (8, 4)
+        assert (self.scheduler.backlog('bulk'), len(self.scheduler)) == (12, 28)
+    #---
+
+    def test_RefusesNonPositiveWeights(self):
+        """
+        Tests that queues need a positive weight.
+
+        """
+        with pytest.raises(ValueError):
+            self.scheduler.add('never', 0)
+    #---
+#---
+
+class Test_WeightedFairQueue(object):
+    """
+    Tests the WeightedFairQueue class.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.scheduler = scheduling.WeightedFairQueue(weights={'gold': 2})
+    #---
+
+    def drain(self, count):
+        served = []
+        for _ in range(count):
+            name, _ = self.scheduler.pop()
+            self.scheduler.done(name)
+            served.append(name)
+        return served
+    #---
+
+    def test_FloodingFlowDoesNotDelayOthers(self):
+        """
+        Tests that a flow arriving behind a flood is served in its fair turn, not after the flood.
+
+        """
+        for number in range(100):
+            self.scheduler.push('noisy', number)
+        self.scheduler.push('quiet', 0)
+
+        assert self.drain(2) == ['noisy', 'quiet']
+    #---
+
+    def test_SharesByWeight(self):
+        """
+        Tests that backlogged flows are served in proportion to their weights.
+
+        """
+        for number in range(30):
+            self.scheduler.push('gold', number)
+            self.scheduler.push('plain', number)
+
+        served = self.drain(15)
+
+        assert (served.count('gold'), served.count('plain')) == (10, 5)
+    #---
+
+    def test_IdleFlowBanksNoCredit(self):
+        """
+        Tests that a flow that was idle gets no burst of turns for the time it had nothing waiting.
+
+        """
+        for number in range(10):
+            self.scheduler.push('busy', number)
+        self.drain(8)
+
+        for number in range(4):
+            self.scheduler.push('late', number)
+
+        assert self.drain(4) == ['busy', 'late', 'busy', 'late']
+    #---
+
+    def test_CapsItemsRunning(self):
+        """
+        Tests that a flow at its cap is passed over until one of its items finishes.
+
+        """
+        scheduler = scheduling.WeightedFairQueue(max_running={'noisy': 1})
+        for number in range(3):
+            scheduler.push('noisy', number)
+
+        assert scheduler.pop() == ('noisy', 0)
+        assert scheduler.pop() is None
+
+        scheduler.done('noisy')
+        assert scheduler.pop() == ('noisy', 1)
+    #---
+
+    def test_ForgetsFinishedFlows(self):
+        """
+        Tests that flows with nothing waiting or running leave no state behind.
+
+        """
+        self.scheduler.push('once', 0)
+        self.drain(1)
+
+        assert (self.scheduler._flows, self.scheduler._last_finish, dict(self.scheduler._running)) == ({}, {}, {})
+    #---
+#---
+
+class Test_EarliestDeadlineFirst(object):
+    """
+    Tests the EarliestDeadlineFirst class.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.now = 100.0
+        self.scheduler = scheduling.EarliestDeadlineFirst(min_remaining=0.5, default_timeout=5.0,
+                                                          clock=lambda: self.now)
+    #---
+
+    def test_EarliestDeadlineGoesFirst(self):
+        """
+        Tests that items are taken by deadline, not arrival, and that items without one are due after the default
+        timeout.
+
+        """
+        self.scheduler.push('rpc', 'loose', 110.0)
+        self.scheduler.push('rpc', 'none')
+        self.scheduler.push('rpc', 'tight', 101.0)
+
+        assert [self.scheduler.pop()[1] for _ in range(3)] == ['tight', 'none', 'loose']
+        assert self.scheduler.pop() is None
+    #---
+
+    def test_GivesUpItemsThatCantMakeIt(self):
+        """
+        Tests that items with less than min_remaining left are expired, and the rest kept.
+
+        """
+        self.scheduler.push('rpc', 'late', 99.0)
+        self.scheduler.push('rpc', 'close', 100.4)
+        self.scheduler.push('rpc', 'fine', 101.0)
+
+        assert self.scheduler.expired() == [('rpc', 'late'), ('rpc', 'close')]
+        assert (len(self.scheduler), self.scheduler.backlog('rpc')) == (1, 1)
+    #---
+
+    def test_ItemsWithoutDeadlineNeverExpire(self):
+        """
+        Tests that the default deadline orders items but does not expire them.
+
+        """
+        self.scheduler.push('rpc', 'none')
+        self.now += 60
+
+        assert self.scheduler.expired() == []
+        assert self.scheduler.pop() == ('rpc', 'none')
+    #---
+#---
@@ -0,0 +1,229 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_workers.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests for the workers module.
+#
+
+import mock
+import Queue
+import threading
+from rabbitrpc.rabbitmq import workers
+
+
+class Test_WorkerPool(object):
+    """
+    Tests the WorkerPool class.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.handled = Queue.Queue()
+        self.pool = workers.WorkerPool(3, self.handled.put)
+    #---
+
+    def teardown_method(self, method):
+        self.pool.stop()
+    #---
+
+    def test_StartsRequestedNumberOfThreads(self):
+        """
+        Tests that the pool starts one thread per worker.
+
+        """
+        assert len(self.pool._threads) == 3
+        assert all(thread.is_alive() for thread in self.pool._threads)
+    #---
+
+    def test_SubmittedTasksAreHandled(self):
+        """
+        Tests that submitted tasks are passed to the handler.
+
+        """
+        for task in range(5):
+            self.pool.submit(task)
+
+        assert sorted(self.handled.get(timeout=1) for _ in range(5)) == range(5)
+    #---
+
+    def test_HandlerExceptionsDoNotKillWorkers(self):
+        """
+        Tests that a failing handler is logged and the worker keeps going.
+
+        """
+        self.pool.stop()
+        handler = mock.MagicMock(side_effect=[ValueError(), None])
+        self.pool = workers.WorkerPool(1, handler)
+        self.pool.log = mock.MagicMock()
+        done = Queue.Queue()
+        handler.side_effect = lambda task: done.put(task) if task == 'second' else 1 / 0
+
+        self.pool.submit('first')
+        self.pool.submit('second')
+
+        assert done.get(timeout=1) == 'second'
+        assert self.pool.log.exception.called
+    #---
+
+    def test_StopEndsThreads(self):
+        """
+        Tests that stop ends the worker threads.
+
+        """
+        threads = list(self.pool._threads)
+        self.pool.stop()
+
+        for thread in threads:
+            thread.join(1)
+            assert not thread.is_alive()
+    #---
+
+    def test_BacklogCountsUnstartedTasks(self):
+        """
+        Tests that backlog reports the tasks no worker has picked up yet.
+
+        """
+        self.pool.stop()
+        self.pool = workers.WorkerPool(0, self.handled.put)
+        self.pool.submit('a')
+        self.pool.submit('b')
+
+        assert self.pool.backlog() == 2
+    #---
+
+    def test_ResizeGrowsAndShrinks(self):
+        """
+        Tests that resize starts new threads, and that surplus threads stop.
+
+        """
+        self.pool.resize(5)
+
+        assert self.pool.size == 5
+        assert sum(thread.is_alive() for thread in self.pool._threads) == 5
+
+        self.pool.resize(1)
+        for thread in self.pool._threads:
+            thread.join(0.2)
+
+        assert self.pool.size == 1
+        assert sum(thread.is_alive() for thread in self.pool._threads) == 1
+
+        self.pool.submit('still working')
+        assert self.handled.get(timeout=1) == 'still working'
+    #---
+
+    def test_ResizeForgetsStoppedThreads(self):
+        """
+        Tests that resize drops stopped threads and reuses their names.
+
+        """
+        for size in (1, 3, 1):
+            self.pool.resize(size)
+            for thread in self.pool._threads:
+                thread.join(0.2)
+        self.pool.resize(3)
+
+        assert len(self.pool._threads) == 3
+        assert sorted(thread.name for thread in self.pool._threads) == ['rabbitrpc-worker-%i' % number
+                                                                        for number in range(3)]
+    #---
+#---
+
+class Test_WorkerPoolKeys(object):
+    """
+    Tests the WorkerPool class' ordering of keyed tasks.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.events = Queue.Queue()
+        self.release = {}
+
+        def handler(task):
+            self.events.put(('start', task))
+            if task in self.release:
+                self.release[task].wait(1)
+            self.events.put(('end', task))
+        #---
+
+        self.pool = workers.WorkerPool(4, handler)
+    #---
+
+    def teardown_method(self, method):
+        for event in self.release.values():
+            event.set()
+        self.pool.stop()
+    #---
+
+    def test_SameKeyRunsInOrderOneAtATime(self):
+        """
+        Tests that tasks with the same key never overlap and run in submission order.
+
+        """
+        self.release['a1'] = threading.Event()
+        self.pool.submit('a1', 'account-a')
+        self.pool.submit('a2', 'account-a')
+
+        assert self.events.get(timeout=1) == ('start', 'a1')
+        assert self.pool.backlog() == 1
+
+        self.release['a1'].set()
+
+        assert [self.events.get(timeout=1) for _ in range(3)] == [('end', 'a1'), ('start', 'a2'), ('end', 'a2')]
+    #---
+
+    def test_DifferentKeysRunInParallel(self):
+        """
+        Tests that a busy key does not hold up tasks with other keys.
+
+        """
+        self.release['a1'] = threading.Event()
+        self.pool.submit('a1', 'account-a')
+        self.pool.submit('b1', 'account-b')
+
+        events = [self.events.get(timeout=1) for _ in range(3)]
+        self.release['a1'].set()
+
+        assert ('end', 'b1') in events
+        assert ('end', 'a1') not in events
+    #---
+
+    def test_KeyIsReleasedAfterFailure(self):
+        """
+        Tests that a failing task does not block the later tasks for its key.
+
+        """
+        self.pool.stop()
+        self.pool = workers.WorkerPool(2, lambda task: self.events.put(task) if task != 'bad' else 1 / 0)
+        self.pool.log = mock.MagicMock()
+
+        self.pool.submit('bad', 'account-a')
+        self.pool.submit('good', 'account-a')
+
+        assert self.events.get(timeout=1) == 'good'
+    #---
+#---
@@ -25,6 +25,8 @@
 
 
 import inspect
+import mock
+import pytest
 from rabbitrpc.server import register
 
 class Test_RPCFunction(object):
@@ -204,4 +206,264 @@ class Test_RPCFunction(object):
 
         assert 'function_local_module2' in self.server_stub.definitions[self.module]
     #---
-#---
\ No newline at end of file
+#---
+class Test_RPCFunctionOptions(object):
+    """
+    Tests register's `RPCFunction` method when used with endpoint options.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        class RPCServerStub(object):
+            definitions = {}
+            _module_map = {}
+
+            @classmethod
+            def register_definition(cls, definition, module_map):
+                cls.definitions.update(definition)
+                cls._module_map.update(module_map)
+        #---
+
+        self.server_stub = RPCServerStub
+        self.module = self.__module__.split('.')[-1]
+
+        self.local_register = reload(register)
+        self.local_register.rpcserver.RPCServer = RPCServerStub
+    #---
+
+    def test_OptionsAreIncluded(self):
+        """
+        Tests that endpoint options are included with the function definition.
+
+        """
+        @self.local_register.RPCFunction(cache_ttl=30)
+        def function_with_options():
+            return
+        #---
+
+        options = self.server_stub.definitions[self.module]['function_with_options']['options']
+        assert options == {'cache_ttl': 30}
+    #---
+
+    def test_ReturnsTheFunction(self):
+        """
+        Tests that the decorated function is returned untouched when options are given.
+
+        """
+        def function_returned():
+            return 'yes'
+        #---
+
+        assert self.local_register.RPCFunction(cache_ttl=30)(function_returned) is function_returned
+    #---
+
+    def test_BareDecoratorHasNoOptions(self):
+        """
+        Tests that the bare decorator registers an empty set of options.
+
+        """
+        def function_without_options():
+            return
+        #---
+        self.local_register.RPCFunction(function_without_options)
+
+        assert self.server_stub.definitions[self.module]['function_without_options']['options'] == {}
+    #---
+
+    def test_RaisesErrorOnUnknownOption(self):
+        """
+        Tests that unknown endpoint options are refused.
+
+        """
+        def function_bad_option():
+            return
+        #---
+
+        with pytest.raises(self.local_register.RegistrationError):
+            self.local_register.RPCFunction(not_an_option=True)(function_bad_option)
+    #---
+
+    def test_RaisesErrorOnUnknownDurability(self):
+        """
+        Tests that durability profiles the producer does not know are refused.
+
+        """
+        def function_bad_durability():
+            return
+        #---
+
+        with pytest.raises(self.local_register.RegistrationError):
+            self.local_register.RPCFunction(durability='sturdy')(function_bad_durability)
+    #---
+#---
+
+class Test_RPCClass(object):
+    """
+    Tests register's `RPCClass` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        class RPCServerStub(object):
+            definitions = {}
+            _module_map = {}
+
+            @classmethod
+            def register_definition(cls, definition, module_map):
+                cls.definitions.update(definition)
+                cls._module_map.update(module_map)
+        #---
+
+        self.server_stub = RPCServerStub
+        self.module = self.__module__.split('.')[-1]
+
+        self.local_register = reload(register)
+        self.local_register.rpcserver.RPCServer = RPCServerStub
+
+        class Session(object):
+            """
+            A session
+            """
+            def __init__(self, user, timeout = 10):
+                pass
+
+            def fetch(self, key):
+                """
+                Fetches a key
+                """
+
+            def _internal(self):
+                pass
+        #---
+
+        self.cls = Session
+    #---
+
+    def test_ConstructorArgsLeaveOutSelf(self):
+        """
+        Tests that the class' args are those of its constructor, without `self`.
+
+        """
+        self.local_register.RPCClass(self.cls)
+
+        args = self.server_stub.definitions[self.module]['Session']['args']
+        assert args['defined'] == {'var': ['user'], 'kw': {'timeout': 10}}
+    #---
+
+    def test_PublicMethodsAreIncluded(self):
+        """
+        Tests that public methods are described, without `self`, and private ones are left out.
+
+        """
+        self.local_register.RPCClass(self.cls)
+
+        methods = self.server_stub.definitions[self.module]['Session']['methods']
+        assert methods.keys() == ['fetch']
+        assert methods['fetch']['args']['defined'] == {'var': ['key'], 'kw': None}
+        assert methods['fetch']['doc'] == 'Fetches a key'
+    #---
+
+    def test_ClassWithoutConstructorHasNoArgs(self):
+        """
+        Tests that a class using object's constructor takes no arguments.
+
+        """
+        class Plain(object):
+            pass
+        #---
+        self.local_register.RPCClass(Plain)
+
+        assert self.server_stub.definitions[self.module]['Plain']['args'] is None
+    #---
+
+    def test_OptionsAreIncluded(self):
+        """
+        Tests that endpoint options are included with the class definition, and the class is returned untouched.
+
+        """
+        assert self.local_register.RPCClass(object_ttl=30)(self.cls) is self.cls
+        assert self.server_stub.definitions[self.module]['Session']['options'] == {'object_ttl': 30}
+    #---
+
+    def test_UnknownOptionsAreRefused(self):
+        """
+        Tests that unknown endpoint options raise RegistrationError.
+
+        """
+        with pytest.raises(self.local_register.RegistrationError):
+            self.local_register.RPCClass(bogus=True)(self.cls)
+    #---
+
+    def test_SharedResultOptionsAreRefused(self):
+        """
+        Tests that options which would share one remote object between callers raise RegistrationError.
+
+        """
+        for options in ({'cache_ttl': 30}, {'coalesce': True}, {'delta': True}, {'idempotent': True}):
+            with pytest.raises(self.local_register.RegistrationError):
+                self.local_register.RPCClass(**options)(self.cls)
+    #---
+#---
+
+class Test_RPCFunctionArgumentOptions(object):
+    """
+    Tests register's `RPCFunction` method with options that name an argument.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_register = reload(register)
+        self.local_register.rpcserver.RPCServer = mock.MagicMock()
+    #---
+
+    def test_ArgumentIsAccepted(self):
+        """
+        Tests that route_by may name a positional or keyword argument.
+
+        """
+        def charge(account, amount, currency = 'EUR'):
+            return
+        #---
+
+        self.local_register.RPCFunction(route_by='account')(charge)
+        self.local_register.RPCFunction(route_by='currency')(charge)
+    #---
+
+    def test_UnknownArgumentIsRefused(self):
+        """
+        Tests that route_by naming an argument the function does not have raises RegistrationError.
+
+        """
+        def charge(account):
+            return
+        #---
+
+        with pytest.raises(self.local_register.RegistrationError):
+            self.local_register.RPCFunction(route_by='user')(charge)
+    #---
+
+    def test_OrderByIsChecked(self):
+        """
+        Tests that order_by is checked against the function's arguments too.
+
+        """
+        def charge(account):
+            return
+        #---
+
+        with pytest.raises(self.local_register.RegistrationError):
+            self.local_register.RPCFunction(order_by='user')(charge)
+    #---
+#---
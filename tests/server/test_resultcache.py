@@ -0,0 +1,149 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_resultcache.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Unit tests for the resultcache module
+#
+
+import mock
+from rabbitrpc.server import resultcache
+
+
+class Test_get(object):
+    """
+    Tests ResultCache's `get` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_resultcache = reload(resultcache)
+        self.local_resultcache.time = mock.MagicMock()
+        self.local_resultcache.time.time.return_value = 100.0
+
+        self.cache = self.local_resultcache.ResultCache(100, ttl=10)
+        self.cache.set('key', 'value')
+    #---
+
+    def test_ReturnsStoredValue(self):
+        """
+        Tests that get returns a value that was stored.
+
+        """
+        assert self.cache.get('key') == 'value'
+    #---
+
+    def test_ReturnsNoneForMissingKey(self):
+        """
+        Tests that get returns `None` for keys that were never stored.
+
+        """
+        assert self.cache.get('nope') is None
+    #---
+
+    def test_ReturnsNoneForExpiredEntry(self):
+        """
+        Tests that get does not return entries whose TTL has elapsed, and releases their space.
+
+        """
+        self.local_resultcache.time.time.return_value = 110.0
+
+        assert self.cache.get('key') is None
+        assert self.cache.size == 0
+    #---
+
+    def test_CountsHitsAndMisses(self):
+        """
+        Tests that get keeps hit/miss counts.
+
+        """
+        self.cache.get('key')
+        self.cache.get('nope')
+
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+    #---
+#---
+
+class Test_set(object):
+    """
+    Tests ResultCache's `set` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.cache = resultcache.ResultCache(10)
+    #---
+
+    def test_TracksSizeOfValues(self):
+        """
+        Tests that set accounts for the length of the stored values.
+
+        """
+        self.cache.set('a', '1234')
+        self.cache.set('b', '12')
+
+        assert self.cache.size == 6
+    #---
+
+    def test_ReplacingValueUpdatesSize(self):
+        """
+        Tests that overwriting a key does not double count it.
+
+        """
+        self.cache.set('a', '1234')
+        self.cache.set('a', '12')
+
+        assert self.cache.size == 2
+    #---
+
+    def test_EvictsLeastRecentlyUsedWhenOverBudget(self):
+        """
+        Tests that set evicts the least recently used entries to stay within the byte budget.
+
+        """
+        self.cache.set('a', '1234')
+        self.cache.set('b', '1234')
+        self.cache.get('a')
+        self.cache.set('c', '1234')
+
+        assert self.cache.get('b') is None
+        assert self.cache.get('a') == '1234'
+        assert self.cache.size == 8
+    #---
+
+    def test_RefusesValuesLargerThanBudget(self):
+        """
+        Tests that set refuses values that could never fit, without flushing the cache.
+
+        """
+        self.cache.set('a', '1234')
+
+        assert self.cache.set('b', 'x' * 11) is False
+        assert self.cache.get('a') == '1234'
+    #---
+#---
@@ -25,9 +25,12 @@
 
 import cPickle
 import copy
+import imp
 import pytest
 import mock
 import sys
+import threading
+import time
 import traceback
 
 from rabbitrpc.server import rpcserver
@@ -183,11 +186,10 @@ class Test_run(object):
 
     def test_CreatesAConsumer(self):
         """
-        Tests that run creates a consumer, also tests that the config gets neutered before being passed.
+        Tests that run creates a consumer with the callback and the RabbitMQ config.
 
         """
-        self.local_rpcserver.consumer.Consumer.assert_called_with(self.server._rabbit_callback,
-                MQ_CONFIG['queue_name'], MQ_CONFIG['exchange'], MQ_CONFIG['connection_settings'] )
+        self.local_rpcserver.consumer.Consumer.assert_called_with(self.server._rabbit_callback, MQ_CONFIG)
     #---
 
     def test_RunsTheConsumer(self):
@@ -199,6 +201,167 @@ class Test_run(object):
     #---
 #---
 
+class Test_run_module_routing(object):
+    """
+    Tests RPCServer's `run` method with per-module routing.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+        self.rabbit_consumer = mock.MagicMock()
+        self.local_rpcserver.consumer.Consumer = mock.MagicMock(return_value=self.rabbit_consumer)
+        self.local_rpcserver.RPCServer.definitions = {
+            'billing': {'charge': {'args': None, 'doc': None, 'options': {}}},
+            'search': {'find': {'args': None, 'doc': None, 'options': {}}},
+        }
+
+        self.server = self.local_rpcserver.RPCServer(dict(MQ_CONFIG, routing='module'))
+        self.server.run()
+    #---
+
+    def test_ConsumesAQueuePerHostedModule(self):
+        """
+        Tests that run adds a durable queue for each module registered in the process.
+
+        """
+        assert self.rabbit_consumer.addQueue.call_args_list == [
+            mock.call('%s.billing' % MQ_CONFIG['queue_name'], durable=True),
+            mock.call('%s.search' % MQ_CONFIG['queue_name'], durable=True),
+        ]
+    #---
+#---
+
+class Test_run_lanes(object):
+    """
+    Tests RPCServer's `run` method with endpoints in lanes.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+        self.rabbit_consumer = mock.MagicMock()
+        self.local_rpcserver.consumer.Consumer = mock.MagicMock(return_value=self.rabbit_consumer)
+        self.local_rpcserver.RPCServer.definitions = {
+            'reports': {
+                'build': {'args': None, 'doc': None, 'options': {'lane': 'slow'}},
+                'peek': {'args': None, 'doc': None, 'options': {}},
+            },
+        }
+
+        # The lane's load shedding limit is for the server, not the consumer
+        lanes = {'slow': {'workers': 2, 'max_queue_wait': 5}}
+        self.server = self.local_rpcserver.RPCServer(dict(MQ_CONFIG, lanes=lanes))
+        self.server.run()
+    #---
+
+    def test_AddsTheEndpointsLanes(self):
+        """
+        Tests that run adds a lane for each lane used by the registered endpoints, sized from the config.
+
+        """
+        self.rabbit_consumer.addLane.assert_called_once_with('slow', '%s.lane.slow' % MQ_CONFIG['queue_name'],
+                                                             workers=2)
+    #---
+#---
+
+class Test_run_weighted_queues(object):
+    """
+    Tests RPCServer's `run` method with weighted queues.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+        self.rabbit_consumer = mock.MagicMock()
+        self.local_rpcserver.consumer.Consumer = mock.MagicMock(return_value=self.rabbit_consumer)
+        self.local_rpcserver.RPCServer.definitions = {}
+
+        weighted_queues = {'critical': {'weight': 4}, 'bulk': {'weight': 1, 'prefetch_count': 2}}
+        self.server = self.local_rpcserver.RPCServer(dict(MQ_CONFIG, weighted_queues=weighted_queues))
+        self.server.run()
+    #---
+
+    def test_AddsTheWeightedQueues(self):
+        """
+        Tests that run adds each configured weighted queue to the consumer, with its settings.
+
+        """
+        assert self.rabbit_consumer.addWeightedQueue.call_args_list == [mock.call('bulk', weight=1, prefetch_count=2),
+                                                                        mock.call('critical', weight=4)]
+    #---
+#---
+
+class Test_run_key_routing(object):
+    """
+    Tests RPCServer's `run` method with key-routed endpoints.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+        self.rabbit_consumer = mock.MagicMock()
+        self.local_rpcserver.consumer.Consumer = mock.MagicMock(return_value=self.rabbit_consumer)
+        self.local_rpcserver.RPCServer.definitions = {
+            'accounts': {'balance': {'args': None, 'doc': None, 'options': {'route_by': 'account'}}},
+        }
+
+        self.server = self.local_rpcserver.RPCServer(dict(MQ_CONFIG, hash_weight=20))
+        self.server.run()
+    #---
+
+    def test_BindsInstanceQueueToHashExchange(self):
+        """
+        Tests that the instance queue is bound to the consistent-hash exchange with the configured weight.
+
+        """
+        self.rabbit_consumer.addQueue.assert_called_once_with(
+            self.server.instance_queue, exclusive=True, auto_delete=True,
+            bindings=[('%s.hash' % MQ_CONFIG['queue_name'], 'x-consistent-hash', '20')])
+    #---
+#---
+
+class Test_cancellation_token(object):
+    """
+    Tests the `cancellation_token` function.
+
+    """
+    def test_ProvidesTheRunningCallsToken(self):
+        """
+        Tests that cancellation_token provides the token of the call running on the thread.
+
+        """
+        token = rpcserver.cancellation.CancellationToken('call-1')
+
+        with rpcserver.cancellation.running(token):
+            assert rpcserver.cancellation_token() is token
+    #---
+#---
+
 class Test_stop(object):
     """
     Tests RPCServer's `stop` method.
@@ -865,4 +1028,830 @@ class Test__rabbit_callback(object):
 
         assert expected_results == results
     #---
-#---
\ No newline at end of file
+#---
+class Test__cache_key(object):
+    """
+    Tests RPCServer's `_cache_key` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+
+        self.server = self.local_rpcserver.RPCServer(MQ_CONFIG)
+    #---
+
+    def call(self, varargs = None, kwargs = None):
+        return {
+            'internal': False,
+            'call_name': 'Bob',
+            'module': 'barker',
+            'args': {'varargs': varargs, 'kwargs': kwargs},
+        }
+    #---
+
+    def test_KeywordOrderDoesNotMatter(self):
+        """
+        Tests that _cache_key normalizes the keyword arguments.
+
+        """
+        first = self.server._cache_key(self.call(kwargs={'a': 1, 'b': 2, 'c': 3}))
+        second = self.server._cache_key(self.call(kwargs={'c': 3, 'b': 2, 'a': 1}))
+
+        assert first == second
+    #---
+
+    def test_MissingArgsMatchEmptyArgs(self):
+        """
+        Tests that _cache_key treats `None` args and empty args alike.
+
+        """
+        call = self.call()
+        call['args'] = None
+
+        assert self.server._cache_key(call) == self.server._cache_key(self.call((), {}))
+    #---
+
+    def test_DifferentArgsGiveDifferentKeys(self):
+        """
+        Tests that _cache_key distinguishes different arguments.
+
+        """
+        assert self.server._cache_key(self.call([1])) != self.server._cache_key(self.call([2]))
+    #---
+#---
+
+class Test__rabbit_callback_caching(object):
+    """
+    Tests the result memoization done by RPCServer's `_rabbit_callback` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+
+        self.endpoint = mock.MagicMock(return_value='expensive')
+        self.module = imp.new_module('cached_endpoints')
+        self.module.Bob = self.endpoint
+        sys.modules['cached_endpoints'] = self.module
+
+        self.local_rpcserver.RPCServer.definitions = {
+            'cached_endpoints': {
+                'Bob': {'args': None, 'doc': None, 'options': {'cache_ttl': 60}},
+                'Barker': {'args': None, 'doc': None, 'options': {}},
+            }
+        }
+        self.local_rpcserver.RPCServer._module_map = {'cached_endpoints': 'cached_endpoints'}
+
+        self.server = self.local_rpcserver.RPCServer(MQ_CONFIG)
+        self.server._encode_result = mock.MagicMock(side_effect=lambda *args: cPickle.dumps(args[0]))
+
+        self.call = cPickle.dumps({
+            'internal': False,
+            'call_name': 'Bob',
+            'args': {'varargs': [1], 'kwargs': None},
+            'module': 'cached_endpoints',
+        })
+    #---
+
+    def teardown_method(self, method):
+        del sys.modules['cached_endpoints']
+    #---
+
+    def test_RunsCallOnlyOnceForRepeatedRequests(self):
+        """
+        Tests that _rabbit_callback serves repeated requests to a memoized endpoint from the cache.
+
+        """
+        self.server._rabbit_callback(self.call)
+        self.server._rabbit_callback(self.call)
+
+        self.endpoint.assert_called_once_with(1)
+    #---
+
+    def test_HitsSkipEncoding(self):
+        """
+        Tests that cache hits return the stored encoded reply without encoding it again.
+
+        """
+        first = self.server._rabbit_callback(self.call)
+        second = self.server._rabbit_callback(self.call)
+
+        assert first == second
+        assert self.server._encode_result.call_count == 1
+    #---
+
+    def test_DoesNotCacheErrors(self):
+        """
+        Tests that _rabbit_callback does not memoize calls that raised an exception.
+
+        """
+        self.endpoint.side_effect = [ValueError(), 'fine']
+
+        self.server._rabbit_callback(self.call)
+        self.server._rabbit_callback(self.call)
+
+        assert self.endpoint.call_count == 2
+    #---
+
+    def test_DoesNotCacheEndpointsWithoutTTL(self):
+        """
+        Tests that endpoints without a cache_ttl option are run every time.
+
+        """
+        self.module.Barker = self.endpoint
+        call = cPickle.dumps({
+            'internal': False,
+            'call_name': 'Barker',
+            'args': None,
+            'module': 'cached_endpoints',
+        })
+
+        self.server._rabbit_callback(call)
+        self.server._rabbit_callback(call)
+
+        assert self.endpoint.call_count == 2
+    #---
+#---
+
+class Test__rabbit_callback_shared_cache(object):
+    """
+    Tests that RPCServer's `_rabbit_callback` memoizes into a provided result cache.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+
+        self.endpoint = mock.MagicMock(return_value='expensive')
+        self.module = imp.new_module('cached_endpoints')
+        self.module.Bob = self.endpoint
+        sys.modules['cached_endpoints'] = self.module
+
+        self.local_rpcserver.RPCServer.definitions = {
+            'cached_endpoints': {
+                'Bob': {'args': None, 'doc': None, 'options': {'cache_ttl': 60}},
+            }
+        }
+        self.local_rpcserver.RPCServer._module_map = {'cached_endpoints': 'cached_endpoints'}
+
+        self.result_cache = mock.MagicMock()
+        self.result_cache.get.return_value = None
+        self.server = self.local_rpcserver.RPCServer(MQ_CONFIG, result_cache=self.result_cache)
+
+        self.call = cPickle.dumps({
+            'internal': False,
+            'call_name': 'Bob',
+            'args': None,
+            'module': 'cached_endpoints',
+        })
+    #---
+
+    def teardown_method(self, method):
+        del sys.modules['cached_endpoints']
+    #---
+
+    def test_StoresResultWithEndpointTTL(self):
+        """
+        Tests that the encoded result is stored in the provided cache with the endpoint's TTL.
+
+        """
+        encoded_result = self.server._rabbit_callback(self.call)
+
+        key = self.server._cache_key(cPickle.loads(self.call))
+        self.result_cache.set.assert_called_once_with(key, encoded_result, 60)
+    #---
+
+    def test_ServesHitsFromProvidedCache(self):
+        """
+        Tests that hits in the provided cache are returned without running the call.
+
+        """
+        self.result_cache.get.return_value = 'cached reply'
+
+        assert self.server._rabbit_callback(self.call) == 'cached reply'
+        assert self.endpoint.called is False
+    #---
+#---
+
+class Test__rabbit_callback_coalescing(object):
+    """
+    Tests the coalescing of identical concurrent requests by RPCServer's `_rabbit_callback` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.runs = []
+
+        def slow_endpoint(value):
+            self.runs.append(value)
+            self.started.set()
+            self.release.wait(5)
+            return value * 2
+        #---
+
+        def checked_endpoint(value):
+            result = slow_endpoint(value)
+            rpcserver.cancellation_token().raise_if_cancelled()
+            return result
+        #---
+
+        self.module = imp.new_module('coalesced_endpoints')
+        self.module.Bob = slow_endpoint
+        self.module.Barker = slow_endpoint
+        self.module.Checked = checked_endpoint
+        sys.modules['coalesced_endpoints'] = self.module
+
+        self.local_rpcserver.RPCServer.definitions = {
+            'coalesced_endpoints': {
+                'Bob': {'args': None, 'doc': None, 'options': {'coalesce': True}},
+                'Barker': {'args': None, 'doc': None, 'options': {}},
+                'Checked': {'args': None, 'doc': None, 'options': {'coalesce': True}},
+            }
+        }
+        self.local_rpcserver.RPCServer._module_map = {'coalesced_endpoints': 'coalesced_endpoints'}
+
+        self.server = self.local_rpcserver.RPCServer(MQ_CONFIG)
+        self.replies = []
+    #---
+
+    def teardown_method(self, method):
+        self.release.set()
+        del sys.modules['coalesced_endpoints']
+    #---
+
+    def call(self, call_name, value):
+        return cPickle.dumps({
+            'internal': False,
+            'call_name': call_name,
+            'args': {'varargs': [value], 'kwargs': None},
+            'module': 'coalesced_endpoints',
+        })
+    #---
+
+    def run_concurrently(self, bodies, leader_context = None):
+        def serve(body):
+            self.replies.append(cPickle.loads(self.server._rabbit_callback(body))['result'])
+        #---
+        def lead(body):
+            with leader_context:
+                serve(body)
+        #---
+        threads = [threading.Thread(target=lead if leader_context else serve, args=(body,)) for body in bodies[:1]]
+        threads += [threading.Thread(target=serve, args=(body,)) for body in bodies[1:]]
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # Give the followers time to find the running call
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+    #---
+
+    def test_IdenticalRequestsRunOnce(self):
+        """
+        Tests that identical requests arriving while a matching one runs share its result.
+
+        """
+        self.run_concurrently([self.call('Bob', 21)] * 4)
+
+        assert self.runs == [21]
+        assert self.replies == [42] * 4
+        assert self.server.stats['coalesced_calls'] == 3
+    #---
+
+    def test_DifferentArgumentsAreNotMerged(self):
+        """
+        Tests that requests with different arguments are not coalesced.
+
+        """
+        self.release.set()
+        self.run_concurrently([self.call('Bob', 1), self.call('Bob', 2)])
+
+        assert sorted(self.runs) == [1, 2]
+        assert self.server.stats['coalesced_calls'] == 0
+    #---
+
+    def test_OtherEndpointsAreNotMerged(self):
+        """
+        Tests that identical requests to endpoints without the coalesce option all run.
+
+        """
+        self.run_concurrently([self.call('Barker', 21)] * 3)
+
+        assert self.runs == [21] * 3
+    #---
+
+    def test_CancelledCallIsRunAgainForTheOthers(self):
+        """
+        Tests that requests waiting on a call its caller cancelled don't share its cancellation, but run the call
+        themselves.
+
+        """
+        cancelled_calls = rpcserver.cancellation.CancelledCalls()
+        cancelled_calls.add('leader')
+        token = rpcserver.cancellation.CancellationToken('leader', cancelled_calls)
+
+        self.run_concurrently([self.call('Checked', 21)] * 3, rpcserver.cancellation.running(token))
+
+        assert self.runs == [21] * 3
+        cancelled = [reply for reply in self.replies if isinstance(reply, rpcserver.cancellation.CallCancelledError)]
+        assert (len(cancelled), self.replies.count(42)) == (1, 2)
+        assert (self.server.stats['coalesce_reruns'], self.server.stats['coalesced_calls']) == (2, 0)
+    #---
+
+    def test_ExpiredCallIsRunAgainForTheOthers(self):
+        """
+        Tests that requests waiting on a call that outlived its caller's deadline run the call themselves.
+
+        """
+        self.run_concurrently([self.call('Bob', 21)] * 2, rpcserver.admission.running(None, time.time()))
+
+        assert self.runs == [21] * 2
+        assert self.server.stats['coalesce_reruns'] == 1
+    #---
+#---
+
+class Test__rabbit_callback_blobs(object):
+    """
+    Tests the handling of content-addressed arguments by RPCServer's `_rabbit_callback` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+
+        self.endpoint = mock.MagicMock(return_value='trained')
+        self.module = imp.new_module('blob_endpoints')
+        self.module.Bob = self.endpoint
+        sys.modules['blob_endpoints'] = self.module
+
+        self.local_rpcserver.RPCServer.definitions = {
+            'blob_endpoints': {
+                'Bob': {'args': None, 'doc': None, 'options': {'blob_args': True}},
+            }
+        }
+        self.local_rpcserver.RPCServer._module_map = {'blob_endpoints': 'blob_endpoints'}
+
+        self.server = self.local_rpcserver.RPCServer(MQ_CONFIG)
+
+        self.big_arg = {'table': range(100)}
+        self.blob = cPickle.dumps(self.big_arg, 2)
+        self.digest = rpcserver.blobs.content_digest(self.blob)
+        self.ref = rpcserver.blobs.BlobRef(self.digest)
+    #---
+
+    def teardown_method(self, method):
+        del sys.modules['blob_endpoints']
+    #---
+
+    def call(self, blobs = None, complete = False):
+        call = {
+            'internal': False,
+            'call_name': 'Bob',
+            'args': {'varargs': (self.ref,), 'kwargs': {'other': self.ref}},
+            'module': 'blob_endpoints',
+        }
+        if blobs is not None:
+            call['blobs'] = blobs
+        if complete:
+            call['blobs_complete'] = True
+        return cPickle.dumps(call)
+    #---
+
+    def test_ResolvesReferencesFromSentBlobs(self):
+        """
+        Tests that references are replaced by the blobs sent along with the call.
+
+        """
+        self.server._rabbit_callback(self.call({self.digest: self.blob}))
+
+        self.endpoint.assert_called_once_with(self.big_arg, other=self.big_arg)
+    #---
+
+    def test_ResolvesReferencesFromStore(self):
+        """
+        Tests that blobs sent with an earlier call serve later calls that only send references.
+
+        """
+        self.server._rabbit_callback(self.call({self.digest: self.blob}))
+        reply = cPickle.loads(self.server._rabbit_callback(self.call()))
+
+        assert reply['result'] == 'trained'
+        assert self.endpoint.call_count == 2
+    #---
+
+    def test_ReportsMissingBlobs(self):
+        """
+        Tests that a reference to an unknown blob is answered with a BlobMissingError naming it.
+
+        """
+        reply = cPickle.loads(self.server._rabbit_callback(self.call()))
+
+        assert isinstance(reply['result'], rpcserver.blobs.BlobMissingError)
+        assert reply['result'].digests == [self.digest]
+        assert self.endpoint.called is False
+    #---
+
+    def test_RefusesBlobsThatDoNotMatchTheirDigest(self):
+        """
+        Tests that blobs whose content does not match their digest are not stored.
+
+        """
+        reply = cPickle.loads(self.server._rabbit_callback(self.call({self.digest: 'something else'})))
+
+        assert isinstance(reply['result'], rpcserver.blobs.BlobError)
+        assert self.server.blob_store.get(self.digest) is None
+    #---
+
+    def test_BlobsAreNotEchoedInReply(self):
+        """
+        Tests that the reply's copy of the call request does not carry the blobs back.
+
+        """
+        reply = cPickle.loads(self.server._rabbit_callback(self.call({self.digest: self.blob})))
+
+        assert 'blobs' not in reply['call']
+        assert reply['call']['args']['varargs'] == (self.ref,)
+    #---
+
+    def test_SentBlobsServeTheCallEvenIfNotStored(self):
+        """
+        Tests that a blob too large for the blob store still serves the call it was sent with.
+
+        """
+        self.server.blob_store = rpcserver.resultcache.ResultCache(10)
+
+        reply = cPickle.loads(self.server._rabbit_callback(self.call({self.digest: self.blob})))
+
+        assert reply['result'] == 'trained'
+        assert self.server.blob_store.get(self.digest) is None
+        assert self.server.stats['blobs_not_stored'] == 1
+    #---
+
+    def test_MissingBlobsOfACompleteCallAreUnavailable(self):
+        """
+        Tests that a call sent with all the client's blobs that still misses one gets an error the client won't retry.
+
+        """
+        reply = cPickle.loads(self.server._rabbit_callback(self.call({}, complete=True)))
+
+        assert isinstance(reply['result'], rpcserver.blobs.BlobUnavailableError)
+        assert not isinstance(reply['result'], rpcserver.blobs.BlobMissingError)
+        assert reply['result'].digests == [self.digest]
+    #---
+#---
+
+class Test__rabbit_callback_delta(object):
+    """
+    Tests the delta encoding of results by RPCServer's `_rabbit_callback` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+
+        self.status = {'hosts': dict(('host%i' % index, {'load': index}) for index in range(100))}
+        self.module = imp.new_module('delta_endpoints')
+        self.module.Bob = lambda: copy.deepcopy(self.status)
+        sys.modules['delta_endpoints'] = self.module
+
+        self.local_rpcserver.RPCServer.definitions = {
+            'delta_endpoints': {
+                'Bob': {'args': None, 'doc': None, 'options': {'delta': True}},
+            }
+        }
+        self.local_rpcserver.RPCServer._module_map = {'delta_endpoints': 'delta_endpoints'}
+
+        self.server = self.local_rpcserver.RPCServer(MQ_CONFIG)
+    #---
+
+    def teardown_method(self, method):
+        del sys.modules['delta_endpoints']
+    #---
+
+    def poll(self, base):
+        call = {
+            'internal': False,
+            'call_name': 'Bob',
+            'args': None,
+            'module': 'delta_endpoints',
+            'delta_base': base,
+        }
+        return cPickle.loads(self.server._rabbit_callback(cPickle.dumps(call)))['result']
+    #---
+
+    def test_FirstPollGetsFullResult(self):
+        """
+        Tests that a caller without a base gets the full result.
+
+        """
+        reply = self.poll(None)
+
+        assert reply.kind == rpcserver.delta.DeltaReply.FULL
+        assert reply.payload == self.status
+    #---
+
+    def test_UnchangedResultIsNotResent(self):
+        """
+        Tests that a caller holding the current result is told it is unchanged.
+
+        """
+        version = self.poll(None).version
+        reply = self.poll(version)
+
+        assert reply.kind == rpcserver.delta.DeltaReply.UNCHANGED
+        assert reply.payload is None
+    #---
+
+    def test_ChangedResultIsSentAsPatch(self):
+        """
+        Tests that a caller holding an older result gets a patch against it.
+
+        """
+        first = self.poll(None)
+        self.status['hosts']['host5']['load'] = 50
+        reply = self.poll(first.version)
+
+        assert reply.kind == rpcserver.delta.DeltaReply.PATCH
+        assert reply.apply(first.payload) == self.status
+    #---
+
+    def test_UnknownBaseGetsFullResult(self):
+        """
+        Tests that a caller holding a version the server no longer knows gets the full result.
+
+        """
+        assert self.poll('not a version').kind == rpcserver.delta.DeltaReply.FULL
+    #---
+
+    def test_CallsWithoutBaseAreNotDeltaEncoded(self):
+        """
+        Tests that requests which do not ask for delta encoding get the plain result.
+
+        """
+        call = {'internal': False, 'call_name': 'Bob', 'args': None, 'module': 'delta_endpoints'}
+
+        assert cPickle.loads(self.server._rabbit_callback(cPickle.dumps(call)))['result'] == self.status
+    #---
+#---
+
+class Test__rabbit_callback_objects(object):
+    """
+    Tests remote object calls handled by RPCServer's `_rabbit_callback` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+
+        class Counter(object):
+            def __init__(self, start = 0):
+                self.value = start
+
+            def add(self, amount):
+                self.value += amount
+                return self.value
+
+            def _secret(self):
+                return 'hidden'
+        #---
+
+        self.module = imp.new_module('object_endpoints')
+        self.module.Counter = Counter
+        sys.modules['object_endpoints'] = self.module
+
+        self.local_rpcserver.RPCServer.definitions = {
+            'object_endpoints': {
+                'Counter': {'args': None, 'doc': None, 'options': {'object_ttl': 30}, 'methods': {
+                    'add': {'args': None, 'doc': None},
+                }},
+            }
+        }
+        self.local_rpcserver.RPCServer._module_map = {'object_endpoints': 'object_endpoints'}
+
+        self.server = self.local_rpcserver.RPCServer(MQ_CONFIG)
+    #---
+
+    def teardown_method(self, method):
+        del sys.modules['object_endpoints']
+    #---
+
+    def call(self, call_name, varargs = None, object_id = None, internal = False):
+        call = {
+            'internal': internal,
+            'call_name': call_name,
+            'args': {'varargs': varargs, 'kwargs': None} if varargs else None,
+            'module': None if internal else 'object_endpoints',
+        }
+        if object_id:
+            call['object_id'] = object_id
+        return cPickle.loads(self.server._rabbit_callback(cPickle.dumps(call)))
+    #---
+
+    def test_ConstructorReturnsHandle(self):
+        """
+        Tests that calling a registered class returns a handle routed to this server's instance queue.
+
+        """
+        handle = self.call('Counter', [5])['result']
+
+        assert isinstance(handle, rpcserver.objects.ObjectHandle)
+        assert handle.route == self.server.instance_queue
+        assert (handle.module, handle.class_name) == ('object_endpoints', 'Counter')
+    #---
+
+    def test_MethodCallsShareTheObjectsState(self):
+        """
+        Tests that method calls run on the object the handle refers to.
+
+        """
+        handle = self.call('Counter', [5])['result']
+        self.call('add', [2], handle.id)
+
+        assert self.call('add', [3], handle.id)['result'] == 10
+    #---
+
+    def test_UnregisteredMethodsAreRefused(self):
+        """
+        Tests that only the registered (public) methods of an object may be called.
+
+        """
+        handle = self.call('Counter')['result']
+
+        assert isinstance(self.call('_secret', None, handle.id)['result'], rpcserver.CallError)
+    #---
+
+    def test_ReleaseDropsTheObject(self):
+        """
+        Tests that the internal release_object call drops the object, and later calls on it fail.
+
+        """
+        handle = self.call('Counter')['result']
+
+        assert self.call('release_object', [handle.id], internal=True)['result'] is True
+        assert isinstance(self.call('add', [1], handle.id)['result'], rpcserver.objects.ObjectError)
+    #---
+
+    def test_IdleObjectsExpire(self):
+        """
+        Tests that objects unused for longer than the class' object_ttl are dropped.
+
+        """
+        handle = self.call('Counter')['result']
+        self.server.objects._objects[handle.id][4] -= 60
+        self.server.objects._last_sweep -= 60
+
+        assert isinstance(self.call('add', [1], handle.id)['result'], rpcserver.objects.ObjectError)
+    #---
+
+    def test_RunConsumesTheInstanceQueue(self):
+        """
+        Tests that a server with registered classes also consumes its instance queue.
+
+        """
+        self.local_rpcserver.consumer.Consumer = mock.MagicMock()
+        self.server.run()
+
+        self.local_rpcserver.consumer.Consumer.return_value.addQueue.assert_called_once_with(
+            self.server.instance_queue, exclusive=True, auto_delete=True)
+    #---
+#---
+
+class Test__rabbit_callback_admission(object):
+    """
+    Tests RPCServer's shedding of calls that waited too long.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_rpcserver = reload(rpcserver)
+
+        self.local_rpcserver.logging.getLogger = mock.MagicMock()
+
+        self.module = imp.new_module('shed_endpoints')
+        self.module.report = lambda: 'report'
+        self.module.lookup = lambda: 'lookup'
+        self.module.anything = lambda: 'anything'
+        sys.modules['shed_endpoints'] = self.module
+
+        self.local_rpcserver.RPCServer.definitions = {
+            'shed_endpoints': {
+                'report': {'args': None, 'doc': None, 'options': {'lane': 'reports'}},
+                'lookup': {'args': None, 'doc': None, 'options': {'max_queue_wait': 0.5, 'lane': 'reports'}},
+                'anything': {'args': None, 'doc': None, 'options': {}},
+            }
+        }
+        self.local_rpcserver.RPCServer._module_map = {'shed_endpoints': 'shed_endpoints'}
+
+        config = copy.deepcopy(MQ_CONFIG)
+        config.update(max_queue_wait=10, lanes={'reports': {'workers': 2, 'max_queue_wait': 2}})
+        self.server = self.local_rpcserver.RPCServer(config)
+    #---
+
+    def teardown_method(self, method):
+        del sys.modules['shed_endpoints']
+    #---
+
+    def call(self, call_name, waited):
+        call = {'internal': False, 'call_name': call_name, 'args': None, 'module': 'shed_endpoints'}
+
+        with rpcserver.admission.running(waited):
+            return cPickle.loads(self.server._rabbit_callback(cPickle.dumps(call)))
+    #---
+
+    def test_EndpointLimitComesFirst(self):
+        """
+        Tests that an endpoint's own limit applies before its lane's.
+
+        """
+        assert self.call('lookup', 0.4)['result'] == 'lookup'
+
+        reply = self.call('lookup', 0.6)
+
+        assert isinstance(reply['result'], rpcserver.admission.OverloadError)
+        assert self.server.stats['shed_calls'] == 1
+    #---
+
+    def test_LaneLimitComesNext(self):
+        """
+        Tests that the lane's limit applies to endpoints without one of their own.
+
+        """
+        assert self.call('report', 1)['result'] == 'report'
+        assert isinstance(self.call('report', 3)['result'], rpcserver.admission.OverloadError)
+    #---
+
+    def test_ServerLimitComesLast(self):
+        """
+        Tests that the config's limit applies to the other endpoints, and that unstamped calls always run.
+
+        """
+        assert self.call('anything', 3)['result'] == 'anything'
+        assert isinstance(self.call('anything', 11)['result'], rpcserver.admission.OverloadError)
+        assert self.call('anything', None)['result'] == 'anything'
+    #---
+
+    def test_ShedCallsDoNotRun(self):
+        """
+        Tests that a shed call's endpoint is not run.
+
+        """
+        self.module.anything = mock.MagicMock()
+        self.call('anything', 11)
+
+        assert self.module.anything.called is False
+    #---
+#---
@@ -0,0 +1,224 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_sharedcache.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Unit tests for the sharedcache module
+#
+
+import mock
+import os
+import pytest
+from rabbitrpc.server import sharedcache
+
+
+class Test___init__(object):
+    """
+    Tests SharedResultCache's `__init__` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.cache = None
+    #---
+
+    def teardown_method(self, method):
+        if self.cache:
+            self.cache.close()
+    #---
+
+    def test_CreatesBackingFileOfBudgetSize(self, tmpdir):
+        """
+        Tests that __init__ lays out a file large enough for the whole slot table.
+
+        """
+        path = str(tmpdir.join('cache'))
+        self.cache = sharedcache.SharedResultCache(path, 64 * 1024, slot_size=1024, ways=4)
+
+        assert self.cache.num_sets == 16
+        assert os.path.getsize(path) >= 64 * 1024
+    #---
+
+    def test_ExistingFileGeometryWins(self, tmpdir):
+        """
+        Tests that a second process opening the file adopts the layout it was created with.
+
+        """
+        path = str(tmpdir.join('cache'))
+        first = sharedcache.SharedResultCache(path, 64 * 1024, slot_size=1024, ways=4)
+        self.cache = sharedcache.SharedResultCache(path, 1024 * 1024, slot_size=4096, ways=2)
+        first.close()
+
+        assert (self.cache.num_sets, self.cache.ways, self.cache.slot_size) == (16, 4, 1024)
+    #---
+
+    def test_RaisesErrorOnForeignFile(self, tmpdir):
+        """
+        Tests that __init__ refuses to map a file that isn't a cache file.
+
+        """
+        path = tmpdir.join('cache')
+        path.write('this is not a cache file at all')
+
+        with pytest.raises(sharedcache.SharedCacheError):
+            sharedcache.SharedResultCache(str(path), 64 * 1024)
+    #---
+#---
+
+class Test_get(object):
+    """
+    Tests SharedResultCache's `get` and `set` methods.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.caches = []
+    #---
+
+    def teardown_method(self, method):
+        for cache in self.caches:
+            cache.close()
+    #---
+
+    def open_cache(self, path, **kwargs):
+        cache = sharedcache.SharedResultCache(path, 4096, slot_size=1024, ways=4, **kwargs)
+        self.caches.append(cache)
+        return cache
+    #---
+
+    def test_ReturnsStoredValue(self, tmpdir):
+        """
+        Tests that get returns a value that was stored.
+
+        """
+        cache = self.open_cache(str(tmpdir.join('cache')))
+        cache.set('key', 'value')
+
+        assert cache.get('key') == 'value'
+        assert cache.get('other') is None
+        assert (cache.hits, cache.misses) == (1, 1)
+    #---
+
+    def test_RefusesValuesLargerThanASlot(self, tmpdir):
+        """
+        Tests that values up to the slot size less its header are stored, and larger ones are counted and turned away.
+
+        """
+        cache = self.open_cache(str(tmpdir.join('cache')))
+
+        assert cache.max_value_size == 1024 - 40
+        assert cache.set('fits', 'x' * cache.max_value_size) is True
+        assert cache.set('too big', 'x' * (cache.max_value_size + 1)) is False
+        assert cache.get('fits') == 'x' * cache.max_value_size
+        assert cache.too_large == 1
+    #---
+
+    def test_ValuesAreSharedBetweenInstances(self, tmpdir):
+        """
+        Tests that a value stored through one mapping can be read through another.
+
+        """
+        path = str(tmpdir.join('cache'))
+        self.open_cache(path).set('key', 'value')
+
+        assert self.open_cache(path).get('key') == 'value'
+    #---
+
+    def test_ValuesAreSharedBetweenProcesses(self, tmpdir):
+        """
+        Tests that a value stored by a child process can be read by its parent.
+
+        """
+        path = str(tmpdir.join('cache'))
+        cache = self.open_cache(path)
+
+        pid = os.fork()
+        if pid == 0:
+            child_cache = sharedcache.SharedResultCache(path, 4096, slot_size=1024, ways=4)
+            child_cache.set('key', 'from the child')
+            os._exit(0)
+
+        os.waitpid(pid, 0)
+        assert cache.get('key') == 'from the child'
+    #---
+
+    def test_ReturnsNoneForExpiredEntry(self, tmpdir):
+        """
+        Tests that get does not return entries whose TTL has elapsed.
+
+        """
+        cache = self.open_cache(str(tmpdir.join('cache')), ttl=10)
+        with mock.patch.object(sharedcache.time, 'time', return_value=100.0):
+            cache.set('key', 'value')
+        with mock.patch.object(sharedcache.time, 'time', return_value=111.0):
+            assert cache.get('key') is None
+    #---
+
+    def test_EvictsLeastRecentlyUsedSlot(self, tmpdir):
+        """
+        Tests that set overwrites the least recently used slot once a set is full.
+
+        """
+        cache = self.open_cache(str(tmpdir.join('cache')))
+
+        for index in range(4):
+            with mock.patch.object(sharedcache.time, 'time', return_value=float(index + 1)):
+                cache.set('key%i' % index, 'value%i' % index)
+        with mock.patch.object(sharedcache.time, 'time', return_value=10.0):
+            cache.get('key0')
+        with mock.patch.object(sharedcache.time, 'time', return_value=11.0):
+            cache.set('key4', 'value4')
+
+        assert cache.get('key1') is None
+        assert cache.get('key0') == 'value0'
+        assert cache.get('key4') == 'value4'
+    #---
+
+    def test_RefusesValuesLargerThanASlot(self, tmpdir):
+        """
+        Tests that set refuses values that do not fit in a slot.
+
+        """
+        cache = self.open_cache(str(tmpdir.join('cache')))
+
+        assert cache.set('key', 'x' * 1024) is False
+        assert cache.get('key') is None
+    #---
+
+    def test_DeleteRemovesValue(self, tmpdir):
+        """
+        Tests that delete removes a stored value.
+
+        """
+        cache = self.open_cache(str(tmpdir.join('cache')))
+        cache.set('key', 'value')
+        cache.delete('key')
+
+        assert cache.get('key') is None
+    #---
+#---
@@ -0,0 +1,122 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_admission.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests for the admission module.
+#
+
+import pytest
+from rabbitrpc import admission
+import time
+
+
+class Test_waited(object):
+    """
+    Tests the `waited` function.
+
+    """
+
+    def test_MeasuresFromTheStamp(self):
+        """
+        Tests that the wait is measured from the time of publishing.
+
+        """
+        sent_at = long((time.time() - 2) * 1000)
+
+        assert 1.9 < admission.waited({'x-sent-at': sent_at}) < 3
+    #---
+
+    def test_UnstampedCallsHaveNoWait(self):
+        """
+        Tests that calls without the header have no known wait.
+
+        """
+        assert admission.waited(None) is None
+        assert admission.waited({'x-order-key': 'a'}) is None
+    #---
+
+    def test_ClockSkewDoesNotGoNegative(self):
+        """
+        Tests that a stamp from a clock ahead of the server's counts as no wait.
+
+        """
+        assert admission.waited({'x-sent-at': long((time.time() + 5) * 1000)}) == 0
+    #---
+#---
+
+class Test_deadline(object):
+    """
+    Tests the `deadline` function and the current deadline.
+
+    """
+
+    def test_ReadsTheHeader(self):
+        """
+        Tests that the deadline is read in seconds, and is ``None`` for calls without one.
+
+        """
+        assert admission.deadline({'x-deadline': 1500}) == 1.5
+        assert admission.deadline({'x-sent-at': 1500}) is None
+        assert admission.deadline(None) is None
+    #---
+
+    def test_DeadlineIsSetWhileRunning(self):
+        """
+        Tests that the running call's deadline is current only within the block.
+
+        """
+        with admission.running(None, 12.5):
+            assert admission.current_deadline() == 12.5
+
+        assert admission.current_deadline() is None
+    #---
+#---
+
+class Test_admit(object):
+    """
+    Tests the `admit` function and the current queue wait.
+
+    """
+
+    def test_RefusesLateCalls(self):
+        """
+        Tests that only calls over the limit are refused.
+
+        """
+        admission.admit(1, 2)
+        admission.admit(None, 2)
+        admission.admit(5, None)
+
+        with pytest.raises(admission.OverloadError):
+            admission.admit(3, 2)
+    #---
+
+    def test_QueueWaitIsSetWhileRunning(self):
+        """
+        Tests that the running call's wait is current only within the block.
+
+        """
+        with admission.running(1.5):
+            assert admission.queue_wait() == 1.5
+
+        assert admission.queue_wait() is None
+    #---
+#---
@@ -0,0 +1,87 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_blobs.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Unit tests for the blobs module
+#
+
+import cPickle
+from rabbitrpc import blobs
+
+
+class Test_BlobRef(object):
+    """
+    Tests the BlobRef class.
+
+    """
+
+    def test_RefsWithSameDigestAreEqual(self):
+        """
+        Tests that references compare (and hash) by digest.
+
+        """
+        assert blobs.BlobRef('abc') == blobs.BlobRef('abc')
+        assert blobs.BlobRef('abc') != blobs.BlobRef('def')
+        assert hash(blobs.BlobRef('abc')) == hash(blobs.BlobRef('abc'))
+    #---
+
+    def test_SurvivesPickling(self):
+        """
+        Tests that references can be sent over the wire.
+
+        """
+        assert cPickle.loads(cPickle.dumps(blobs.BlobRef('abc'))) == blobs.BlobRef('abc')
+    #---
+#---
+
+class Test_BlobMissingError(object):
+    """
+    Tests the BlobMissingError class.
+
+    """
+
+    def test_KeepsDigestsThroughPickling(self):
+        """
+        Tests that the missing digests survive the trip back to the client.
+
+        """
+        error = cPickle.loads(cPickle.dumps(blobs.BlobMissingError(['abc', 'def'])))
+
+        assert error.digests == ['abc', 'def']
+        assert 'abc' in str(error)
+    #---
+#---
+
+class Test_content_digest(object):
+    """
+    Tests the `content_digest` function.
+
+    """
+
+    def test_DigestDependsOnContent(self):
+        """
+        Tests that equal content gives equal digests and different content different ones.
+
+        """
+        assert blobs.content_digest('abc') == blobs.content_digest('abc')
+        assert blobs.content_digest('abc') != blobs.content_digest('abd')
+    #---
+#---
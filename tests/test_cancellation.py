@@ -0,0 +1,101 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_cancellation.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests for the cancellation module.
+#
+
+import pytest
+from rabbitrpc import cancellation
+
+
+class Test_CancelledCalls(object):
+    """
+    Tests the CancelledCalls class.
+
+    """
+    def test_RemembersCancelledIds(self):
+        """
+        Tests that added ids are remembered.
+
+        """
+        cancelled = cancellation.CancelledCalls()
+        cancelled.add('call-1')
+
+        assert 'call-1' in cancelled
+        assert 'call-2' not in cancelled
+    #---
+
+    def test_ForgetsOldestIds(self):
+        """
+        Tests that only the latest ids are kept.
+
+        """
+        cancelled = cancellation.CancelledCalls(size=2)
+        for call_id in ('call-1', 'call-2', 'call-3'):
+            cancelled.add(call_id)
+
+        assert len(cancelled) == 2
+        assert 'call-1' not in cancelled
+    #---
+#---
+
+class Test_CancellationToken(object):
+    """
+    Tests the CancellationToken class and the current token.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.cancelled = cancellation.CancelledCalls()
+        self.token = cancellation.CancellationToken('call-1', self.cancelled)
+    #---
+
+    def test_FollowsTheCancelledCalls(self):
+        """
+        Tests that a token reports a cancellation made after it was created.
+
+        """
+        assert self.token.cancelled is False
+        self.token.raise_if_cancelled()
+
+        self.cancelled.add('call-1')
+
+        assert self.token.cancelled is True
+        with pytest.raises(cancellation.CallCancelledError):
+            self.token.raise_if_cancelled()
+    #---
+
+    def test_CurrentTokenIsSetWhileRunning(self):
+        """
+        Tests that the running call's token is current only within the block.
+
+        """
+        with cancellation.running(self.token):
+            assert cancellation.current_token() is self.token
+
+        assert cancellation.current_token().cancelled is False
+        assert cancellation.current_token().call_id is None
+    #---
+#---
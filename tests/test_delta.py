@@ -0,0 +1,148 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_delta.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Unit tests for the delta module
+#
+
+import copy
+import cPickle
+import pytest
+from rabbitrpc import delta
+
+
+class Test_make_patch(object):
+    """
+    Tests the `make_patch` and `apply_patch` functions.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.old = {
+            'status': 'ok',
+            'hosts': {'a': {'load': 1, 'up': True}, 'b': {'load': 2, 'up': True}},
+            'history': [1, 2, 3],
+            'gone': 'soon',
+        }
+        self.new = copy.deepcopy(self.old)
+        self.new['hosts']['b']['load'] = 5
+        self.new['history'][2] = 4
+        self.new['added'] = 'yes'
+        del self.new['gone']
+    #---
+
+    def test_EqualValuesGiveNoPatch(self):
+        """
+        Tests that there is no patch between equal values.
+
+        """
+        assert delta.make_patch(self.old, copy.deepcopy(self.old)) is None
+    #---
+
+    def test_PatchRebuildsNewValue(self):
+        """
+        Tests that applying the patch to the old value gives the new value.
+
+        """
+        patch = delta.make_patch(self.old, self.new)
+
+        assert delta.apply_patch(self.old, patch) == self.new
+    #---
+
+    def test_PatchOnlyCarriesChanges(self):
+        """
+        Tests that the patch is much smaller than the value when little changed.
+
+        """
+        self.old['hosts'].update(('host%i' % index, {'load': index, 'up': True}) for index in range(1000))
+        self.new['hosts'].update(('host%i' % index, {'load': index, 'up': True}) for index in range(1000))
+
+        patch = delta.make_patch(self.old, self.new)
+
+        assert len(cPickle.dumps(patch, 2)) * 20 < len(cPickle.dumps(self.new, 2))
+    #---
+
+    def test_ApplyDoesNotModifyOldValue(self):
+        """
+        Tests that apply_patch leaves the old value alone.
+
+        """
+        original = copy.deepcopy(self.old)
+        delta.apply_patch(self.old, delta.make_patch(self.old, self.new))
+
+        assert self.old == original
+    #---
+
+    def test_TypeChangesReplaceValue(self):
+        """
+        Tests that values that changed type are replaced whole.
+
+        """
+        assert delta.apply_patch([1, 2], delta.make_patch([1, 2], (1, 2))) == (1, 2)
+        assert delta.apply_patch([1, 2], delta.make_patch([1, 2], [1, 2, 3])) == [1, 2, 3]
+    #---
+#---
+
+class Test_DeltaReply(object):
+    """
+    Tests the DeltaReply class.
+
+    """
+
+    def test_UnchangedReturnsBase(self):
+        """
+        Tests that an unchanged reply rebuilds to the base.
+
+        """
+        assert delta.DeltaReply('v', delta.DeltaReply.UNCHANGED).apply({'a': 1}) == {'a': 1}
+    #---
+
+    def test_PatchIsAppliedToBase(self):
+        """
+        Tests that a patch reply is applied to the base.
+
+        """
+        reply = delta.DeltaReply('v', delta.DeltaReply.PATCH, delta.make_patch({'a': 1}, {'a': 2}))
+
+        assert reply.apply({'a': 1}) == {'a': 2}
+    #---
+
+    def test_FullIgnoresBase(self):
+        """
+        Tests that a full reply carries the whole result.
+
+        """
+        assert delta.DeltaReply('v', delta.DeltaReply.FULL, {'a': 2}).apply(None) == {'a': 2}
+    #---
+
+    def test_UnknownKindRaisesError(self):
+        """
+        Tests that an unknown reply kind raises DeltaError.
+
+        """
+        with pytest.raises(delta.DeltaError):
+            delta.DeltaReply('v', 'sideways').apply(None)
+    #---
+#---
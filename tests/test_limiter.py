@@ -0,0 +1,126 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_limiter.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests for the limiter module.
+#
+
+import pytest
+from rabbitrpc import limiter
+import threading
+
+
+class Test_AdaptiveLimiter(object):
+    """
+    Tests the AdaptiveLimiter class.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.limiter = limiter.AdaptiveLimiter(initial_limit=10, min_limit=2, max_limit=12)
+    #---
+
+    def fill(self, calls):
+        for _ in range(calls):
+            self.limiter.acquire()
+    #---
+
+    def test_RefusesCallsOverTheLimit(self):
+        """
+        Tests that calls beyond the limit fail fast.
+
+        """
+        self.fill(10)
+
+        with pytest.raises(limiter.ConcurrencyLimitError):
+            self.limiter.acquire()
+
+        assert self.limiter.in_flight == 10
+    #---
+
+    def test_QueuedCallTakesAFreedSlot(self):
+        """
+        Tests that with a queue timeout a call over the limit waits for a slot to be released.
+
+        """
+        self.limiter.queue_timeout = 1
+        self.fill(10)
+        timer = threading.Timer(0.05, self.limiter.release)
+        timer.start()
+
+        self.limiter.acquire()
+        timer.join()
+
+        assert self.limiter.in_flight == 10
+    #---
+
+    def test_GrowsWhileRoundTripsStayLow(self):
+        """
+        Tests that a busy limit grows while round trip times stay near the lowest seen.
+
+        """
+        self.fill(10)
+        self.limiter.release(0.010)
+        self.limiter.release(0.011)
+
+        assert self.limiter.limit == 12
+    #---
+
+    def test_ShrinksWhenRoundTripsShowQueueing(self):
+        """
+        Tests that round trips well above the lowest seen shrink the limit.
+
+        """
+        self.fill(1)
+        self.limiter.release(0.010)
+        self.fill(1)
+        self.limiter.release(0.100)
+
+        assert self.limiter.limit == 9
+    #---
+
+    def test_IdleLimitDoesNotGrow(self):
+        """
+        Tests that a limit far from being used is left alone.
+
+        """
+        self.fill(1)
+        self.limiter.release(0.010)
+
+        assert self.limiter.limit == 10
+    #---
+
+    def test_DropsBackOff(self):
+        """
+        Tests that a timed out call cuts the limit, down to the minimum.
+
+        """
+        for _ in range(20):
+            self.fill(1)
+            self.limiter.release(dropped=True)
+
+        assert self.limiter.limit == 2
+        assert self.limiter.in_flight == 0
+    #---
+#---
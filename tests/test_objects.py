@@ -0,0 +1,132 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_objects.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Unit tests for the objects module
+#
+
+import cPickle
+import mock
+import pytest
+from rabbitrpc import objects
+
+
+class Test_ObjectRegistry(object):
+    """
+    Tests the ObjectRegistry class.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.local_objects = reload(objects)
+        self.local_objects.time = mock.MagicMock()
+        self.local_objects.time.time.return_value = 100.0
+
+        self.registry = self.local_objects.ObjectRegistry(sweep_interval=1.0)
+        self.instance = object()
+        self.object_id = self.registry.add(self.instance, 'module', 'Class', 10)
+    #---
+
+    def test_GetProvidesTheObject(self):
+        """
+        Tests that get provides the object with its module and class name.
+
+        """
+        assert self.registry.get(self.object_id) == (self.instance, 'module', 'Class')
+    #---
+
+    def test_GetRaisesForUnknownObjects(self):
+        """
+        Tests that get raises ObjectError for objects that are not held.
+
+        """
+        with pytest.raises(self.local_objects.ObjectError):
+            self.registry.get('nope')
+    #---
+
+    def test_ReleaseDropsTheObject(self):
+        """
+        Tests that release drops the object and reports whether it was held.
+
+        """
+        assert self.registry.release(self.object_id) is True
+        assert self.registry.release(self.object_id) is False
+        assert len(self.registry) == 0
+    #---
+
+    def test_ExpireDropsIdleObjects(self):
+        """
+        Tests that expire drops objects idle for longer than their TTL, and keeps ones without a TTL.
+
+        """
+        self.registry.add(object(), 'module', 'Class', None)
+        self.local_objects.time.time.return_value = 111.0
+
+        assert self.registry.expire() == 1
+        assert len(self.registry) == 1
+    #---
+
+    def test_UseKeepsObjectsAlive(self):
+        """
+        Tests that using an object restarts its idle time.
+
+        """
+        self.local_objects.time.time.return_value = 105.0
+        self.registry.get(self.object_id)
+        self.local_objects.time.time.return_value = 111.0
+
+        assert self.registry.expire() == 0
+    #---
+
+    def test_ExpireSweepsAtMostOncePerInterval(self):
+        """
+        Tests that expire does nothing when the last sweep was less than sweep_interval ago.
+
+        """
+        self.local_objects.time.time.return_value = 111.0
+        self.registry.expire()
+        self.registry.add(object(), 'module', 'Class', 0)
+        self.local_objects.time.time.return_value = 111.5
+
+        assert self.registry.expire() == 0
+    #---
+#---
+
+class Test_ObjectHandle(object):
+    """
+    Tests the ObjectHandle class.
+
+    """
+
+    def test_SurvivesPickling(self):
+        """
+        Tests that a handle keeps its id, route, module and class name through pickling.
+
+        """
+        handle = cPickle.loads(cPickle.dumps(objects.ObjectHandle('abc', 'queue.1', 'module', 'Class')))
+
+        assert (handle.id, handle.route, handle.module, handle.class_name) == ('abc', 'queue.1', 'module', 'Class')
+    #---
+#---
@@ -0,0 +1,168 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_routing.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Unit tests for the routing module
+#
+
+import pytest
+from rabbitrpc import routing
+
+
+class Test_routing_mode(object):
+    """
+    Tests the `routing_mode` function.
+
+    """
+
+    def test_DefaultsToShared(self):
+        """
+        Tests that configs without a routing setting use shared routing.
+
+        """
+        assert routing.routing_mode({}) == routing.SHARED
+    #---
+
+    def test_ReadsModuleRouting(self):
+        """
+        Tests that module routing is read from the config.
+
+        """
+        assert routing.routing_mode({'routing': 'module'}) == routing.MODULE
+    #---
+
+    def test_RefusesUnknownModes(self):
+        """
+        Tests that unknown routing modes raise RoutingError.
+
+        """
+        with pytest.raises(routing.RoutingError):
+            routing.routing_mode({'routing': 'sideways'})
+    #---
+#---
+
+class Test_module_queue(object):
+    """
+    Tests the `module_queue` function.
+
+    """
+
+    def test_NamesQueueAfterMainQueueAndModule(self):
+        """
+        Tests that a module's queue is named after the main queue and the module.
+
+        """
+        assert routing.module_queue(routing.queue_name({}), 'rpcendpoints') == 'rabbitrpc.rpcendpoints'
+    #---
+
+    def test_NamesLaneQueuesApart(self):
+        """
+        Tests that lane queues can't be confused with module queues.
+
+        """
+        assert routing.lane_queue('rabbitrpc', 'reports') == 'rabbitrpc.lane.reports'
+    #---
+
+    def test_NamesCancelExchange(self):
+        """
+        Tests that the cancel exchange is named after the main queue.
+
+        """
+        assert routing.cancel_exchange('rabbitrpc') == 'rabbitrpc.cancel'
+    #---
+
+    def test_NamesRetryQueuesByDelay(self):
+        """
+        Tests that retry queues are named after the queue and their delay in milliseconds, next to the dead letters.
+
+        """
+        assert routing.retry_queue('rabbitrpc', 2.5) == 'rabbitrpc.retry.2500'
+        assert routing.dead_letter_exchange('rabbitrpc') == 'rabbitrpc.dlx'
+        assert routing.dead_letter_queue('rabbitrpc') == 'rabbitrpc.dead'
+    #---
+#---
+
+class Test_hash_routing_key(object):
+    """
+    Tests the `hash_routing_key` function.
+
+    """
+
+    def test_UsesTheKeysText(self):
+        """
+        Tests that keys are turned into their text, with unicode encoded as UTF-8.
+
+        """
+        assert routing.hash_routing_key(42) == '42'
+        assert routing.hash_routing_key(u'\xe9') == '\xc3\xa9'
+    #---
+
+    def test_LongKeysAreDigested(self):
+        """
+        Tests that keys too long for a routing key are replaced by a stable digest.
+
+        """
+        key = routing.hash_routing_key('x' * 300)
+
+        assert len(key) == 40
+        assert key == routing.hash_routing_key('x' * 300)
+    #---
+#---
+
+class Test_call_argument(object):
+    """
+    Tests the `call_argument` function.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.args_definition = {'defined': {'var': ['account', 'amount'], 'kw': {'currency': 'EUR'}},
+                                'kwargs_var': None, 'varargs_var': None}
+    #---
+
+    def test_FindsPositionalArguments(self):
+        """
+        Tests that positional arguments are found by their position in the definition.
+
+        """
+        assert routing.call_argument(self.args_definition, ('acct-1', 5), None, 'account') == 'acct-1'
+    #---
+
+    def test_FindsKeywordArguments(self):
+        """
+        Tests that arguments passed by keyword are found.
+
+        """
+        assert routing.call_argument(self.args_definition, (), {'account': 'acct-2'}, 'account') == 'acct-2'
+    #---
+
+    def test_FallsBackToDefault(self):
+        """
+        Tests that arguments the call leaves out read as their default.
+
+        """
+        assert routing.call_argument(self.args_definition, ('acct-1', 5), None, 'currency') == 'EUR'
+    #---
+#---
@@ -0,0 +1,120 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_singleflight.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Unit tests for the singleflight module
+#
+
+import threading
+from rabbitrpc import singleflight
+
+
+class Test_do(object):
+    """
+    Tests SingleFlight's `do` method.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.flights = singleflight.SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+        self.outcomes = []
+    #---
+
+    def slow_call(self, value):
+        self.calls.append(value)
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+    #---
+
+    def run_concurrently(self, key, value, count):
+        def waiter():
+            try:
+                self.outcomes.append(self.flights.do(key, self.slow_call, value))
+            except Exception as error:
+                self.outcomes.append(error)
+        #---
+        threads = [threading.Thread(target=waiter) for _ in range(count)]
+        threads[0].start()
+        # The first caller must be in flight before the others arrive
+        while not self.calls:
+            pass
+        for thread in threads[1:]:
+            thread.start()
+        while self.flights._flights[key].waiters < count - 1:
+            pass
+        self.release.set()
+        for thread in threads:
+            thread.join()
+    #---
+
+    def test_ReturnsResultAndNotShared(self):
+        """
+        Tests that a lone call runs and reports that its result was not shared.
+
+        """
+        self.release.set()
+
+        assert self.flights.do('key', self.slow_call, 'value') == ('value', False)
+    #---
+
+    def test_ConcurrentCallsShareOneExecution(self):
+        """
+        Tests that concurrent calls with the same key run the function once and all receive its result.
+
+        """
+        self.run_concurrently('key', 'value', 5)
+
+        assert self.calls == ['value']
+        assert sorted(self.outcomes) == [('value', False)] + [('value', True)] * 4
+    #---
+
+    def test_ExceptionIsRaisedToEveryWaiter(self):
+        """
+        Tests that an exception from the shared call is raised in every waiting caller.
+
+        """
+        error = ValueError('nope')
+        self.run_concurrently('key', error, 3)
+
+        assert self.outcomes == [error] * 3
+    #---
+
+    def test_KeyIsReleasedAfterTheCall(self):
+        """
+        Tests that a finished call does not serve later callers.
+
+        """
+        self.release.set()
+        self.flights.do('key', self.slow_call, 'first')
+        self.flights.do('key', self.slow_call, 'second')
+
+        assert self.calls == ['first', 'second']
+        assert len(self.flights) == 0
+    #---
+#---
@@ -0,0 +1,129 @@
+# coding=utf-8
+#
+# $Id: $
+#
+# NAME:         test_stats.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2013 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Unit tests for the stats module
+#
+
+from rabbitrpc import stats
+
+
+class Test_Counters(object):
+    """
+    Tests the Counters class.
+
+    """
+
+    def setup_method(self, method):
+        """
+        Test setup
+
+        """
+        self.counters = stats.Counters()
+    #---
+
+    def test_UnknownCounterIsZero(self):
+        """
+        Tests that counters that were never incremented read as 0.
+
+        """
+        assert self.counters['nothing'] == 0
+    #---
+
+    def test_IncrementAddsToCounter(self):
+        """
+        Tests that increment adds to the named counter.
+
+        """
+        self.counters.increment('calls')
+        self.counters.increment('calls', 4)
+
+        assert self.counters['calls'] == 5
+    #---
+
+    def test_SnapshotCopiesCounters(self):
+        """
+        Tests that snapshot provides a copy of all the counters.
+
+        """
+        self.counters.increment('calls')
+        snapshot = self.counters.snapshot()
+        self.counters.increment('calls')
+
+        assert snapshot == {'calls': 1}
+    #---
+
+    def test_SetReplacesValue(self):
+        """
+        Tests that set replaces a counter's value.
+
+        """
+        self.counters.increment('depth', 4)
+        self.counters.set('depth', 2)
+
+        assert self.counters['depth'] == 2
+    #---
+#---
+
+class Test_LatencyWindow(object):
+    """
+    Tests the LatencyWindow class.
+
+    """
+    def setup_method(self, method):
+        """
+        Test setup.
+
+        """
+        self.window = stats.LatencyWindow(size=10)
+    #---
+
+    def test_EmptyWindowHasNoPercentile(self):
+        """
+        Tests that percentile is None before any sample.
+
+        """
+        assert self.window.percentile(95) is None
+    #---
+
+    def test_Percentile(self):
+        """
+        Tests that percentile picks the nearest rank.
+
+        """
+        for latency in range(1, 11):
+            self.window.add(latency)
+
+        assert (self.window.percentile(50), self.window.percentile(95), self.window.percentile(0)) == (5, 10, 1)
+    #---
+
+    def test_KeepsLatestSamples(self):
+        """
+        Tests that only the latest samples are kept.
+
+        """
+        for latency in range(20):
+            self.window.add(latency)
+
+        assert len(self.window) == 10
+        assert self.window.percentile(0) == 10
+    #---
+#---